@@ -0,0 +1,216 @@
+"""
+Benchmarks for peerdid's hot paths. Builds a synthetic repo (see
+peerdid.workload) in a temp folder, times each operation, and writes the
+results as JSON so runs can be compared across commits:
+
+    python benchmarks/run.py --dids 200 --deltas 20 --keys 5 --out new.json
+    python benchmarks/run.py --compare old.json new.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    # See if peerdid module is installed.
+    import peerdid
+except ImportError:
+    # If not, then assume we're working with source code.
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from peerdid.diddoc import DIDDoc, get_path_where_diddocs_differ
+from peerdid.file import File
+from peerdid.ingest import Ingester, encode_message
+from peerdid.repo import Repo
+from peerdid.sync.folder_channel import Channel
+from peerdid.sync.socket_channel import SocketChannel
+from peerdid.workload import Workload
+
+
+def _timed(func, items):
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return time.perf_counter() - start
+
+
+def run(args):
+    results = {}
+
+    def record(name, ops, seconds):
+        best = results.get(name)
+        if best is None or seconds < best['seconds']:
+            results[name] = {'ops': ops, 'seconds': seconds, 'ops_per_sec': ops / seconds if seconds else None}
+
+    workload = Workload(seed=args.seed, keys=args.keys)
+    histories = list(workload.histories(args.dids, args.deltas))
+    genesis_docs = [h[0] for h in histories]
+    histories = [h[1:] for h in histories]
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as folder:
+            repo = Repo(os.path.join(folder, 'repo'))
+            dids = []
+            record('Repo.new_doc', args.dids, _timed(lambda g: dids.append(repo.new_doc(g)), genesis_docs))
+
+            files = [repo.get_doc(did).file for did in dids]
+            pairs = [(f, d) for f, history in zip(files, histories) for d in history]
+            record('File.append', len(pairs), _timed(lambda p: p[0].append(p[1]), pairs))
+
+            paths = [f.path for f in files]
+            record('File.load', len(paths), _timed(File, paths))
+
+            docs = [DIDDoc(path) for path in paths]
+            record('DIDDoc.resolve', len(docs), _timed(lambda d: d.resolve(), docs))
+            as_of = [h[len(h) // 2].when if h else None for h in histories]
+            record('DIDDoc.resolve(as_of)', len(docs),
+                   _timed(lambda i: docs[i].resolve(as_of[i]), range(len(docs))))
+
+            fresh = [File(path) for path in paths]
+            record('File.snapshot', len(fresh), _timed(lambda f: f.snapshot, fresh))
+
+            resolved = [d.resolve() for d in docs]
+            reordered = []
+            for doc in resolved:
+                doc = json.loads(json.dumps(doc))
+                doc['publicKey'].reverse()
+                reordered.append(doc)
+            record('get_path_where_diddocs_differ', len(resolved),
+                   _timed(lambda i: get_path_where_diddocs_differ(resolved[i], reordered[i]), range(len(resolved))))
+
+            channel_folder = os.path.join(folder, 'channel')
+            os.mkdir(channel_folder)
+            sender = Channel(channel_folder, is_destward=True)
+            receiver = Channel(channel_folder, is_destward=False)
+            # With the genesis delta, there's something to send even with --deltas 0.
+            sample = [d.to_json() for d in [genesis_docs[0]] + histories[0]]
+            payloads = sample * max(1, args.messages // len(sample))
+            record('Channel.send', len(payloads), _timed(sender.send, payloads))
+
+            async def drain():
+                n = 0
+                while await receiver.receive() is not None:
+                    n += 1
+                return n
+            start = time.perf_counter()
+            n = asyncio.run(drain())
+            record('Channel.receive', n, time.perf_counter() - start)
+
+            async def watch(count):
+                n = 0
+                if not count:
+                    # watch() would wait forever for a first message.
+                    return n
+                async for _ in receiver.watch():
+                    n += 1
+                    if n == count:
+                        break
+                return n
+            for payload in payloads:
+                sender.send(payload)
+            start = time.perf_counter()
+            n = asyncio.run(watch(len(payloads)))
+            record('Channel.watch', n, time.perf_counter() - start)
+
+            batches = [payloads[i:i + 64] for i in range(0, len(payloads), 64)]
+            start = time.perf_counter()
+            for batch in batches:
+                sender.send_many(batch)
+            record('Channel.send_many', len(payloads), time.perf_counter() - start)
+            start = time.perf_counter()
+            n = len(asyncio.run(receiver.receive_many()))
+            record('Channel.receive_many', n, time.perf_counter() - start)
+
+            ingest_folder = os.path.join(folder, 'ingest')
+            os.mkdir(ingest_folder)
+            ingest_sender = Channel(ingest_folder, is_destward=True)
+            messages = [encode_message('did:peer:1z' + g.encnumbasis, d)
+                        for g, h in zip(genesis_docs, histories) for d in [g] + h]
+            for i in range(0, len(messages), 64):
+                ingest_sender.send_many(messages[i:i + 64])
+            ingester = Ingester(Repo(os.path.join(folder, 'ingested')),
+                                Channel(ingest_folder, is_destward=False, ordered=True))
+            try:
+                stats = asyncio.run(ingester.run(idle_timeout=0))
+            finally:
+                ingester.close()
+            assert stats['rejected'] == 0
+            record('Ingester.run', stats['messages'], stats['seconds'])
+
+            socket_folder = os.path.join(folder, 'sock')
+            os.mkdir(socket_folder)
+            with SocketChannel(socket_folder, is_destward=True) as relay, \
+                    SocketChannel(socket_folder, is_destward=False) as agent:
+                start = time.perf_counter()
+                for payload in payloads:
+                    relay.send(payload)
+
+                async def drain_socket(count):
+                    n = 0
+                    while n < count:
+                        if await agent.receive() is None:
+                            await asyncio.sleep(0)
+                        else:
+                            n += 1
+                    return n
+                n = asyncio.run(drain_socket(len(payloads)))
+                record('SocketChannel.send+receive', n, time.perf_counter() - start)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path, 'rt') as f:
+        old = json.load(f)['results']
+    with open(new_path, 'rt') as f:
+        new = json.load(f)['results']
+    print('%-32s %14s %14s %8s' % ('benchmark', 'old ops/s', 'new ops/s', 'ratio'))
+    for name in sorted(set(old) | set(new)):
+        a = (old.get(name) or {}).get('ops_per_sec')
+        b = (new.get(name) or {}).get('ops_per_sec')
+        ratio = '%.2fx' % (b / a) if a and b else '-'
+        print('%-32s %14s %14s %8s' % (name, '%.1f' % a if a else '-', '%.1f' % b if b else '-', ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark peerdid.')
+    parser.add_argument('--dids', type=int, default=100, help='number of DIDs in the synthetic repo')
+    parser.add_argument('--deltas', type=int, default=20, help='deltas appended to each DID')
+    parser.add_argument('--keys', type=int, default=5, help='keys in each genesis doc')
+    parser.add_argument('--messages', type=int, default=1000, help='messages sent through the channel')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark; the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write JSON results here (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {k: getattr(args, k) for k in ('dids', 'deltas', 'keys', 'messages', 'repeat', 'seed')},
+        'results': run(args),
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'wt') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
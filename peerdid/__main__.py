@@ -0,0 +1,23 @@
+import argparse
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='peerdid', description='Peer DID repo tools.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('fsck', help='check (and optionally repair) the integrity of a repo')
+    p.add_argument('repo', help='folder that holds .diddocdeltas files')
+    p.add_argument('--repair', action='store_true',
+                   help='drop duplicate deltas, truncate torn last lines, and rename misnamed files')
+    p.add_argument('--workers', type=int, default=None, help='size of the process pool (default: one per core)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'fsck':
+        from .fsck import main as fsck_main
+        return fsck_main(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Optional compression for delta changes and channel messages. Change JSON is
+small and repetitive ("publicKey", "type": "Ed25519VerificationKey2018",
+"authentication", ...), which plain zlib can't exploit in a short input. So
+we compress with a preset dictionary of those recurring fragments. The
+dictionary ships with the package (deltas.zdict) and is tagged with an id,
+so compressed data stays readable after the dictionary is retrained.
+
+    compressed = compress(data)
+    assert decompress(compressed) == data
+
+Delta(change, by, compress=True) stores its change this way;
+Delta.change_json_bytes (and so .hash and the DID) are unaffected.
+"""
+
+import collections
+import os
+import re
+import zlib
+
+
+# The dictionary new data is compressed with. Ids of older dictionaries stay
+# in _DICTIONARY_FILES so data compressed with them can still be read.
+DICTIONARY_ID = 1
+_DICTIONARY_FILES = {1: 'deltas.zdict'}
+_dictionaries = {}
+
+# The most that inflate() will produce. Changes and messages are far smaller.
+MAX_SIZE = 16 * 1024 * 1024
+
+# Compressed payloads (e.g., channel messages) start with this, then the
+# dictionary id (one byte). JSON can't start with it.
+PAYLOAD_MAGIC = b'\x00PDZ'
+
+
+def get_dictionary(id: int = DICTIONARY_ID) -> bytes:
+    d = _dictionaries.get(id)
+    if d is None:
+        fname = _DICTIONARY_FILES.get(id)
+        if fname is None:
+            raise ValueError('Unknown compression dictionary %r.' % id)
+        with open(os.path.join(os.path.dirname(__file__), fname), 'rb') as f:
+            d = _dictionaries[id] = f.read()
+    return d
+
+
+def deflate(data: bytes, id: int = DICTIONARY_ID) -> bytes:
+    """Raw deflate of data, primed with dictionary id."""
+    c = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=get_dictionary(id))
+    return c.compress(data) + c.flush()
+
+
+def inflate(data: bytes, id: int = DICTIONARY_ID, max_size: int = None) -> bytes:
+    """
+    Undo deflate(). Raises ValueError if data isn't a complete deflate stream,
+    or if it would inflate to more than max_size bytes (default MAX_SIZE), so
+    a small hostile payload can't exhaust memory.
+    """
+    if max_size is None:
+        max_size = MAX_SIZE
+    d = zlib.decompressobj(-15, zdict=get_dictionary(id))
+    try:
+        # One byte more than allowed tells "at the limit" from "over it".
+        out = d.decompress(data, max_size + 1)
+    except zlib.error as e:
+        raise ValueError('Bad compressed data: %s' % e)
+    if len(out) > max_size or d.unconsumed_tail:
+        raise ValueError('Compressed data inflates to more than %d bytes.' % max_size)
+    if not d.eof:
+        raise ValueError('Compressed data is truncated.')
+    return out
+
+
+def compress(data: bytes) -> bytes:
+    """Compress a payload; the result is self-describing (see is_compressed)."""
+    return PAYLOAD_MAGIC + bytes([DICTIONARY_ID]) + deflate(data)
+
+
+def is_compressed(data: bytes) -> bool:
+    return data[:len(PAYLOAD_MAGIC)] == PAYLOAD_MAGIC
+
+
+def decompress(data: bytes, max_size: int = None) -> bytes:
+    """
+    Undo compress(). Data that isn't compressed is returned as is. Raises
+    ValueError if it's corrupt or too big (see inflate()).
+    """
+    if not is_compressed(data):
+        return data
+    n = len(PAYLOAD_MAGIC)
+    if len(data) <= n:
+        raise ValueError('Truncated compressed payload.')
+    return inflate(data[n + 1:], data[n], max_size)
+
+
+# Fragments of JSON text: a string plus what follows it up to the next value
+# ('"type": ', '"#key-1",'), or a run of closing brackets.
+_FRAGMENT_PAT = re.compile(rb'\s*"[^"]*"\s*:?\s*[\[{]?,?|\s*[\]}]+,?')
+
+
+def train_dictionary(samples, size: int = 16384) -> bytes:
+    """
+    Build a preset dictionary from sample JSON texts (bytes). Fragments that
+    occur in at least two samples are scored by how many samples hold them
+    times their length, and the best are kept, up to size bytes. deflate
+    reaches the end of the dictionary most cheaply, so the best go last.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(_FRAGMENT_PAT.findall(sample)))
+    scored = sorted(((n * len(frag), frag) for frag, n in counts.items() if n > 1), reverse=True)
+    chosen = []
+    total = 0
+    for score, frag in scored:
+        if total + len(frag) > size:
+            continue
+        chosen.append(frag)
+        total += len(frag)
+    return b''.join(reversed(chosen))
+
+
+def _default_samples():
+    """The samples deltas.zdict is trained on: synthetic histories and the predefined docs."""
+    import json
+    from .diddoc import get_predefined
+    from .jcs import canonicalize
+    from .workload import Workload
+    samples = []
+    for history in Workload(seed=0).histories(200, 10):
+        for d in history:
+            samples.append(d.change_json_bytes)
+            samples.append(canonicalize(d.change_json_dict))
+    for which in '12345':
+        doc = get_predefined(which)
+        samples.append(doc.encode('utf-8'))
+        samples.append(canonicalize(json.loads(doc)))
+    return samples
+
+
+if __name__ == '__main__':
+    # Regenerate the shipped dictionary: python -m peerdid.compression
+    # (Bump DICTIONARY_ID and add a new file, rather than overwriting one that
+    # stored data may depend on.)
+    path = os.path.join(os.path.dirname(__file__), _DICTIONARY_FILES[DICTIONARY_ID])
+    data = train_dictionary(_default_samples())
+    with open(path, 'wb') as f:
+        f.write(data)
+    print('Wrote %d bytes to %s.' % (len(data), path))
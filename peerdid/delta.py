@@ -1,10 +1,17 @@
 import base64
 import base58
+from concurrent.futures import ThreadPoolExecutor
+import copy
 from datetime import datetime
 import hashlib
 import json
+import os
+import re
+import time
 from typing import Union, List
 
+from . import compression, metrics
+from .jcs import canonicalize
 from .jsondetect import str_seems_like_json, bytes_seems_like_json
 
 
@@ -18,31 +25,71 @@ def _is_base64(txt):
 
 _bad_json = ValueError('change should be JSON str/bytes/dict, or base64 text.')
 
+# A compressed change is stored as "z<dictionary id>:<base64 of deflated JSON>".
+# ':' is not a base64 character, so this can't be mistaken for plain base64.
+_COMPRESSED_PAT = re.compile(r'z(\d+):')
+
+
+def _compress_change(change_bytes):
+    return 'z%d:%s' % (compression.DICTIONARY_ID,
+                       base64.urlsafe_b64encode(compression.deflate(change_bytes)).decode('ascii'))
+
+
 class Delta:
     """
     An immutable {change, by, when} object. Also has .hash and .encnumbasis properties that uniquely
     identify it. The values of these properties are derived only from .change; they are not
     affected by the values in .by and .when.
     """
-    def __init__(self, change_json: Union[str, bytes, dict], by: List, when: str = None):
-        if isinstance(change_json, str):
+    def __init__(self, change_json: Union[str, bytes, dict], by: List, when: str = None, canonical: bool = False,
+                 compress: bool = False):
+        """
+        :param canonical: If true, JSON (str, bytes, or dict) is re-serialized with the
+          JSON Canonicalization Scheme (RFC 8785) before it's encoded, so semantically
+          identical changes get identical bytes and the same .hash. Base64 text is
+          already in stored form, and is never rewritten.
+        :param compress: If true, the change is stored deflated with the shared
+          dictionary in peerdid.compression (about a quarter the size, for
+          typical changes). change_json_bytes, .hash and the DID are the same
+          either way. Compressed stored form is recognized, so from_dict()
+          round-trips it.
+        """
+        if isinstance(change_json, bytes) and _COMPRESSED_PAT.match(change_json[:16].decode('latin-1')):
+            change_json = change_json.decode('ascii')
+        if isinstance(change_json, str) and _COMPRESSED_PAT.match(change_json):
+            self._change = change_json
+            # Fail now (ValueError), not whenever the change is first read.
+            self.change_json_bytes
+        elif isinstance(change_json, str):
             if str_seems_like_json(change_json):
-                self._change = base64.urlsafe_b64encode(change_json.encode('utf-8')).decode('ascii')
+                if canonical:
+                    change_json = json.loads(change_json)
+                else:
+                    self._change = base64.urlsafe_b64encode(change_json.encode('utf-8')).decode('ascii')
             elif _is_base64(change_json):
                 self._change = change_json
             else:
                 raise _bad_json
         elif isinstance(change_json, bytes):
             if bytes_seems_like_json(change_json):
-                self._change = base64.urlsafe_b64encode(change_json).decode('ascii')
+                if canonical:
+                    change_json = json.loads(change_json)
+                else:
+                    self._change = base64.urlsafe_b64encode(change_json).decode('ascii')
             elif _is_base64(change_json):
                 self._change = change_json.decode('ascii')
             else:
                 raise _bad_json
-        elif isinstance(change_json, dict):
-            self._change = base64.urlsafe_b64encode(json.dumps(change_json, indent=2).encode('utf-8')).decode('ascii')
-        else:
+        elif not isinstance(change_json, dict):
             raise _bad_json
+        if isinstance(change_json, dict):
+            if canonical:
+                change_bytes = canonicalize(change_json)
+            else:
+                change_bytes = json.dumps(change_json, indent=2).encode('utf-8')
+            self._change = base64.urlsafe_b64encode(change_bytes).decode('ascii')
+        if compress and not self.compressed:
+            self._change = _compress_change(self.change_json_bytes)
         self._by = by
         if when is None:
             when = datetime.utcnow().isoformat()
@@ -54,8 +101,13 @@ class Delta:
         """
         The raw bytes, unencoded, that uniquely identify this delta.
         """
-        if not self._hash:
+        r = metrics.registry
+        if self._hash is None:
             self._hash = hashlib.sha256(self.change_json_bytes).digest()
+            if r is not None:
+                r.inc('delta_hash_cache_miss')
+        elif r is not None:
+            r.inc('delta_hash_cache_hit')
         return self._hash
 
     @property
@@ -74,8 +126,24 @@ class Delta:
     def when(self) -> str:
         return self._when
 
+    @property
+    def compressed(self) -> bool:
+        return _COMPRESSED_PAT.match(self._change) is not None
+
+    def compress(self) -> 'Delta':
+        """Return this delta with its change stored compressed (self, if it already is)."""
+        if self.compressed:
+            return self
+        # Copy rather than construct, which would inflate the change again to check it.
+        d = copy.copy(self)
+        d._change = _compress_change(self.change_json_bytes)
+        return d
+
     @property
     def change_json_bytes(self) -> bytes:
+        m = _COMPRESSED_PAT.match(self._change)
+        if m:
+            return compression.inflate(base64.urlsafe_b64decode(self._change[m.end():]), int(m.group(1)))
         return base64.urlsafe_b64decode(self._change)
 
     @property
@@ -92,7 +160,14 @@ class Delta:
 
     @classmethod
     def from_json(cls, json_text: Union[str, bytes]):
-        return Delta.from_dict(json.loads(json_text))
+        r = metrics.registry
+        if r is None:
+            return Delta.from_dict(json.loads(json_text))
+        start = time.perf_counter()
+        delta = Delta.from_dict(json.loads(json_text))
+        r.observe('delta_decode', time.perf_counter() - start)
+        r.inc('delta_decode_bytes', len(json_text))
+        return delta
 
     def to_dict(self):
         return {"change": self.change, "by": self._by, "when": self._when}
@@ -115,3 +190,38 @@ class Delta:
         if isinstance(other, Delta):
             return self.hash != other.hash
         return NotImplemented
+
+
+# Below this many deltas, handing work to threads costs more than it saves.
+_MIN_PARALLEL_HASHES = 256
+
+
+def _hash_all(deltas):
+    for d in deltas:
+        d._hash = hashlib.sha256(d.change_json_bytes).digest()
+
+
+def compute_hashes(deltas, executor=None, max_workers: int = None):
+    """
+    Populate the cached .hash of many deltas at once. The work is split into one
+    chunk per worker and run in a thread pool (the executor you pass, or a
+    temporary one). hashlib releases the GIL while it digests large buffers, so
+    big logs hash on all cores. Small batches are just hashed inline.
+    """
+    todo = [d for d in deltas if d._hash is None]
+    if not todo:
+        return
+    r = metrics.registry
+    if r is not None:
+        r.inc('delta_hash_cache_miss', len(todo))
+    if executor is None and (max_workers == 1 or len(todo) < _MIN_PARALLEL_HASHES):
+        _hash_all(todo)
+        return
+    n = max_workers or os.cpu_count() or 1
+    size = -(-len(todo) // n)
+    chunks = [todo[i:i + size] for i in range(0, len(todo), size)]
+    if executor is None:
+        with ThreadPoolExecutor(n) as pool:
+            list(pool.map(_hash_all, chunks))
+    else:
+        list(executor.map(_hash_all, chunks))
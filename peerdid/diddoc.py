@@ -1,8 +1,12 @@
+import copy
 import json
 import os
 import re
+import time
 from typing import Union
 
+from . import metrics, tracing
+from .delta import Delta
 from .file import File, canonical_fname
 from .jsondetect import str_seems_like_json, bytes_seems_like_json
 
@@ -27,10 +31,10 @@ class DIDDoc:
         if self._file:
             return self._file.did
 
-    def append(self, delta):
+    def append(self, delta) -> bool:
         if not self._file:
             self._file = File(os.path.join(self._folder, canonical_fname(delta.encnumbasis)))
-        self._file.append(delta)
+        return self._file.append(delta)
 
     @property
     def file(self):
@@ -43,36 +47,7 @@ class DIDDoc:
             return f.path
 
     def apply_delta(self, json_dict, delta):
-        change_fragment = delta.change_json_dict
-
-        def add_to_list(list_name, container):
-            d = container.get(list_name)
-            if d:
-                items = json_dict.get(list_name)
-                if not items:
-                    items = json_dict[list_name] = []
-                items.append(d[0])
-                return d[0]
-
-        def find_item_by_id(list, id):
-            if list:
-                for item in list:
-                    if item.id == id:
-                        return list, item
-
-        deleted_id = add_to_list('deleted', change_fragment)
-        if deleted_id:
-            list, found = find_item_by_id(json_dict.get('publicKey'), deleted_id)
-            if found:
-                list.remove(found)
-            json_dict.get('authentication', []).remove(deleted_id)
-            list, found = find_item_by_id(json_dict.get('authorization', {}).get('profiles'), deleted_id)
-            if found:
-                list.remove(found)
-        if add_to_list('publicKey', change_fragment):
-            add_to_list('authentication', change_fragment)
-            add_to_list('profiles', change_fragment.get('authorization', []))
-        add_to_list('rules', change_fragment)
+        _apply_change(json_dict, delta.change_json_dict)
 
     def resolve(self, as_of:str = None) -> dict:
         f = self.file
@@ -81,12 +56,23 @@ class DIDDoc:
         g = f.genesis
         if not g:
             return
-        json_dict = g.change_json_dict
-        for item in self.file.deltas[1:]:
-            if as_of and (item.when > as_of):
-                break
-            self.apply_delta(json_dict, item)
-        json_dict['id'] = self.did
+        r = metrics.registry
+        if r is not None:
+            start = time.perf_counter()
+        with tracing.tracer.start_as_current_span('DIDDoc.resolve') as span:
+            json_dict = g.change_json_dict
+            n = 0
+            for item in self.file.deltas[1:]:
+                if as_of and (item.when > as_of):
+                    break
+                self.apply_delta(json_dict, item)
+                n += 1
+            json_dict['id'] = self.did
+            span.set_attributes({'peerdid.did': json_dict['id'], 'peerdid.as_of': as_of or '',
+                                 'peerdid.deltas_replayed': n})
+        if r is not None:
+            r.observe('diddoc_resolve', time.perf_counter() - start)
+            r.inc('diddoc_resolve_deltas_applied', n)
         return json_dict
 
     @property
@@ -145,135 +131,290 @@ def get_predefined(which) -> str:
 
 
 class ValidationError(BaseException):
-    def __init__(self, msg):
+    def __init__(self, msg, errors=None):
         BaseException.__init__(self, msg)
+        # List of (path, message) tuples, in the order they were found.
+        self.errors = errors if errors is not None else []
 
 
+def _type_name(value_type):
+    if isinstance(value_type, tuple):
+        return ' or '.join(t.__name__ for t in value_type)
+    return value_type.__name__
 
-def _require(dict, key, value_type, contained_type=None, allow_empty=False, regex=None, allow_missing=False):
-    class Missing: pass
-    missing = Missing()
-    value = dict.get(key, missing)
-    if value is missing:
-        if not allow_missing:
-            raise ValidationError('Missing "%s" property' % key)
-    else:
-        if not isinstance(value, value_type):
-            raise ValidationError('Property "%s" is of wrong type. Expected %s, not %s.' % (
-                key, type(value).__name__, value_type.__name__))
-        if contained_type:
-            if len(x) == 0:
-                if not allow_empty:
-                    raise ValidationError('Property "%s" cannot be empty.' % key)
-            else:
-                i = 0
-                for item in value:
-                    if not isinstance(item, contained_type):
-                        raise ValidationError('Item %s[%d] is of wrong type. Expected %s, not %s.' % (
-                            key, i, contained_type.__name__, type(item).__name__
-                        ))
-                    i += 1
-                if regex:
-                    i = 0
-                    for item in value:
-                        if not regex.match(item):
-                            raise ValidationError('Item %s[%d] doesn\'t match regex "%s".' % (
-                                key, i, regex.pattern
-                            ))
-                        i += 1
-        elif regex:
+
+def _compile(schema):
+    """
+    Turn a schema (a dict using a tiny subset of JSON Schema vocabulary) into a
+    function(value, path, errors) that appends (path, msg) tuples to errors. All
+    regexes, property tables and sub-schemas are compiled here, once, so checking
+    a doc is just a walk over the data.
+    """
+    value_type = schema['type']
+    checks = []
+
+    regex = schema.get('regex')
+    if regex:
+        regex = re.compile(regex)
+
+        def check_regex(value, path, errors):
             if not regex.match(value):
-                raise ValidationError('Property "%s" doesn\'t match regex "%s".' % (
-                    key, regex.pattern
-                ))
+                errors.append((path, 'Doesn\'t match regex "%s".' % regex.pattern))
+        checks.append(check_regex)
+
+    props = schema.get('properties')
+    if props:
+        compiled_props = [(key, sub.get('required', False), _compile(sub)) for key, sub in props.items()]
+
+        def check_props(value, path, errors):
+            for key, required, check in compiled_props:
+                if key in value:
+                    check(value[key], path + '.' + key, errors)
+                elif required:
+                    errors.append((path + '.' + key, 'Missing required property.'))
+        checks.append(check_props)
+
+    one_of = schema.get('one_of')
+    if one_of:
+        def check_one_of(value, path, errors):
+            n = sum(1 for key in one_of if key in value)
+            if n != 1:
+                errors.append((path, 'Expected exactly one of %s, not %d.' % (', '.join(one_of), n)))
+        checks.append(check_one_of)
+
+    items = schema.get('items')
+    if items:
+        check_item = _compile(items)
+        allow_empty = schema.get('allow_empty', True)
+
+        def check_items(value, path, errors):
+            if not value and not allow_empty:
+                errors.append((path, 'Cannot be empty.'))
+            i = 0
+            for item in value:
+                check_item(item, '%s[%d]' % (path, i), errors)
+                i += 1
+        checks.append(check_items)
+
+    def check(value, path, errors):
+        if not isinstance(value, value_type):
+            errors.append((path, 'Expected %s, not %s.' % (_type_name(value_type), type(value).__name__)))
+            return
+        for c in checks:
+            c(value, path, errors)
+    return check
+
+
+_KEY_MATERIAL = ('publicKeyBase58', 'publicKeyHex', 'publicKeyPem', 'publicKeyJwk')
+
+_PUBLIC_KEY_SCHEMA = {
+    'type': dict,
+    'properties': {
+        'id': {'type': str, 'required': True},
+        'type': {'type': str, 'required': True},
+        'controller': {'type': str},
+        'publicKeyBase58': {'type': str, 'regex': r'^[1-9a-km-zA-HJ-NP-Z]+$'},
+        'publicKeyHex': {'type': str, 'regex': r'^[0-9a-fA-F]+$'},
+        'publicKeyPem': {'type': str},
+        'publicKeyJwk': {'type': dict},
+    },
+    'one_of': _KEY_MATERIAL,
+}
+
+_SERVICE_SCHEMA = {
+    'type': dict,
+    'properties': {
+        'id': {'type': str},
+        'type': {'type': str, 'required': True},
+        'serviceEndpoint': {'type': str, 'required': True},
+    }
+}
 
+_AUTHORIZATION_SCHEMA = {
+    'type': dict,
+    'properties': {
+        'profiles': {'type': list, 'items': {
+            'type': dict,
+            'properties': {
+                'key': {'type': str, 'required': True},
+                'roles': {'type': list, 'items': {'type': str}},
+            }
+        }},
+        'rules': {'type': list, 'items': {'type': dict, 'properties': {
+            'id': {'type': str},
+            'grant': {'type': list, 'items': {'type': str}, 'allow_empty': False, 'required': True},
+            'when': {'type': dict, 'required': True},
+        }}},
+    }
+}
 
-def validate(did_doc):
-    json_dict = None
+_DIDDOC_PROPERTIES = {
+    '@context': {'type': str, 'regex': r'^https://w3id.org/did/v1', 'required': True},
+    'id': {'type': str},
+    'publicKey': {'type': list, 'items': _PUBLIC_KEY_SCHEMA},
+    # Authentication entries are references to keys, or embedded keys.
+    'authentication': {'type': list, 'items': {'type': (str, dict)}},
+    'service': {'type': list, 'items': _SERVICE_SCHEMA},
+    'authorization': _AUTHORIZATION_SCHEMA,
+}
+
+_DIDDOC_SCHEMA = {'type': dict, 'properties': _DIDDOC_PROPERTIES}
+
+# Deltas carry fragments of a DID doc (see DIDDoc.apply_delta); nothing is required.
+_CHANGE_SCHEMA = {'type': dict, 'properties': {
+    'publicKey': _DIDDOC_PROPERTIES['publicKey'],
+    'authentication': _DIDDOC_PROPERTIES['authentication'],
+    'service': _DIDDOC_PROPERTIES['service'],
+    'authorization': _AUTHORIZATION_SCHEMA,
+    'rules': _AUTHORIZATION_SCHEMA['properties']['rules'],
+    'deleted': {'type': list, 'items': {'type': str}},
+}}
+
+
+def _parse_for_validation(did_doc):
+    if isinstance(did_doc, dict):
+        return did_doc
     if isinstance(did_doc, bytes):
-        json_text = did_doc.decode("utf-8")
-    elif isinstance(did_doc, str):
-        pass
-    elif isinstance(did_doc, dict):
-        json_dict = did_doc
-    else:
+        try:
+            did_doc = did_doc.decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise ValidationError('Not valid UTF-8: %s' % e)
+    elif not isinstance(did_doc, str):
         raise ValidationError('Bad datatype. Expected bytes, string, or JSON dict, not %s.' % did_doc.__class__.__name__)
-    if not json_dict:
-        json_dict = json.loads(did_doc)
-    _require(json_dict, '@context', str, regex=re.compile(r'https://w3id.org/did/v1'))
+    try:
+        return json.loads(did_doc)
+    except ValueError as e:
+        raise ValidationError('Not valid JSON: %s' % e)
+
+
+class Validator:
+    """
+    Checks JSON against a schema that is compiled once, up front. Reports every
+    problem it finds (with a path like .publicKey[1].id) instead of stopping at
+    the first one.
+    """
+    def __init__(self, schema):
+        self._check = _compile(schema)
+
+    def errors(self, json_dict) -> list:
+        """Return a list of (path, msg) tuples; empty if json_dict is valid."""
+        errors = []
+        self._check(json_dict, '', errors)
+        return errors
+
+    def validate(self, doc):
+        json_dict = _parse_for_validation(doc)
+        errors = self.errors(json_dict)
+        if errors:
+            raise ValidationError('\n'.join('%s: %s' % (path or '.', msg) for path, msg in errors), errors)
+        return json_dict
 
+    def validate_many(self, docs) -> list:
+        """
+        Validate a batch of docs. Returns a list parallel to docs, holding the
+        errors for each (an empty list means valid). Doesn't raise.
+        """
+        results = []
+        for doc in docs:
+            try:
+                results.append(self.errors(_parse_for_validation(doc)))
+            except ValidationError as e:
+                results.append([('', str(e))])
+        return results
 
-def _get_object_subset(set_a, set_b):
-    matched = []
-    i = 0
-    for a_item in set_a:
-        found = False
-        for b_item in set_b:
-            if b_item not in matched:
-                path = _get_path_where_jsonld_objects_differ(a_item, b_item, '')
-                if not path:
-                    matched.append(b_item)
-                    found = True
-                    break
-        if not found:
-            return i, None
-    return None, matched
-
-
-def _get_path_where_jsonld_sets_differ(a_value, b_value, path):
-    if not a_value:
-        if not b_value:
-            return None
-        return path
-    set_of_objects = bool(isinstance(a_value[0], dict))
-    if set_of_objects:
-        gap_idx, matches_in_b = _get_object_subset(a_value, b_value)
-        if gap_idx is not None:
-            return path + '[%d]' % gap_idx
-        # a_value is a subset of b. Prove that b is also a subset of a.
-        # Normally this should be trivial (make sure the lists are the same
-        # length) -- but it's possible for one list to contain the same item
-        # more than once. Since JSON-LD defines sequences as sets, not lists,
-        # comparison has to be a bit more careful.
-        if len(matches_in_b) < len(b_value):
-            remainder = [b_item for b_item in b_value if b_item not in matches_in_b]
-            gap_idx, matches_in_a = _get_object_subset(remainder, a_value)
-            if not matches_in_a:
-                return path
-        return None
-    else:
-        set_of_sets = bool(isinstance(a_value[0], list))
-        if set_of_sets:
-            raise NotImplemented
-        else:
-            if set(a_value) != set(b_value):
-                return path
 
+DIDDOC_VALIDATOR = Validator(_DIDDOC_SCHEMA)
+CHANGE_VALIDATOR = Validator(_CHANGE_SCHEMA)
 
-def _get_path_where_jsonld_objects_differ(a, b, path):
-    a_keys = set(a.keys())
-    b_keys = set(b.keys())
-    if a_keys != b_keys:
-        missing = {a for a in a_keys if a not in b_keys}
-        missing = missing.union({b for b in b_keys if b not in a_keys})
-        return path + '.{' + ','.join(missing) + '}'
+
+def validate(did_doc):
+    return DIDDOC_VALIDATOR.validate(did_doc)
+
+
+def validate_many(did_docs):
+    return DIDDOC_VALIDATOR.validate_many(did_docs)
+
+
+def validate_change(change):
+    """Validate the change fragment carried by a Delta (a dict, or a Delta itself)."""
+    if hasattr(change, 'change_json_dict'):
+        change = change.change_json_dict
+    return CHANGE_VALIDATOR.validate(change)
+
+
+def _canonical(value, cache):
+    """
+    Return a canonical text form of a JSON value. Key order is ignored, and lists
+    are treated as sets (as JSON-LD does), so two values are equal in the JSON-LD
+    sense exactly when their canonical forms are equal. Containers are memoized in
+    cache by id(), so each object in a doc is canonicalized only once per comparison.
+    """
+    if isinstance(value, dict):
+        key = id(value)
+        text = cache.get(key)
+        if text is None:
+            text = cache[key] = '{' + ','.join(
+                json.dumps(k) + ':' + _canonical(v, cache) for k, v in sorted(value.items())) + '}'
+        return text
+    if isinstance(value, list):
+        key = id(value)
+        text = cache.get(key)
+        if text is None:
+            text = cache[key] = '[' + ','.join(sorted({_canonical(v, cache) for v in value})) + ']'
+        return text
+    return json.dumps(value)
+
+
+def _diff_jsonld_sets(a_value, b_value, path, cache, diffs, first_only):
+    b_keys = {_canonical(item, cache) for item in b_value}
+    a_keys = set()
+    # Differences in sets of objects are reported by index; in sets of scalars,
+    # by the path to the set.
+    by_index = bool(a_value) and isinstance(a_value[0], dict)
+    i = 0
+    for item in a_value:
+        key = _canonical(item, cache)
+        a_keys.add(key)
+        if key not in b_keys:
+            diffs.append(path + '[%d]' % i if by_index else path)
+            if first_only or not by_index:
+                return
+        i += 1
+    # a_value is a subset of b_value. Since JSON-LD defines sequences as sets,
+    # not lists, b_value may still have extra items (duplicates don't count).
+    if not b_keys.issubset(a_keys):
+        diffs.append(path)
+
+
+def _diff_jsonld_objects(a, b, path, cache, diffs, first_only):
+    missing = a.keys() ^ b.keys()
+    if missing:
+        diffs.append(path + '.{' + ','.join(sorted(missing)) + '}')
+        if first_only:
+            return
     for key, a_value in a.items():
+        if key not in b:
+            continue
         subpath = path + '.' + key
+        b_value = b[key]
         a_type = type(a_value)
-        b_value = b.get(key)
         if type(b_value) != a_type:
-            return subpath
-        if a_type is list:
-            diff_path = _get_path_where_jsonld_sets_differ(a_value, b_value, subpath)
-            if diff_path:
-                return diff_path
+            diffs.append(subpath)
+        elif a_type is list:
+            if _canonical(a_value, cache) != _canonical(b_value, cache):
+                _diff_jsonld_sets(a_value, b_value, subpath, cache, diffs, first_only)
         elif a_type is dict:
-            diff_path = _get_path_where_jsonld_objects_differ(a_value, b_value)
-            if diff_path:
-                return diff_path
-        else:
-            if a_value != b_value:
-                return subpath
+            _diff_jsonld_objects(a_value, b_value, subpath, cache, diffs, first_only)
+        elif a_value != b_value:
+            diffs.append(subpath)
+        if first_only and diffs:
+            return
+
+
+def _get_path_where_jsonld_objects_differ(a, b, path):
+    diffs = []
+    _diff_jsonld_objects(a, b, path, {}, diffs, True)
+    return diffs[0] if diffs else None
 
 
 def as_dict(did_doc):
@@ -291,4 +432,129 @@ def as_dict(did_doc):
 def get_path_where_diddocs_differ(did_doc_1, did_doc_2):
     did_doc_1 = as_dict(did_doc_1)
     did_doc_2 = as_dict(did_doc_2)
-    return _get_path_where_jsonld_objects_differ(did_doc_1, did_doc_2, '')
\ No newline at end of file
+    return _get_path_where_jsonld_objects_differ(did_doc_1, did_doc_2, '')
+
+
+def get_paths_where_diddocs_differ(did_doc_1, did_doc_2) -> list:
+    """
+    Like get_path_where_diddocs_differ, but keep going after the first
+    difference and return the paths of all of them (empty list if equal).
+    """
+    did_doc_1 = as_dict(did_doc_1)
+    did_doc_2 = as_dict(did_doc_2)
+    diffs = []
+    _diff_jsonld_objects(did_doc_1, did_doc_2, '', {}, diffs, False)
+    return diffs
+
+
+# Each list that a delta can change: where it lives in a DID doc, where additions
+# to it live in a change fragment, and which property identifies its items (the
+# values named in a fragment's "deleted" list).
+_DELTA_LISTS = [
+    (('publicKey',), ('publicKey',), 'id'),
+    (('authentication',), ('authentication',), 'id'),
+    (('service',), ('service',), 'id'),
+    (('authorization', 'profiles'), ('authorization', 'profiles'), 'key'),
+    (('authorization', 'rules'), ('rules',), 'id'),
+]
+
+
+def _get_list(container, path, create=False):
+    for name in path[:-1]:
+        child = container.get(name)
+        if not isinstance(child, dict):
+            if not create:
+                return None
+            child = container[name] = {}
+        container = child
+    items = container.get(path[-1])
+    if items is None and create:
+        items = container[path[-1]] = []
+    return items
+
+
+def _item_id(item, id_field):
+    """Get the id of a list item, ignoring any '#' prefix (so "#key-1" refs match "key-1")."""
+    if isinstance(item, dict):
+        item = item.get(id_field)
+    if isinstance(item, str):
+        return item.lstrip('#')
+
+
+def _apply_change(json_dict, change):
+    # Deletions happen first, so a delta can replace an item by deleting its id
+    # and adding it back with new content.
+    deleted = {_item_id(x, None) for x in change.get('deleted', [])}
+    if deleted:
+        for doc_path, _, id_field in _DELTA_LISTS:
+            items = _get_list(json_dict, doc_path)
+            if items:
+                items[:] = [item for item in items if _item_id(item, id_field) not in deleted]
+    for doc_path, change_path, _ in _DELTA_LISTS:
+        added = _get_list(change, change_path)
+        if added:
+            _get_list(json_dict, doc_path, create=True).extend(added)
+
+
+def _without_delta_lists(json_dict):
+    """Shallow copy of a DID doc minus everything a delta can change (and minus "id")."""
+    rest = dict(json_dict)
+    rest.pop('id', None)
+    for doc_path, _, _ in _DELTA_LISTS:
+        if len(doc_path) == 1:
+            rest.pop(doc_path[0], None)
+        elif isinstance(rest.get(doc_path[0]), dict):
+            sub = rest[doc_path[0]] = dict(rest[doc_path[0]])
+            sub.pop(doc_path[1], None)
+            if not sub:
+                del rest[doc_path[0]]
+    return rest
+
+
+def get_change_between_diddocs(old_doc, new_doc) -> dict:
+    """
+    Compute a change fragment that, applied to old_doc by DIDDoc.apply_delta,
+    produces a doc that is equal to new_doc in the JSON-LD sense (lists are sets).
+    Items that changed are deleted by id and added back. Returns an empty dict if
+    the docs are already equal. Raises ValueError if the docs differ in a way a
+    delta can't express.
+    """
+    old_doc = as_dict(old_doc)
+    new_doc = as_dict(new_doc)
+    cache = {}
+    path = _get_path_where_jsonld_objects_differ(_without_delta_lists(old_doc), _without_delta_lists(new_doc), '')
+    if path:
+        raise ValueError("DID docs differ at %s, which a delta can't change." % path)
+    deleted = []
+    for doc_path, _, id_field in _DELTA_LISTS:
+        wanted = {_canonical(item, cache) for item in _get_list(new_doc, doc_path) or []}
+        for item in _get_list(old_doc, doc_path) or []:
+            if _canonical(item, cache) not in wanted:
+                item_id = _item_id(item, id_field)
+                if item_id is None:
+                    raise ValueError("Can't delete an item from %s that has no %s." % ('.'.join(doc_path), id_field))
+                if item_id not in deleted:
+                    deleted.append(item_id)
+    change = {}
+    result = old_doc
+    if deleted:
+        change['deleted'] = deleted
+        result = copy.deepcopy(old_doc)
+        _apply_change(result, change)
+    for doc_path, change_path, _ in _DELTA_LISTS:
+        have = {_canonical(item, cache) for item in _get_list(result, doc_path) or []}
+        for item in _get_list(new_doc, doc_path) or []:
+            key = _canonical(item, cache)
+            if key not in have:
+                have.add(key)
+                _get_list(change, change_path, create=True).append(item)
+    return change
+
+
+def get_delta_between_diddocs(old_doc, new_doc, by: list = None, when: str = None) -> Delta:
+    """
+    Wrap get_change_between_diddocs in a Delta. Returns None if there's nothing to change.
+    """
+    change = get_change_between_diddocs(old_doc, new_doc)
+    if change:
+        return Delta(change, by if by is not None else [], when)
@@ -1,8 +1,21 @@
 import base64
 import hashlib
+import json
 import os
+import time
 
-from .delta import Delta
+try:
+    import fcntl
+except ImportError:
+    # Windows: no advisory locks, so compact() relies on its stat check alone.
+    fcntl = None
+
+from . import metrics, tracing
+from .delta import Delta, compute_hashes
+
+
+DELTAS_EXT = '.diddocdeltas'
+ARCHIVE_EXT = '.archive'
 
 
 class FileMisuseError(IOError):
@@ -15,9 +28,26 @@ class File:
     Provides backing storage for a single peer DID.
     """
 
-    def __init__(self, path, autosave=True):
+    def __init__(self, path, autosave=True, hash_workers: int = None):
+        """
+        :param hash_workers: Threads for hashing the deltas on load (see
+          compute_hashes()). 1 hashes inline, which suits callers that are
+          already loading many files in parallel.
+        """
         self.path = os.path.normpath(path)
+        self.hash_workers = hash_workers
         self.deltas = []
+        # Hashes of every delta this DID has had: in the log, or archived by
+        # compact(). Checkpoint deltas that compact() wrote are also in
+        # _checkpoints, and aren't part of the DID's history.
+        self._hashes = set()
+        self._checkpoints = set()
+        # How many of self.deltas are on disk. Deltas are only ever appended,
+        # so save() just appends the rest.
+        self._saved = 0
+        # (inode, size, mtime) of the file when it last matched self.deltas,
+        # or None if someone else may have written it since.
+        self._stat = None
         self.dirty = False
         self.autosave = autosave
         self._did = None
@@ -27,28 +57,171 @@ class File:
     def load(self, ignore_dirty=False):
         if (not ignore_dirty) and self.dirty:
             raise FileMisuseError("Can't load while in the dirty state.")
-        self.deltas = []
-        with open(self.path, 'rt') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('{') and line.endswith('}'):
-                    self.deltas.append(Delta.from_json(line))
+        r = metrics.registry
+        if r is not None:
+            start = time.perf_counter()
+        with tracing.tracer.start_as_current_span('File.load', {'peerdid.path': self.path}) as span:
+            # Stat first: a write after it makes the stat look stale, not current.
+            self._stat = _stat_key(os.stat(self.path))
+            self.deltas = _read_deltas(self.path)
+            archived, self._checkpoints = _read_archive(self.archive_path)
+            with tracing.tracer.start_as_current_span('File.hash'):
+                self.compute_hashes(max_workers=self.hash_workers)
+                compute_hashes(archived, max_workers=self.hash_workers)
+                # Read _hash directly: bookkeeping isn't a cache hit.
+                self._hashes = {d._hash for d in self.deltas}
+                self._hashes.update(d._hash for d in archived)
+            span.set_attribute('peerdid.deltas', len(self.deltas))
+        self._saved = len(self.deltas)
         self.dirty = False
+        if r is not None:
+            r.observe('file_load', time.perf_counter() - start)
+            r.inc('file_load_bytes', os.path.getsize(self.path))
+            r.inc('file_load_deltas', len(self.deltas))
 
-    def save(self):
+    def save(self, fsync: bool = False):
+        """
+        Write the deltas out if anything changed. If the file already holds
+        the earlier ones, only the new deltas are appended. With fsync, the
+        write is flushed to disk before save() returns, so it survives a
+        crash. A crash mid-write leaves the old content: a new file is written
+        to a temp file and renamed into place, and a torn append is an
+        unfinished last line, which load() ignores.
+        """
         if self.dirty:
-            with open(self.path, 'wt') as f:
-                for d in self.deltas:
-                    f.write(d.to_json() + '\n')
+            r = metrics.registry
+            if r is not None:
+                start = time.perf_counter()
+            if self._saved and os.path.exists(self.path):
+                n, self._stat = _append_lines(self.path, _to_lines(self.deltas[self._saved:]), fsync, self._stat)
+            elif fsync:
+                data = _to_lines(self.deltas)
+                self._stat = _replace_contents(self.path, data)
+                n = len(data)
+            else:
+                with open(self.path, 'wt') as f:
+                    for d in self.deltas:
+                        f.write(d.to_json() + '\n')
+                    n = f.tell()
+                    f.flush()
+                    self._stat = _stat_key(os.fstat(f.fileno()))
+            self._saved = len(self.deltas)
             self.dirty = False
+            if r is not None:
+                r.observe('file_save', time.perf_counter() - start)
+                r.inc('file_save_bytes', n)
 
-    def append(self, delta: Delta, autosave: bool = None):
+    def append(self, delta: Delta, autosave: bool = None) -> bool:
+        """
+        Add a delta, unless one with the same hash is already present. Returns
+        True if the delta was new.
+        """
+        if delta.hash in self._hashes:
+            return False
+        self._hashes.add(delta.hash)
         self.deltas.append(delta)
         self.dirty = True
         if autosave is None:
             autosave = self.autosave
         if autosave:
             self.save()
+        return True
+
+    def extend(self, deltas, autosave: bool = None) -> int:
+        """
+        Append many deltas (skipping ones already present), saving at most once.
+        Returns how many were new.
+        """
+        n = 0
+        for delta in deltas:
+            if self.append(delta, autosave=False):
+                n += 1
+        if autosave is None:
+            autosave = self.autosave
+        if autosave:
+            self.save()
+        return n
+
+    def contains(self, hash: bytes) -> bool:
+        """Tell whether a delta with this (raw, unencoded) hash is present."""
+        return hash in self._hashes
+
+    def compute_hashes(self, executor=None, max_workers: int = None):
+        """Hash every delta now (in parallel for big logs), so later .hash/.snapshot calls are cheap."""
+        compute_hashes(self.deltas, executor, max_workers)
+
+    @property
+    def archive_path(self) -> str:
+        """Where compact() keeps the deltas it removes from the log."""
+        return self.path + ARCHIVE_EXT
+
+    def archived_deltas(self) -> list:
+        """Every delta that compaction has removed from the log, oldest first."""
+        return _read_archive(self.archive_path)[0]
+
+    def compact(self) -> bool:
+        """
+        Rewrite the log as the genesis delta plus (at most) one checkpoint delta
+        that has the same effect as all the others. The DID doesn't change, and
+        neither does the resolved doc, but resolving as_of a time before the last
+        delta no longer sees intermediate states. The removed deltas are appended
+        to an archive segment first, so full history survives, and the log itself
+        is replaced atomically. The file still knows the archived deltas, so
+        append() won't reapply one, and .snapshot is unchanged. Other File
+        objects for the same path go stale. Returns False if there was nothing
+        to compact; raises ValueError if a delta to be removed is signed, since
+        its signatures wouldn't cover the checkpoint.
+
+        The log is locked (save() takes the same lock to append) and reloaded
+        first if anyone else wrote it since this File last did, so a delta
+        appended by another File or process is compacted, not lost.
+        """
+        if self.dirty:
+            raise FileMisuseError("Can't compact while in the dirty state.")
+        if not os.path.exists(self.path):
+            return False
+        with _locked(self.path, 'rb') as lock:
+            if _stat_key(os.fstat(lock.fileno())) != self._stat:
+                self.load()
+            return self._compact()
+
+    def _compact(self) -> bool:
+        if len(self.deltas) < 3:
+            return False
+        removed = self.deltas[1:]
+        if any(d.by for d in removed):
+            raise ValueError("Can't compact signed deltas.")
+        # diddoc imports this module, so import lazily.
+        from .diddoc import get_change_between_diddocs, _apply_change
+        genesis = self.deltas[0]
+        doc = genesis.change_json_dict
+        for d in removed:
+            _apply_change(doc, d.change_json_dict)
+        change = get_change_between_diddocs(genesis.change_json_dict, doc)
+        compacted = [genesis]
+        if change:
+            compacted.append(Delta(change, [], self.deltas[-1].when, canonical=True))
+        # An earlier compaction may have archived some of these before a crash
+        # kept it from replacing the log. Earlier checkpoints aren't history.
+        archived = self.archived_deltas()
+        compute_hashes(archived, max_workers=self.hash_workers)
+        archived = {d._hash for d in archived}
+        lines = _to_lines(d for d in removed if d._hash not in archived and d._hash not in self._checkpoints)
+        # (A checkpoint that happens to match a real delta is just that delta.)
+        compute_hashes(compacted, max_workers=1)
+        checkpoints = {d._hash for d in compacted[1:]} - self._hashes
+        for hash in checkpoints:
+            lines += _checkpoint_line(hash)
+        with open(self.archive_path, 'ab') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._stat = _replace_contents(self.path, _to_lines(compacted))
+        self.deltas = compacted
+        self._saved = len(compacted)
+        self._hashes.update(checkpoints)
+        self._checkpoints.update(checkpoints)
+        return True
 
     @property
     def genesis(self) -> Delta:
@@ -65,7 +238,8 @@ class File:
 
     @property
     def snapshot(self) -> str:
-        hashes = [d.hash for d in self.deltas]
+        # Over the whole history, so compacting doesn't change it.
+        hashes = list(self._hashes - self._checkpoints)
         hashes.sort()
         hasher = hashlib.sha256()
         for hash in hashes:
@@ -77,4 +251,126 @@ class File:
 def canonical_fname(did_or_hash):
     if did_or_hash.startswith('did:peer:1z'):
         did_or_hash = did_or_hash[11:]
-    return did_or_hash + ".diddocdeltas"
\ No newline at end of file
+    return did_or_hash + DELTAS_EXT
+
+
+def _read_deltas(path):
+    # Read, then parse, so traces can tell slow disks from slow JSON.
+    with tracing.tracer.start_as_current_span('File.read') as span:
+        with open(path, 'rt') as f:
+            text = f.read()
+        span.set_attribute('peerdid.chars', len(text))
+    with tracing.tracer.start_as_current_span('File.parse'):
+        deltas = []
+        lines = text.splitlines()
+        # Every line save() writes ends with a newline. One that doesn't may be
+        # the torn end of an interrupted append.
+        torn = lines.pop() if lines and not text.endswith('\n') else None
+        for line in lines:
+            line = line.strip()
+            if line.startswith('{') and line.endswith('}'):
+                deltas.append(Delta.from_json(line))
+        delta = _parse_tail(torn) if torn else None
+        if delta is not None:
+            deltas.append(delta)
+    return deltas
+
+
+def _parse_tail(line):
+    """Parse a last line that has no newline after it. Returns None if it's torn."""
+    line = line.strip()
+    if line.startswith('{') and line.endswith('}'):
+        try:
+            return Delta.from_json(line)
+        except ValueError:
+            pass
+
+
+def _read_archive(path):
+    """Return the deltas in an archive segment, and the hashes of the checkpoints that replaced them."""
+    deltas = []
+    checkpoints = set()
+    if os.path.exists(path):
+        with open(path, 'rt') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('{"checkpoint"'):
+                    checkpoints.add(base64.urlsafe_b64decode(json.loads(line)['checkpoint']))
+                elif line.startswith('{') and line.endswith('}'):
+                    deltas.append(Delta.from_json(line))
+    return deltas, checkpoints
+
+
+def _checkpoint_line(hash: bytes) -> bytes:
+    return (json.dumps({'checkpoint': base64.urlsafe_b64encode(hash).decode('ascii')}) + '\n').encode('utf-8')
+
+
+def _to_lines(deltas) -> bytes:
+    return ''.join(d.to_json() + '\n' for d in deltas).encode('utf-8')
+
+
+def _stat_key(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _locked(path, mode):
+    """
+    Open path with an exclusive lock on it. If compact() replaced the file
+    while we waited, the lock is on the old one, so open the new one instead.
+    """
+    while True:
+        f = open(path, mode)
+        if fcntl is None:
+            return f
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def _append_lines(path, data: bytes, fsync: bool, expected=None):
+    """
+    Append lines to path, first cutting off a torn last line if there is one.
+    Returns how many bytes were written, and the file's stat key afterward,
+    or None if it didn't match expected before (someone else wrote it).
+    """
+    with _locked(path, 'r+b') as f:
+        before = _stat_key(os.fstat(f.fileno()))
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                f.seek(0)
+                text = f.read()
+                start = text.rfind(b'\n') + 1
+                if _parse_tail(text[start:].decode('utf-8', 'replace')) is None:
+                    f.truncate(start)
+                else:
+                    # Whole, just unterminated (not written by save()).
+                    data = b'\n' + data
+                f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+        after = _stat_key(os.fstat(f.fileno())) if before == expected else None
+    return len(data), after
+
+
+def _replace_contents(path, data: bytes):
+    """
+    Write to a temp file, then rename it over path, so a crash leaves either
+    the old content or the new, never a mixture. Returns the new file's stat key.
+    """
+    folder, fname = os.path.split(path)
+    temp = os.path.join(folder, '.' + fname + '.tmp')
+    with open(temp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        st = os.fstat(f.fileno())
+    os.replace(temp, path)
+    return _stat_key(st)
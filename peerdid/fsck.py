@@ -0,0 +1,150 @@
+"""
+Integrity checks for a Repo: each deltas file must be named after its genesis
+delta, every line must parse, no delta may appear twice, and the doc must
+resolve. Files are checked in batches across a process pool, and problems are
+streamed back as they're found. Some problems can be repaired in place.
+"""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import os
+
+from .delta import Delta
+from .diddoc import DIDDoc
+from .file import File, canonical_fname, _replace_contents
+from .repo import Repo, _bounded_map
+
+
+Problem = collections.namedtuple('Problem', 'path kind detail repaired')
+
+# Kinds of problems.
+EMPTY = 'empty'
+BAD_LINE = 'bad-line'
+TORN_TAIL = 'torn-tail'
+DUPLICATE = 'duplicate'
+MISNAMED = 'misnamed'
+UNRESOLVABLE = 'unresolvable'
+
+
+def _parse_line(line):
+    delta = Delta.from_json(line)
+    delta.hash
+    return delta
+
+
+def check_file(path: str, repair: bool = False) -> list:
+    """
+    Check one deltas file and return a list of Problems. If repair is true,
+    duplicate deltas are dropped, a torn last line is truncated, and a misnamed
+    file is renamed (unless that would overwrite another file).
+    """
+    problems = []
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    keep = []
+    deltas = []
+    seen = set()
+    rewrite = False
+    last = len(lines) - 1
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            delta = _parse_line(line)
+        except Exception as e:
+            # File.save ends every line with a newline, so an unparseable
+            # last line without one is the remains of an interrupted write.
+            if i == last:
+                problems.append(Problem(path, TORN_TAIL, 'line %d: %s' % (i + 1, e), repair))
+                rewrite = True
+            else:
+                problems.append(Problem(path, BAD_LINE, 'line %d: %s' % (i + 1, e), False))
+                keep.append(line)
+            continue
+        if delta.hash in seen:
+            problems.append(Problem(path, DUPLICATE, 'line %d: %s' % (i + 1, delta.encnumbasis), repair))
+            rewrite = True
+            continue
+        seen.add(delta.hash)
+        deltas.append(delta)
+        keep.append(line)
+    if repair and rewrite:
+        _replace_contents(path, b''.join(line + b'\n' for line in keep))
+
+    if not deltas:
+        problems.append(Problem(path, EMPTY, 'no genesis delta', False))
+        return problems
+
+    try:
+        # Resolve what parsed, without reading the file again: nothing is at
+        # this path, so the File starts out empty.
+        f = File(path + '.fsck', autosave=False)
+        f.extend(deltas)
+        DIDDoc(f).resolve()
+    except Exception as e:
+        problems.append(Problem(path, UNRESOLVABLE, str(e), False))
+
+    folder, fname = os.path.split(path)
+    expected = canonical_fname(deltas[0].encnumbasis)
+    if fname != expected:
+        target = os.path.join(folder, expected)
+        repaired = False
+        if repair:
+            # link() fails if target exists, so of two misnamed copies of one
+            # DID (perhaps in different workers), only the first moves.
+            try:
+                os.link(path, target)
+                os.unlink(path)
+                repaired = True
+            except FileExistsError:
+                pass
+        problems.append(Problem(path, MISNAMED, 'should be ' + expected, repaired))
+    return problems
+
+
+def _check_batch(paths, repair):
+    problems = []
+    for path in paths:
+        problems.extend(check_file(path, repair))
+    return problems
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fsck(repo: Repo, repair: bool = False, max_workers: int = None, batch_size: int = 256):
+    """
+    Check every file in repo, yielding Problems as they're found. With
+    max_workers=1, everything runs in the current process.
+    """
+    batches = _batches(repo.iter_paths(), batch_size)
+    if max_workers == 1:
+        for batch in batches:
+            yield from _check_batch(batch, repair)
+        return
+    check = functools.partial(_check_batch, repair=repair)
+    with ProcessPoolExecutor(max_workers) as pool:
+        window = 4 * (max_workers or os.cpu_count() or 1)
+        for problems in _bounded_map(pool, check, batches, window):
+            yield from problems
+
+
+def main(args) -> int:
+    problems = 0
+    unrepaired = 0
+    for p in fsck(Repo(args.repo), args.repair, args.workers):
+        problems += 1
+        if not p.repaired:
+            unrepaired += 1
+        print('%s: %s: %s%s' % (p.path, p.kind, p.detail, ' (repaired)' if p.repaired else ''), flush=True)
+    print('%d problem(s), %d unrepaired.' % (problems, unrepaired))
+    return 1 if unrepaired else 0
@@ -0,0 +1,335 @@
+"""
+The write path from the sync layer into a Repo. An Ingester takes messages
+from a Channel and decodes and validates them in a worker pool. It groups the
+deltas by DID and commits each group to its file with one durable write.
+
+A message is JSON that names a DID and carries one delta or several:
+
+    {"did": "did:peer:1z...", "deltas": [{"change": ..., "by": ..., "when": ...}, ...]}
+
+(encode_message() builds one, optionally compressed; see peerdid.compression.)
+Deltas for a DID the repo doesn't know yet wait until the DID's genesis delta
+has been committed; their messages are retried then (see Ingester.run).
+
+    ingester = Ingester(repo, Channel(folder, is_destward=False))
+    asyncio.run(ingester.run(idle_timeout=5))
+    print(ingester.stats)
+"""
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+
+from . import compression, metrics, tracing, is_valid_peer_did, is_reserved_peer_did
+from .delta import Delta
+from .diddoc import ValidationError, validate, validate_change
+from .file import File, canonical_fname
+
+
+def encode_message(did: str, deltas, compress: bool = False) -> bytes:
+    """Build a message that carries deltas (a Delta or a list of them) for did."""
+    if isinstance(deltas, Delta):
+        deltas = [deltas]
+    data = json.dumps({'did': did, 'deltas': [d.to_dict() for d in deltas]}).encode('utf-8')
+    return compression.compress(data) if compress else data
+
+
+class Ingester:
+    """
+    Runs the pipeline: take a batch from the channel, decode and validate it in
+    the executor, and meanwhile commit earlier batches in order. Messages are
+    claimed (see Channel.claim_many) and only acknowledged once their deltas
+    are on disk, so a crash means redelivery, which File.extend shrugs off as
+    duplicates. Run one Ingester per repo: commits for a DID aren't locked
+    against other writers.
+
+    Messages for a DID whose genesis delta hasn't been committed yet are set
+    aside, still claimed, and put back in the channel once a new DID has been
+    committed (or when run() returns), so they're retried. Channels that
+    can't claim (no claim_many()) can't put messages back, so such messages
+    are rejected instead.
+    """
+    def __init__(self, repo, channel, workers: int = None, executor=None, batch_size: int = 256,
+                 max_pending: int = 4, check: bool = True, fsync: bool = True, poll_interval: float = 0.05,
+                 on_reject=None, compress: bool = False, max_open_files: int = 1024):
+        """
+        :param workers: Threads for committing, and for decoding if no executor
+          is given.
+        :param executor: Where messages are decoded and validated. A
+          ProcessPoolExecutor works too, and scales past the GIL.
+        :param batch_size: Most message files taken from the channel at once.
+        :param max_pending: Most batches being decoded while commits are still
+          in progress. When commits fall behind, the pipeline stops taking
+          messages from the channel, so memory stays bounded.
+        :param check: Validate each delta (genesis deltas as DID docs, others
+          as changes) before committing it.
+        :param fsync: Make each commit durable before acknowledging its messages.
+        :param on_reject: Called with a reason (str) for each rejected message.
+        :param compress: Store changes compressed (see Delta.compress).
+        :param max_open_files: Most Files kept loaded between commits, so a
+          commit only appends to its file instead of reading it again.
+        """
+        self.repo = repo
+        self.channel = channel
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.check = check
+        self.fsync = fsync
+        self.poll_interval = poll_interval
+        self.on_reject = on_reject
+        self.compress = compress
+        self._own_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(workers)
+        self._commit_pool = ThreadPoolExecutor(workers)
+        self._stopped = False
+        self.max_open_files = max_open_files
+        # Path -> (File, its size when we last wrote it), most recently used last.
+        self._files = collections.OrderedDict()
+        self._files_lock = threading.Lock()
+        # How many DIDs this ingester has created, and claims set aside (with
+        # that count at the time) until the genesis they wait for arrives.
+        self._created = 0
+        self._deferred = []
+        # Batches taken from the channel but not yet committed; run() makes
+        # _progress an Event that's set as each is done.
+        self._in_flight = 0
+        self._progress = None
+        self.stats = {'messages': 0, 'deltas': 0, 'new_deltas': 0, 'rejected': 0, 'waiting': 0, 'commits': 0,
+                      'seconds': 0.0}
+
+    def stop(self):
+        """Make run() return once what it has taken from the channel is committed."""
+        self._stopped = True
+
+    def close(self):
+        self._commit_pool.shutdown()
+        if self._own_executor:
+            self.executor.shutdown()
+
+    async def run(self, idle_timeout: float = None):
+        """
+        Ingest until stop() is called or, if idle_timeout is given, until the
+        channel has been empty for that many seconds (0 = drain what's waiting
+        and return). Returns self.stats. Messages still waiting for a genesis
+        delta go back in the channel.
+        """
+        os.makedirs(self.repo.path, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.max_pending)
+        self._progress = asyncio.Event()
+        start = time.perf_counter()
+        committer = asyncio.ensure_future(self._commit_batches(queue))
+        try:
+            idle_since = time.monotonic()
+            while not self._stopped and not committer.done():
+                self._retry_deferred()
+                claims, owners, payloads = await self._take()
+                if not payloads:
+                    if self._in_flight:
+                        # What's being committed may let deferred messages
+                        # through, so look again as soon as a batch is done.
+                        idle_since = time.monotonic()
+                        self._progress.clear()
+                        try:
+                            await asyncio.wait_for(self._progress.wait(), self.poll_interval)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                idle_since = time.monotonic()
+                decoding = loop.run_in_executor(self.executor, _decode, payloads, self.check)
+                self._in_flight += 1
+                # Blocks when max_pending batches are already waiting: backpressure.
+                await queue.put((claims, owners, len(payloads), decoding))
+        finally:
+            if not committer.done():
+                await queue.put(None)
+            try:
+                # Re-raises if committing failed.
+                await committer
+            finally:
+                self._retry_deferred(everything=True)
+                self.stats['seconds'] += time.perf_counter() - start
+        return self.stats
+
+    def _retry_deferred(self, everything: bool = False):
+        """Put back deferred messages that a DID created since may let through (or all of them)."""
+        keep = []
+        for claim, created in self._deferred:
+            if everything or created != self._created:
+                claim.release()
+            else:
+                keep.append((claim, created))
+        self._deferred = keep
+
+    async def _take(self):
+        """
+        Take a batch of messages. Also return the claims to ack once they're
+        committed, and the claim each message came from.
+        """
+        if hasattr(self.channel, 'claim_many'):
+            claims = await self.channel.claim_many(self.batch_size)
+            owners = [claim for claim in claims for m in claim.messages]
+            return claims, owners, [m for claim in claims for m in claim.messages]
+        payloads = await self.channel.receive_many(self.batch_size)
+        return [], [None] * len(payloads), payloads
+
+    async def _commit_batches(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            claims, owners, count, decoding = item
+            groups, sources, rejects = await decoding
+            with tracing.tracer.start_as_current_span('Ingester.commit', {'peerdid.messages': count}) as span:
+                commit_start = time.perf_counter()
+                results = await loop.run_in_executor(None, self._commit, groups)
+                new = sum(new for new, waiting in results)
+                span.set_attributes({'peerdid.dids': len(groups), 'peerdid.new_deltas': new})
+            held = set()
+            waiting = 0
+            for did, (n, is_waiting) in zip(groups, results):
+                if is_waiting:
+                    waiting += len(groups[did])
+                    held.update(owners[i] for i in sources[did])
+            if None in held:
+                # Can't put these back in the channel.
+                rejects.append('%d deltas for DIDs with no genesis delta yet' % waiting)
+                waiting = 0
+            # Only now is it safe to let the messages go.
+            for claim in claims:
+                if claim in held:
+                    self._deferred.append((claim, self._created))
+                else:
+                    claim.ack()
+            self._in_flight -= 1
+            self._progress.set()
+            deltas = sum(len(deltas) for deltas in groups.values())
+            self.stats['messages'] += count
+            self.stats['deltas'] += deltas
+            self.stats['new_deltas'] += new
+            self.stats['rejected'] += len(rejects)
+            self.stats['waiting'] += waiting
+            self.stats['commits'] += len(groups) - len([w for n, w in results if w])
+            r = metrics.registry
+            if r is not None:
+                r.observe('ingest_commit', time.perf_counter() - commit_start)
+                r.inc('ingest_messages', count)
+                r.inc('ingest_deltas', deltas)
+                r.inc('ingest_new_deltas', new)
+                r.inc('ingest_rejected', len(rejects))
+            if self.on_reject:
+                for reason in rejects:
+                    self.on_reject(reason)
+
+    def _commit(self, groups):
+        """
+        Commit each DID's deltas in parallel (they're separate files). Returns
+        [(new deltas, whether the DID is still waiting for its genesis)].
+        """
+        return list(self._commit_pool.map(lambda item: self._commit_group(*item), groups.items()))
+
+    def _commit_group(self, did, deltas):
+        path = os.path.join(self.repo.path, canonical_fname(did))
+        f = self._open(path)
+        if f is None:
+            # A new DID: its genesis delta goes first.
+            basis = did[11:]
+            genesis = [d for d in deltas if d.encnumbasis == basis]
+            if not genesis:
+                return 0, True
+            f = File(path, autosave=False, hash_workers=1)
+            deltas = genesis + deltas
+            with self._files_lock:
+                self._created += 1
+        if self.compress:
+            deltas = [d.compress() for d in deltas]
+        new = f.extend(deltas, autosave=False)
+        # Appends just the new deltas.
+        f.save(fsync=self.fsync)
+        self._keep(path, f)
+        return new, False
+
+    def _open(self, path):
+        """Return the File at path (None if there isn't one), reusing the loaded one if nobody else has written it."""
+        with self._files_lock:
+            f, size = self._files.pop(path, (None, None))
+        try:
+            current = os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+        if f is None or current != size:
+            f = File(path, autosave=False, hash_workers=1)
+        return f
+
+    def _keep(self, path, f):
+        size = os.path.getsize(path)
+        with self._files_lock:
+            self._files[path] = (f, size)
+            while len(self._files) > self.max_open_files:
+                self._files.popitem(last=False)
+
+
+def _check_shape(msg):
+    """
+    Make sure a decoded message has the fields and types _decode() expects,
+    raising ValueError if not. Returns the DID and the list of delta dicts.
+    """
+    if not isinstance(msg, dict):
+        raise ValueError('message is not an object')
+    did = msg.get('did')
+    if not isinstance(did, str):
+        raise ValueError('did must be a string')
+    items = msg['deltas'] if 'deltas' in msg else [msg.get('delta')]
+    if not isinstance(items, list):
+        raise ValueError('deltas must be a list')
+    for d in items:
+        if not isinstance(d, dict):
+            raise ValueError('each delta must be an object')
+        if not isinstance(d.get('change'), (str, dict)):
+            raise ValueError('delta change must be a string or object')
+        if not isinstance(d.get('by'), (list, type(None))):
+            raise ValueError('delta by must be a list')
+        if not isinstance(d.get('when'), (str, type(None))):
+            raise ValueError('delta when must be a string')
+    return did, items
+
+
+def _decode(payloads, check):
+    """
+    Decode and validate messages (in a worker). Returns a dict of DID -> deltas,
+    in arrival order, a dict of DID -> indexes of the payloads they came from,
+    and a list of reasons for rejected messages.
+    """
+    groups = {}
+    sources = {}
+    rejects = []
+    for i, payload in enumerate(payloads):
+        try:
+            msg = json.loads(compression.decompress(payload))
+            did, items = _check_shape(msg)
+            if not is_valid_peer_did(did) or is_reserved_peer_did(did):
+                raise ValueError('not a storable peer DID: %r' % did)
+            deltas = [Delta.from_dict(d) for d in items]
+            basis = did[11:]
+            for d in deltas:
+                # Hashing here keeps it off the commit path.
+                if d.encnumbasis == basis:
+                    if check:
+                        validate(d.change_json_dict)
+                elif check:
+                    validate_change(d)
+        except (ValueError, KeyError, TypeError, ValidationError) as e:
+            rejects.append('%s: %s' % (type(e).__name__, e))
+            continue
+        groups.setdefault(did, []).extend(deltas)
+        sources.setdefault(did, []).append(i)
+    return groups, sources, rejects
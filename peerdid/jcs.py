@@ -0,0 +1,94 @@
+"""
+JSON Canonicalization Scheme (RFC 8785). Serializes JSON with sorted keys, no
+insignificant whitespace, and ECMAScript number formatting, so that any two
+semantically identical JSON values produce identical bytes (and hashes).
+
+Note that JCS deliberately does not apply Unicode normalization to strings;
+neither do we.
+"""
+
+import json
+import math
+
+# C-accelerated in CPython; escapes only ", \ and control chars, as JCS requires.
+_encode_str = json.encoder.encode_basestring
+
+
+def _utf16_key(key):
+    # JCS sorts property names by their UTF-16 code units, which differs from
+    # Python's code point order for characters outside the BMP.
+    return key.encode('utf-16-be')
+
+
+def _encode_number(value):
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError("JCS can't represent %r." % value)
+    if value == 0:
+        return '0'
+    # repr() gives the shortest digit string that round-trips, which is also
+    # what ECMAScript uses. We only need to reposition the decimal point.
+    mantissa, _, exp = repr(abs(value)).partition('e')
+    int_part, _, frac = mantissa.partition('.')
+    digits = int_part + frac
+    n = int(exp or 0) + len(int_part)
+    stripped = digits.lstrip('0')
+    n -= len(digits) - len(stripped)
+    digits = stripped.rstrip('0')
+    k = len(digits)
+    sign = '-' if value < 0 else ''
+    if k <= n <= 21:
+        return sign + digits + '0' * (n - k)
+    if 0 < n <= 21:
+        return sign + digits[:n] + '.' + digits[n:]
+    if -6 < n <= 0:
+        return sign + '0.' + '0' * -n + digits
+    e = n - 1
+    mantissa = digits[0] + ('.' + digits[1:] if k > 1 else '')
+    return sign + mantissa + 'e' + ('+' if e > 0 else '-') + str(abs(e))
+
+
+def _encode(value, parts):
+    if isinstance(value, str):
+        parts.append(_encode_str(value))
+    elif value is None:
+        parts.append('null')
+    elif value is True:
+        parts.append('true')
+    elif value is False:
+        parts.append('false')
+    elif isinstance(value, (int, float)):
+        parts.append(_encode_number(value))
+    elif isinstance(value, dict):
+        parts.append('{')
+        first = True
+        for key in sorted(value, key=_utf16_key):
+            if not first:
+                parts.append(',')
+            first = False
+            parts.append(_encode_str(key))
+            parts.append(':')
+            _encode(value[key], parts)
+        parts.append('}')
+    elif isinstance(value, (list, tuple)):
+        parts.append('[')
+        first = True
+        for item in value:
+            if not first:
+                parts.append(',')
+            first = False
+            _encode(item, parts)
+        parts.append(']')
+    else:
+        raise TypeError('Object of type %s is not JSON serializable.' % type(value).__name__)
+
+
+def canonicalize(value) -> bytes:
+    """
+    Return the canonical UTF-8 bytes for a JSON value (dict, list, str, number,
+    bool or None).
+    """
+    parts = []
+    _encode(value, parts)
+    return ''.join(parts).encode('utf-8')
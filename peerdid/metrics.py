@@ -0,0 +1,130 @@
+"""
+Optional instrumentation for peerdid's hot paths. Nothing is recorded until
+enable() is called; until then, each instrumentation point costs one module
+attribute lookup and a comparison with None.
+
+    from peerdid import metrics
+    registry = metrics.enable()
+    ...
+    registry.write_prometheus('/var/lib/node_exporter/peerdid.prom')
+"""
+
+import http.server
+import os
+import threading
+
+
+class Registry:
+    """
+    Thread-safe counters and latency summaries. Names are short snake_case
+    strings like "file_load"; exported names get a "peerdid_" prefix.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        # name -> [count, total seconds, max seconds]
+        self._timings = {}
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            t = self._timings.get(name)
+            if t is None:
+                self._timings[name] = [1, seconds, seconds]
+            else:
+                t[0] += 1
+                t[1] += seconds
+                if seconds > t[2]:
+                    t[2] = seconds
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def timing(self, name: str):
+        """Return (count, total seconds, max seconds) for name."""
+        with self._lock:
+            return tuple(self._timings.get(name, (0, 0.0, 0.0)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timings': {name: {'count': t[0], 'seconds': t[1], 'max_seconds': t[2]}
+                            for name, t in self._timings.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+    def to_prometheus(self) -> str:
+        """Render everything in the Prometheus text exposition format."""
+        lines = []
+        snap = self.snapshot()
+        for name, value in sorted(snap['counters'].items()):
+            metric = 'peerdid_%s_total' % name
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %r' % (metric, value))
+        for name, t in sorted(snap['timings'].items()):
+            metric = 'peerdid_%s_seconds' % name
+            lines.append('# TYPE %s summary' % metric)
+            lines.append('%s_count %d' % (metric, t['count']))
+            lines.append('%s_sum %r' % (metric, t['seconds']))
+            lines.append('# TYPE %s_max gauge' % metric)
+            lines.append('%s_max %r' % (metric, t['max_seconds']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Write a .prom file for node_exporter's textfile collector (atomically)."""
+        temp = path + '.tmp'
+        with open(temp, 'wt') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp, path)
+
+    def serve(self, host: str = '127.0.0.1', port: int = 0):
+        """
+        Serve to_prometheus() at /metrics from a daemon thread. Returns the
+        server; its server_address tells which port was bound, and shutdown()
+        stops it.
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# The active registry, or None when instrumentation is disabled. Hot paths
+# read this directly.
+registry = None
+
+
+def enable(r: Registry = None) -> Registry:
+    global registry
+    registry = r if r is not None else Registry()
+    return registry
+
+
+def disable():
+    global registry
+    registry = None
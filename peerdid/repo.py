@@ -1,8 +1,12 @@
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
 import os
+import threading
 
+from . import metrics, tracing
 from .diddoc import DIDDoc, get_predefined
 from .delta import Delta
-from .file import File, canonical_fname
+from .file import File, canonical_fname, DELTAS_EXT
 from . import is_valid_peer_did, is_reserved_peer_did
 
 
@@ -39,19 +43,97 @@ class Repo:
             if is_reserved_peer_did(did):
                 return get_predefined(did[13])
             path = os.path.join(self.path, canonical_fname(did))
-            if os.path.isfile(path):
+            found = os.path.isfile(path)
+            r = metrics.registry
+            if r is not None:
+                r.inc('repo_lookup_hit' if found else 'repo_lookup_miss')
+            if found:
                 return DIDDoc(path)
 
     def resolve(self, did, as_of_time=None):
+        with tracing.tracer.start_as_current_span('Repo.resolve', {'peerdid.did': str(did)}):
+            return self._resolve(did, as_of_time)
+
+    def _resolve(self, did, as_of_time):
         if is_valid_peer_did(did):
             if is_reserved_peer_did(did):
                 return get_predefined(did[13])
             else:
                 path = os.path.join(self.path, canonical_fname(did))
-                if os.path.isfile(path):
+                found = os.path.isfile(path)
+                r = metrics.registry
+                if r is not None:
+                    r.inc('repo_lookup_hit' if found else 'repo_lookup_miss')
+                if found:
                     doc = DIDDoc(path)
                     return doc.resolve(as_of_time)
 
+    def iter_paths(self):
+        """Yield the path of every deltas file in the repo, in directory order."""
+        if os.path.isdir(self.path):
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if entry.name.endswith(DELTAS_EXT) and entry.is_file():
+                        yield entry.path
+
+    def scan(self, max_workers: int = None, window: int = 1024):
+        """
+        Load every File in the repo, with all delta hashes already computed. Files
+        are read and hashed in a thread pool (file I/O and hashlib both release the
+        GIL), with at most window files in flight. Yields Files in directory order.
+        """
+        with ThreadPoolExecutor(max_workers) as pool:
+            for f in _bounded_map(pool, _load_hashed, self.iter_paths(), window):
+                yield f
+
+    def compact(self, min_deltas: int = 8, max_workers: int = None) -> int:
+        """
+        Compact (see File.compact) every file whose log holds at least min_deltas
+        deltas. Files whose changes can't be expressed as a checkpoint are left
+        alone. Returns how many files were compacted.
+        """
+        with ThreadPoolExecutor(max_workers) as pool:
+            compact = lambda path: _compact_file(path, min_deltas)
+            return sum(_bounded_map(pool, compact, self.iter_paths(), 1024))
+
+    def compact_in_background(self, min_deltas: int = 8, max_workers: int = None) -> Future:
+        """Run compact() on a daemon thread. The returned Future holds its result."""
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.compact(min_deltas, max_workers))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
     @classmethod
     def norm_path(cls, path):
-        return os.path.normpath(os.path.abspath(os.path.expanduser(path)))
\ No newline at end of file
+        return os.path.normpath(os.path.abspath(os.path.expanduser(path)))
+
+
+def _load_hashed(path):
+    # Loading hashes; inline, since scan() already runs one load per worker.
+    return File(path, hash_workers=1)
+
+
+def _compact_file(path, min_deltas):
+    f = File(path, hash_workers=1)
+    if len(f.deltas) < min_deltas:
+        return False
+    try:
+        return f.compact()
+    except ValueError:
+        return False
+
+
+def _bounded_map(executor, func, items, window):
+    """Like executor.map, but only submits window items ahead of the consumer."""
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
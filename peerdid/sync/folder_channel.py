@@ -1,6 +1,23 @@
+import asyncio
+import collections
+import heapq
 import os
+import struct
+import threading
+import time
 import uuid
 
+from .. import tracing
+from .watcher import open_watcher
+
+
+# Priority classes for send(). Ordered receivers deliver lower numbers first;
+# for example, send a key revocation with PRIORITY_HIGH so a flood of routine
+# updates can't hold it up.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 
 class Channel:
     """
@@ -13,7 +30,8 @@ class Channel:
     not intended to be used in production.
     """
 
-    def __init__(self, folder: str, is_destward: bool = True):
+    def __init__(self, folder: str, is_destward: bool = True, ordered: bool = False, executor=None,
+                 lease: float = 60.0):
         """
         Claim a folder in the file system as the locus of message
         sending and receiving.
@@ -38,8 +56,44 @@ class Channel:
           http -> relay -> FolderChannel -> agent
                                      |
                Channel is srcward of the agent (read from *.in; write to *.out)
+
+        :param ordered: If true, receive(), receive_many() and watch() deliver
+          messages by priority, then in the order each sender sent them.
+          Otherwise, order is whatever the file system lists first (cheaper).
+        :param executor: Where the async methods do their blocking file system
+          work, so a slow disk doesn't stall the event loop. None means the
+          event loop's default executor.
+        :param lease: Seconds a consumer may hold a claimed message (see
+          claim(), or a batch that receive() has only partly returned)
+          before it's given to someone else. A partly returned batch's lease
+          is renewed as its messages are returned.
         """
         self.is_destward = is_destward
+        self.ordered = ordered
+        self.executor = executor
+        # Guards receive-side state (_buffer, _queue) across executor threads.
+        self._receive_lock = threading.Lock()
+        # Every file we write is stamped with priority, time, this sender's id
+        # and a sequence number, so ordered receivers can sort them.
+        self.sender = uuid.uuid4().hex[:8]
+        self._send_lock = threading.Lock()
+        self._seq = 0
+        self._last_when = 0
+        # For ordered receive: a heap of (order key, fname), the names in it,
+        # and the folder's mtime when it was last refreshed.
+        self._queue = []
+        self._queued = set()
+        self._queue_mtime = None
+        self.lease = lease
+        self._next_requeue = 0
+        # (id, payload, file name) for messages taken from files but not yet
+        # received: the rest of a batch, or what watch() hasn't yielded yet.
+        # Each file stays claimed until all its messages are handed out; _held
+        # maps its name to [claimed name, messages left], and _handed lists
+        # claimed files ready to delete.
+        self._buffer = collections.deque()
+        self._held = {}
+        self._handed = []
         self.folder = os.path.normpath(os.path.abspath(os.path.expanduser(folder)))
         if not os.path.isdir(folder):
             raise Exception("Folder %s must exist." % folder)
@@ -58,53 +112,522 @@ class Channel:
     def direction(self):
         return 'destward' if self.is_destward else 'srcward'
 
-    def send(self, payload, id=None, *args):
+    def send(self, payload, id=None, *args, priority: int = PRIORITY_NORMAL):
         if isinstance(payload, str):
             payload = payload.encode('utf-8')
         if id is None:
             id = str(uuid.uuid4())
+        _check_id(id)
+        attributes = {'peerdid.channel': str(self), 'peerdid.bytes': len(payload)}
+        with tracing.tracer.start_as_current_span('Channel.send', attributes):
+            self._write(self._stamp(id, priority) + self.write_ext, payload)
+        return id
+
+    def send_many(self, payloads, id=None, priority: int = PRIORITY_NORMAL):
+        """
+        Send several messages as one batch file, so they cost one create and
+        one rename instead of one each. Receivers unpack batches
+        transparently; a filter passed to peek() or receive() matches the
+        batch's id.
+        """
+        payloads = [p.encode('utf-8') if isinstance(p, str) else p for p in payloads]
+        if id is None:
+            id = str(uuid.uuid4())
+        _check_id(id)
+        data = b''.join(_FRAME_HEADER.pack(len(p)) + p for p in payloads)
+        attributes = {'peerdid.channel': str(self), 'peerdid.bytes': len(data), 'peerdid.messages': len(payloads)}
+        with tracing.tracer.start_as_current_span('Channel.send_many', attributes):
+            self._write(self._stamp(id, priority) + BATCH_MARK + self.write_ext, data)
+        return id
+
+    def _stamp(self, id, priority):
+        """Name a message file: <id>@<priority>-<time_ns in hex>-<sender>-<seq>."""
+        with self._send_lock:
+            self._seq += 1
+            # Keep times increasing for this sender even if the clock steps back.
+            when = max(time.time_ns(), self._last_when + 1)
+            self._last_when = when
+            return '%s@%d-%x-%s-%d' % (id, priority, when, self.sender, self._seq)
+
+    def _write(self, fname, data):
         # Because writing is not an atomic operation, create the file with
         # a temp name, then rename it once the file has been written and
         # closed. This prevents code from peeking/reading the file before
         # we are done writing it.
-        temp_fname = os.path.join(self.folder, '.' + id + '.tmp')
-        perm_fname = os.path.join(self.folder, id + self.write_ext)
+        temp_fname = os.path.join(self.folder, '.' + fname + '.tmp')
         with open(temp_fname, 'wb') as f:
-            f.write(payload)
-        os.rename(temp_fname, perm_fname)
-        return id
+            f.write(data)
+        os.rename(temp_fname, os.path.join(self.folder, fname))
 
     def peek(self, filter=None):
+        with self._receive_lock:
+            for id, data, fname in self._buffer:
+                if filter is None or id.startswith(filter):
+                    return True
         for x in _next_item_name(self.folder, self.read_ext, filter):
             return True
+        return False
+
+    async def apeek(self, filter=None):
+        """Like peek(), but lists the folder in the executor."""
+        return await self._run(self.peek, filter)
+
+    async def receive(self, filter=None):
+        """
+        Return the next message (None if nothing is waiting). A message sent
+        alone is delivered at most once: it counts as handled when it's
+        returned, so if the caller crashes before handling it, it's lost.
+        Messages sent in a batch are delivered at least once: the batch stays
+        claimed until its last message is returned (the lease is renewed as
+        each is), and if the receiver crashes, or returns none of it for a
+        whole lease, the batch is requeued and delivered again in full, even
+        the messages already returned. (The receiver then drops what it still
+        had of it.) Use claim() to ack only after handling.
+        """
+        with tracing.tracer.start_as_current_span('Channel.receive', {'peerdid.channel': str(self)}) as span:
+            data = await self._run(self._receive, filter)
+            span.set_attribute('peerdid.bytes', len(data) if data is not None else 0)
+        return data
+
+    async def receive_many(self, max_messages: int = None, filter=None) -> list:
+        """
+        Return every waiting message (or at most max_messages of them), taking
+        as many files as needed from a single scan of the folder. Returns an
+        empty list if nothing is waiting. Delivery is as for receive().
+        """
+        with tracing.tracer.start_as_current_span('Channel.receive_many', {'peerdid.channel': str(self)}) as span:
+            messages = await self._run(self._receive_many, max_messages, filter)
+            span.set_attributes({'peerdid.bytes': sum(len(m) for m in messages), 'peerdid.messages': len(messages)})
+        return messages
 
-    def receive(self, filter=None):
-        return _item_content(self.folder, self.read_ext, filter)
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _receive(self, filter):
+        with self._receive_lock:
+            data = self._pop_buffered(filter)
+            if data is None:
+                for fname in self._next_names(filter):
+                    messages = self._take_messages(fname, 1)
+                    if messages:
+                        data = messages[0]
+                        break
+            self._ack_handed()
+            return data
+
+    def _receive_many(self, max_messages, filter):
+        with self._receive_lock:
+            messages = []
+            while max_messages is None or len(messages) < max_messages:
+                data = self._pop_buffered(filter)
+                if data is None:
+                    break
+                messages.append(data)
+            if max_messages is None or len(messages) < max_messages:
+                for fname in self._next_names(filter):
+                    messages.extend(self._take_messages(fname, max_messages - len(messages) if max_messages else None))
+                    if max_messages is not None and len(messages) >= max_messages:
+                        break
+            self._ack_handed()
+            return messages
+
+    def _next_names(self, filter=None):
+        """
+        Yield the names of waiting message files, in order if self.ordered.
+        The caller must take each file it's given.
+        """
+        self._maybe_requeue_expired()
+        if not self.ordered:
+            yield from _next_item_name(self.folder, self.read_ext, filter)
+            return
+        self._refresh_queue()
+        while self._queue:
+            if filter is None:
+                key, fname = heapq.heappop(self._queue)
+            else:
+                matches = [entry for entry in self._queue if entry[1].startswith(filter)]
+                if not matches:
+                    return
+                entry = min(matches)
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                fname = entry[1]
+            self._queued.discard(fname)
+            yield fname
+
+    def _refresh_queue(self):
+        """Add newly arrived files to the heap. Skip the listing if nothing can have changed."""
+        mtime = os.stat(self.folder).st_mtime_ns
+        if self._queue and mtime == self._queue_mtime:
+            return
+        self._queue_mtime = mtime
+        for fname in _next_item_name(self.folder, self.read_ext):
+            if fname not in self._queued:
+                self._queued.add(fname)
+                heapq.heappush(self._queue, (_order_key(fname, self.read_ext), fname))
+
+    def _pop_buffered(self, filter=None):
+        while True:
+            for i, (id, data, fname) in enumerate(self._buffer):
+                if filter is None or id.startswith(filter):
+                    break
+            else:
+                return None
+            held = self._held[fname]
+            if not self._renew(fname, held):
+                # Requeued: it will be delivered again in full.
+                self._drop(fname)
+                continue
+            del self._buffer[i]
+            held[1] -= 1
+            if not held[1]:
+                del self._held[fname]
+                self._handed.append(held[0])
+            return data
+
+    def _renew(self, fname, held) -> bool:
+        """
+        Extend the claim on a held file once half its lease has gone. Returns
+        False if the lease ran out and the file was requeued.
+        """
+        deadline = _parse_claimed(held[0])[1]
+        if deadline - time.time_ns() > self.lease * 1e9 / 2:
+            return True
+        claimed = self._claim_file(fname, self.lease, held[0])
+        if claimed is None:
+            return False
+        held[0] = claimed
+        return True
+
+    def _drop(self, fname):
+        """Forget the buffered messages of a file we no longer hold."""
+        self._held.pop(fname, None)
+        self._buffer = collections.deque(entry for entry in self._buffer if entry[2] != fname)
+
+    def _ack_handed(self):
+        """Delete the claimed files whose messages have all been handed out."""
+        while self._handed:
+            try:
+                os.remove(os.path.join(self.folder, self._handed.pop()))
+            except FileNotFoundError:
+                # The lease ran out and the file was requeued.
+                pass
+
+    def _take_messages(self, fname, limit=None) -> list:
+        """
+        Take a message file and return its messages (a batch holds several).
+        Messages beyond limit are buffered for later receive() calls, and the
+        file stays claimed until the last of them is handed out, so if we
+        crash first, the batch is requeued when the lease runs out.
+        """
+        claimed, messages = self._read_claimed(fname, self.lease)
+        if claimed is None:
+            return []
+        # If we still buffer some of it, our claim ran out and it was requeued.
+        self._drop(fname)
+        if limit is not None and len(messages) > limit:
+            self._hold(fname, claimed, messages[limit:])
+            return messages[:limit]
+        os.remove(os.path.join(self.folder, claimed))
+        return messages
+
+    def _read_claimed(self, fname, lease):
+        """Claim a message file and read its messages. Returns (claimed name, messages), or (None, [])."""
+        claimed = self._claim_file(fname, lease)
+        if claimed is None:
+            return None, []
+        with open(os.path.join(self.folder, claimed), 'rb') as f:
+            data = f.read()
+        if fname[:-len(self.read_ext)].endswith(BATCH_MARK):
+            return claimed, _unframe(data)
+        return claimed, [data]
+
+    def _hold(self, fname, claimed, messages):
+        """Buffer messages from a claimed file; the file is deleted once they've all been received."""
+        id = self._message_id(fname)
+        self._drop(fname)
+        self._held[fname] = [claimed, len(messages)]
+        self._buffer.extend((id, m, fname) for m in messages)
+
+    def _message_id(self, fname):
+        """The id (with its stamp) that filters match, for the messages in a file."""
+        id = fname[:-len(self.read_ext)]
+        return id[:-len(BATCH_MARK)] if id.endswith(BATCH_MARK) else id
+
+    def _claim_file(self, fname, lease, current=None):
+        """
+        Rename a message file (or its current claimed name) to
+        <fname>.<consumer>.<deadline>.processing, and return the new name.
+        Rename is atomic, so of several consumers racing for the file, exactly
+        one wins; the rest get None.
+        """
+        deadline = time.time_ns() + int(lease * 1e9)
+        claimed = '%s.%s.%x%s' % (fname, self.sender, deadline, PROCESSING_EXT)
+        try:
+            os.rename(os.path.join(self.folder, current or fname), os.path.join(self.folder, claimed))
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    async def claim(self, filter=None, lease: float = None):
+        """
+        Take the next message file, but keep it on disk until it's handled.
+        Returns a Claim (or None if nothing is waiting). Call its ack() once
+        the messages are handled. If the consumer dies first, or the lease
+        (default self.lease) runs out, the file goes back in the folder for
+        another consumer. Several processes can drain one folder this way and
+        each file is handled once. Messages left in memory by receive() from a
+        partly received batch are not claimable.
+        """
+        claims = await self._run(self._claim_many, 1, filter, self.lease if lease is None else lease)
+        return claims[0] if claims else None
+
+    async def claim_many(self, max_claims: int = None, filter=None, lease: float = None) -> list:
+        """Like claim(), but take up to max_claims files (all waiting, if None) in one scan. Returns a list."""
+        return await self._run(self._claim_many, max_claims, filter, self.lease if lease is None else lease)
+
+    def _claim_many(self, max_claims, filter, lease):
+        claims = []
+        with self._receive_lock:
+            for fname in self._next_names(filter):
+                claimed, messages = self._read_claimed(fname, lease)
+                if claimed is not None:
+                    claims.append(Claim(self, claimed, fname, messages))
+                    if max_claims is not None and len(claims) >= max_claims:
+                        break
+        return claims
+
+    def requeue_expired(self) -> int:
+        """Put files whose claims have expired back in the folder. Return how many."""
+        count = 0
+        now = time.time_ns()
+        with os.scandir(self.folder) as entries:
+            names = [entry.name for entry in entries if entry.name.endswith(PROCESSING_EXT)]
+        for claimed in names:
+            fname, deadline = _parse_claimed(claimed)
+            if fname is None or not fname.endswith(self.read_ext) or deadline > now:
+                continue
+            try:
+                os.rename(os.path.join(self.folder, claimed), os.path.join(self.folder, fname))
+                count += 1
+            except FileNotFoundError:
+                # Acked, or requeued by someone else.
+                pass
+        return count
+
+    def _maybe_requeue_expired(self):
+        # Looking for expired claims costs a listing, so do it a few times per lease.
+        now = time.monotonic()
+        if now >= self._next_requeue:
+            self._next_requeue = now + self.lease / 4
+            self.requeue_expired()
+
+    async def watch(self, filter=None, poll_interval: float = 0.05):
+        """
+        Yield messages as they arrive, forever (break out of the loop to stop).
+        Messages already waiting come first. Rather than re-listing the folder
+        for each message, this waits for the file system to say that files
+        have appeared: via inotify on Linux, or else by polling the folder's
+        mtime every poll_interval seconds. Delivery is as for receive(): files
+        are deleted once their messages have been yielded.
+        """
+        watcher = open_watcher(self.folder, poll_interval)
+        attributes = {'peerdid.channel': str(self)}
+        try:
+            # Scan after the watch starts, so no file can slip between the two.
+            names = await self._run(watcher.scan)
+            while True:
+                with tracing.tracer.start_as_current_span('Channel.receive', attributes) as span:
+                    sizes = await self._run(self._take_names, names, filter)
+                    span.set_attributes({'peerdid.bytes': sum(sizes), 'peerdid.messages': len(sizes)})
+                # Hand messages out of the buffer one at a time, so any the
+                # caller doesn't get to (it breaks out early) stay there for
+                # the next receive.
+                while True:
+                    with self._receive_lock:
+                        data = self._pop_buffered(filter)
+                    if data is None:
+                        break
+                    yield data
+                if self._handed:
+                    await self._run(self._ack)
+                names = await watcher.changes()
+        finally:
+            watcher.close()
+            if self._handed:
+                await self._run(self._ack)
+
+    def _ack(self):
+        with self._receive_lock:
+            self._ack_handed()
+
+    def _take_names(self, names, filter):
+        """Take the message files among names into the buffer. Return the sizes of their messages."""
+        with self._receive_lock:
+            self._ack_handed()
+            self._maybe_requeue_expired()
+            if self.ordered:
+                names = sorted(names, key=lambda fname: _order_key(fname, self.read_ext))
+            sizes = []
+            for fname in names:
+                if fname.endswith(self.read_ext) and (filter is None or fname.startswith(filter)):
+                    claimed, messages = self._read_claimed(fname, self.lease)
+                    if messages:
+                        self._hold(fname, claimed, messages)
+                        sizes.extend(len(m) for m in messages)
+                    elif claimed is not None:
+                        # An empty batch. (None means another receiver took it first.)
+                        os.remove(os.path.join(self.folder, claimed))
+            return sizes
 
     def __str__(self):
         return self.direction + '=' + self.folder
 
 
+class Claim:
+    """A message file that a consumer holds, from Channel.claim(), until it acks or releases it."""
+    def __init__(self, channel: Channel, claimed: str, fname: str, messages: list):
+        self.channel = channel
+        self.claimed = claimed
+        self.fname = fname
+        # Several if the file is a batch.
+        self.messages = messages
+
+    def ack(self) -> bool:
+        """
+        Delete the file: its messages are handled. Returns False if the lease
+        had expired and the file was requeued, so someone else may handle it too.
+        """
+        try:
+            os.remove(os.path.join(self.channel.folder, self.claimed))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release(self) -> bool:
+        """Put the file back for any consumer to receive. Returns False if the lease had expired."""
+        try:
+            os.rename(os.path.join(self.channel.folder, self.claimed), os.path.join(self.channel.folder, self.fname))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def extend(self, lease: float = None) -> bool:
+        """Restart the lease (default channel.lease seconds). Returns False if it had already expired."""
+        claimed = self.channel._claim_file(self.fname, self.channel.lease if lease is None else lease, self.claimed)
+        if claimed is None:
+            return False
+        self.claimed = claimed
+        return True
+
+
+class BatchingSender:
+    """
+    Coalesce sends on a Channel. Messages are held until max_batch of them are
+    waiting or the oldest has waited max_latency seconds, then written with
+    one send_many(). Call close() (or use it in a with statement) to flush
+    what's left.
+    """
+    def __init__(self, channel: Channel, max_batch: int = 64, max_latency: float = 0.01):
+        self.channel = channel
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+
+    def send(self, payload):
+        with self._lock:
+            self._pending.append(payload)
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_latency, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            batch, self._pending = self._pending, []
+            if len(batch) == 1:
+                self.channel.send(batch[0])
+            else:
+                self.channel.send_many(batch)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+# Batch files are named <id>.batch.in or <id>.batch.out, and hold frames: a
+# 4-byte big-endian length, then that many bytes of message.
+BATCH_MARK = '.batch'
+# Claimed files are named <name>.<consumer>.<lease deadline in ns, hex>.processing.
+PROCESSING_EXT = '.processing'
+_FRAME_HEADER = struct.Struct('>I')
+
+
+def _order_key(fname, ext):
+    """Sort key for a message file: (priority, time, sender, seq)."""
+    stem = fname[:-len(ext)] if fname.endswith(ext) else fname
+    if stem.endswith(BATCH_MARK):
+        stem = stem[:-len(BATCH_MARK)]
+    id, sep, meta = stem.rpartition('@')
+    if sep:
+        try:
+            priority, when, sender, seq = meta.split('-')
+            return int(priority), int(when, 16), sender, int(seq)
+        except ValueError:
+            pass
+    # Not stamped (written by something other than a Channel).
+    return PRIORITY_NORMAL, 0, '', 0
+
+
+def _check_id(id):
+    if id.endswith(BATCH_MARK):
+        raise ValueError('A message id may not end with %r.' % BATCH_MARK)
+
+
+def _unframe(data):
+    messages = []
+    i = 0
+    while i < len(data):
+        size, = _FRAME_HEADER.unpack_from(data, i)
+        i += _FRAME_HEADER.size
+        messages.append(data[i:i + size])
+        i += size
+    return messages
+
+
 def _next_item_name(folder, ext, filter=None):
-    for root, folders, files in os.walk(folder):
-        folders.clear()
-        for fname in files:
+    # scandir streams entries, so the first match is found without listing the
+    # whole folder.
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            fname = entry.name
             # Ignore files that are not messages.
             if fname.endswith(ext):
                 if (filter is None) or (fname.startswith(filter)):
                     yield fname
 
 
-async def _pop_item(fpath):
-    with open(fpath, 'rb') as f:
-        data = f.read()
-    os.remove(fpath)
-    return data
+def _parse_claimed(claimed):
+    """Return (original name, deadline in ns) for a claimed file name, or (None, None)."""
+    try:
+        rest, consumer, deadline = claimed[:-len(PROCESSING_EXT)].rsplit('.', 2)
+        return rest, int(deadline, 16)
+    except ValueError:
+        return None, None
 
-
-async def _item_content(folder, ext, filter=None):
-    """Return next as mwc.MessageWithContext, or None if nothing is found."""
-    data = None
-    for fname in _next_item_name(folder, ext, filter):
-        data = await _pop_item(os.path.join(folder, fname))
-        return data
@@ -0,0 +1,220 @@
+import collections
+import errno
+import os
+import selectors
+import socket
+import struct
+import threading
+import uuid
+
+from .. import tracing
+from .folder_channel import Channel, PRIORITY_NORMAL
+
+
+class SocketChannel:
+    """
+    A Channel-compatible transport for agents on the same machine. Messages
+    travel over Unix domain sockets instead of through files, so they move at
+    memory speed. It has the same send()/peek()/receive() surface and the same
+    destward/srcward pairing as Channel, and uses the same folder: each side
+    listens on a socket file in the folder and connects to the other side's.
+
+    Sockets aren't durable. If the other side isn't listening, send() falls
+    back to writing a file with a folder Channel, and receive() drains such
+    files once the socket has nothing waiting. Pass fallback=False to raise
+    (OSError) instead.
+
+    Only one channel per side can listen in a folder; a second raises OSError
+    (EADDRINUSE). A socket file left by a process that died is replaced.
+
+    Socket paths are limited to about 100 bytes, so keep the folder's path short.
+    """
+
+    def __init__(self, folder: str, is_destward: bool = True, fallback: bool = True):
+        self.is_destward = is_destward
+        self.folder = os.path.normpath(os.path.abspath(os.path.expanduser(folder)))
+        if not os.path.isdir(folder):
+            raise Exception("Folder %s must exist." % folder)
+        self.fallback = Channel(folder, is_destward) if fallback else None
+        # (id, payload) for messages that have arrived but not been received.
+        self._inbox = collections.deque()
+        self._inbox_lock = threading.Lock()
+        self._out = None
+        self._out_lock = threading.Lock()
+        self._closed = False
+        # A socket file left by a dead process would make bind() fail. Remove
+        # it only if nobody answers, rather than take over a live listener.
+        if os.path.exists(self.read_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.read_path)
+            except ConnectionRefusedError:
+                os.remove(self.read_path)
+            else:
+                raise OSError(errno.EADDRINUSE, 'Another channel is listening on this socket.', self.read_path)
+            finally:
+                probe.close()
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.read_path)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def read_path(self):
+        """The socket I listen on."""
+        return os.path.join(self.folder, '.out.sock' if self.is_destward else '.in.sock')
+
+    @property
+    def write_path(self):
+        """The socket I send to."""
+        return os.path.join(self.folder, '.in.sock' if self.is_destward else '.out.sock')
+
+    @property
+    def direction(self):
+        return 'destward' if self.is_destward else 'srcward'
+
+    def send(self, payload, id=None, *args, priority: int = PRIORITY_NORMAL):
+        """
+        Send a message. Socket delivery is immediate and in order, so priority
+        only matters when the message falls back to a file.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        if id is None:
+            id = str(uuid.uuid4())
+        id_bytes = id.encode('utf-8')
+        frame = _FRAME_HEADER.pack(len(id_bytes), len(payload)) + id_bytes + payload
+        attributes = {'peerdid.channel': str(self), 'peerdid.bytes': len(payload)}
+        with tracing.tracer.start_as_current_span('Channel.send', attributes) as span:
+            with self._out_lock:
+                try:
+                    if self._out is None:
+                        self._out = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self._out.connect(self.write_path)
+                    self._out.sendall(frame)
+                    return id
+                except OSError:
+                    if self._out is not None:
+                        self._out.close()
+                        self._out = None
+                    if self.fallback is None:
+                        raise
+            span.set_attribute('peerdid.fallback', True)
+            return self.fallback.send(payload, id, priority=priority)
+
+    def peek(self, filter=None):
+        with self._inbox_lock:
+            for id, data in self._inbox:
+                if filter is None or id.startswith(filter):
+                    return True
+        if self.fallback is not None:
+            return self.fallback.peek(filter)
+        return False
+
+    async def apeek(self, filter=None):
+        with self._inbox_lock:
+            for id, data in self._inbox:
+                if filter is None or id.startswith(filter):
+                    return True
+        if self.fallback is not None:
+            return await self.fallback.apeek(filter)
+        return False
+
+    async def receive(self, filter=None):
+        with tracing.tracer.start_as_current_span('Channel.receive', {'peerdid.channel': str(self)}) as span:
+            data = None
+            with self._inbox_lock:
+                for i, (id, payload) in enumerate(self._inbox):
+                    if filter is None or id.startswith(filter):
+                        del self._inbox[i]
+                        data = payload
+                        break
+            if data is None and self.fallback is not None:
+                data = await self.fallback.receive(filter)
+            span.set_attribute('peerdid.bytes', len(data) if data is not None else 0)
+        return data
+
+    def close(self):
+        """Stop listening. Messages already received stay available."""
+        if self._closed:
+            return
+        self._closed = True
+        self._thread.join()
+        with self._out_lock:
+            if self._out is not None:
+                self._out.close()
+                self._out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __str__(self):
+        return self.direction + '=unix:' + self.folder
+
+    def _serve(self):
+        # One thread multiplexes the listener and every connection.
+        buffers = {}
+        try:
+            while not self._closed:
+                for key, mask in self._selector.select(timeout=0.1):
+                    sock = key.fileobj
+                    if sock is self._listener:
+                        try:
+                            conn, _ = self._listener.accept()
+                        except BlockingIOError:
+                            continue
+                        conn.setblocking(False)
+                        self._selector.register(conn, selectors.EVENT_READ)
+                        buffers[conn] = bytearray()
+                        continue
+                    try:
+                        data = sock.recv(1 << 16)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        data = b''
+                    if not data:
+                        # The sender went away; any partial frame is lost with it.
+                        self._selector.unregister(sock)
+                        sock.close()
+                        del buffers[sock]
+                        continue
+                    buf = buffers[sock]
+                    buf += data
+                    self._unframe(buf)
+        finally:
+            for sock in buffers:
+                sock.close()
+            self._selector.close()
+            self._listener.close()
+            if os.path.exists(self.read_path):
+                os.remove(self.read_path)
+
+    def _unframe(self, buf):
+        """Move every complete frame at the start of buf into the inbox."""
+        messages = []
+        i = 0
+        while len(buf) - i >= _FRAME_HEADER.size:
+            id_size, size = _FRAME_HEADER.unpack_from(buf, i)
+            end = i + _FRAME_HEADER.size + id_size + size
+            if end > len(buf):
+                break
+            start = i + _FRAME_HEADER.size
+            messages.append((buf[start:start + id_size].decode('utf-8'), bytes(buf[start + id_size:end])))
+            i = end
+        if messages:
+            del buf[:i]
+            with self._inbox_lock:
+                self._inbox.extend(messages)
+
+
+# Each message on the wire: id length and payload length (4 bytes each,
+# big-endian), then the id (UTF-8), then the payload.
+_FRAME_HEADER = struct.Struct('>II')
@@ -0,0 +1,147 @@
+"""
+Tell when files appear in a folder, without listing the folder over and over.
+On Linux, InotifyWatcher asks the kernel (through ctypes; there is no
+dependency to install). Elsewhere, PollingWatcher checks the folder's mtime
+and lists it only when the mtime moves. Both are used from asyncio:
+
+    watcher = open_watcher(folder)
+    names = watcher.scan()
+    while True:
+        ...handle names...
+        names = await watcher.changes()
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import time
+
+
+class PollingWatcher:
+    def __init__(self, folder: str, poll_interval: float = 0.05, rescan_interval: float = 1.0):
+        """
+        :param poll_interval: Seconds between checks of the folder's mtime; this
+          bounds how long a new file can go unnoticed.
+        :param rescan_interval: List the folder at least this often even if the
+          mtime hasn't moved, for file systems with coarse timestamps.
+        """
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self._mtime = None
+        self._scanned_at = 0
+
+    def scan(self) -> list:
+        """List every file in the folder now."""
+        # Read the mtime first, so a file created while we list is caught next time.
+        self._mtime = os.stat(self.folder).st_mtime_ns
+        self._scanned_at = time.monotonic()
+        with os.scandir(self.folder) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
+
+    async def changes(self) -> list:
+        """Wait for the folder to change, then return the names of files it may have gained."""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if os.stat(self.folder).st_mtime_ns != self._mtime or \
+                    time.monotonic() - self._scanned_at >= self.rescan_interval:
+                # Listing a big folder can take a while; don't block the event loop.
+                names = await asyncio.get_running_loop().run_in_executor(None, self.scan)
+                if names:
+                    return names
+
+    def close(self):
+        pass
+
+
+# From <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # Raises AttributeError if this libc has no inotify.
+        libc.inotify_init1, libc.inotify_add_watch
+        _libc = libc
+    return _libc
+
+
+class InotifyWatcher:
+    """
+    Reports files that are renamed into the folder or closed after writing.
+    (Channel.send renames each finished message into place.)
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        libc = _get_libc()
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if libc.inotify_add_watch(self._fd, os.fsencode(folder), _IN_MOVED_TO | _IN_CLOSE_WRITE) < 0:
+            e = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(e, os.strerror(e), folder)
+
+    def scan(self) -> list:
+        with os.scandir(self.folder) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
+
+    def _read_events(self):
+        # The fd is non-blocking and only read when the loop says it's ready.
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return None
+        names = []
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, i)
+            i += _EVENT_HEADER.size
+            if mask & _IN_Q_OVERFLOW:
+                # The kernel dropped events; fall back to a listing.
+                return self.scan()
+            if length:
+                names.append(os.fsdecode(buf[i:i + length].rstrip(b'\0')))
+            i += length
+        return names
+
+    async def changes(self) -> list:
+        while True:
+            names = self._read_events()
+            if names:
+                return names
+            loop = asyncio.get_running_loop()
+            ready = loop.create_future()
+            loop.add_reader(self._fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                loop.remove_reader(self._fd)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def open_watcher(folder: str, poll_interval: float = 0.05):
+    """Return an InotifyWatcher if the platform supports one, else a PollingWatcher."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(folder, poll_interval)
@@ -0,0 +1,52 @@
+import pytest
+import zlib
+
+from .. import compression
+from ..workload import Workload
+
+
+def test_round_trip():
+    data = b'{"publicKey": [{"id": "key-1", "type": "Ed25519VerificationKey2018"}]}'
+    packed = compression.compress(data)
+    assert compression.is_compressed(packed)
+    assert compression.decompress(packed) == data
+    # Uncompressed data passes through.
+    assert compression.decompress(data) == data
+
+
+def test_dictionary_helps():
+    # A different seed than the dictionary was trained on. Only the direction
+    # is checked; the ratio depends on the workload.
+    samples = [d.change_json_bytes for h in Workload(seed=99).histories(20, 10) for d in h]
+    with_dictionary = sum(len(compression.deflate(s)) for s in samples)
+    plain = sum(len(zlib.compress(s, 9)) for s in samples)
+    assert with_dictionary < plain
+
+
+def test_unknown_dictionary():
+    with pytest.raises(ValueError):
+        compression.inflate(b'', 255)
+
+
+def test_train_dictionary():
+    samples = [b'{"type": "a", "x": "%d"}' % i for i in range(10)]
+    d = compression.train_dictionary(samples, size=100)
+    assert b'"type": ' in d
+    assert b'"0"' not in d
+    assert len(d) <= 100
+
+
+def test_corrupt_data():
+    packed = compression.compress(b'{"a": 1}')
+    magic = compression.PAYLOAD_MAGIC
+    for bad in [magic + b'\x01garbage', packed[:-2], magic, magic + b'\x01']:
+        with pytest.raises(ValueError):
+            compression.decompress(bad)
+
+
+def test_size_limit():
+    bomb = compression.compress(b' ' * 100000)
+    assert len(bomb) < 1000
+    assert compression.decompress(bomb, max_size=100000) == b' ' * 100000
+    with pytest.raises(ValueError):
+        compression.decompress(bomb, max_size=99999)
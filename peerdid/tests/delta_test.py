@@ -1,7 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
+import pytest
 import re
 
-from ..delta import Delta
+from ..delta import Delta, compute_hashes
+from ..diddoc import get_predefined
 
 
 SAMPLE_CHANGE = '{"deleted": ["key-1"]}'
@@ -71,4 +74,40 @@ def test_comparison(sample_delta):
 def test_hashable(sample_delta):
     x = [sample_delta, Delta(SAMPLE_CHANGE, [])]
     y = set(x)
-    assert len(y) == 1
\ No newline at end of file
+    assert len(y) == 1
+
+def test_canonical_changes_hash_the_same():
+    d1 = Delta({"deleted": ["key-1"], "rules": []}, [], canonical=True)
+    d2 = Delta('{ "rules": [],\n  "deleted": ["key-1"] }', [], canonical=True)
+    d3 = Delta(b'{"rules":[],"deleted":["key-1"]}', [], canonical=True)
+    assert d1.change_json_str == '{"deleted":["key-1"],"rules":[]}'
+    assert d1.hash == d2.hash == d3.hash
+    assert Delta(d1.change, [], canonical=True).change == d1.change
+
+
+def test_canonical_is_opt_in():
+    assert Delta(SAMPLE_CHANGE, []).change == SAMPLE_CHANGE_BASE64
+    assert Delta(SAMPLE_CHANGE, [], canonical=True).change != SAMPLE_CHANGE_BASE64
+
+
+def test_compressed_change():
+    change = get_predefined('1')
+    plain = Delta(change, [], '2020-01-01')
+    packed = Delta(change, [], '2020-01-01', compress=True)
+    assert packed.compressed and not plain.compressed
+    assert len(packed.change) < len(plain.change) / 2
+    assert packed.change_json_bytes == plain.change_json_bytes
+    assert packed.hash == plain.hash and packed.encnumbasis == plain.encnumbasis
+    assert Delta.from_json(packed.to_json()).change == packed.change
+    assert plain.compress().change == packed.change
+    assert Delta(packed.change.encode('ascii'), []).change_json_str == change
+    with pytest.raises(ValueError):
+        Delta('z1:AAAA', [])
+
+
+def test_compute_hashes_with_nothing_to_do():
+    with ThreadPoolExecutor(2) as pool:
+        compute_hashes([], executor=pool)
+        d = Delta('{"a": 1}', [])
+        d.hash
+        compute_hashes([d], executor=pool)
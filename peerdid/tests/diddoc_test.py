@@ -1,3 +1,4 @@
+import copy
 import pytest
 
 from ..diddoc import *
@@ -91,4 +92,104 @@ def test_get_path_where_diddocs_differ():
 def test_resolve(scratch_space):
     dd = make_genesis_doc(scratch_space.name, BOGUS_CHANGE)
     assert get_path_where_diddocs_differ(dd.resolve(),
-        '{"id": "did:peer:1zQmPdtCnLd1sGv4FemhUt4kzLQXuDAywSC8cPSZMa27GPGs", "say": "hello, world"}') is None
\ No newline at end of file
+        '{"id": "did:peer:1zQmPdtCnLd1sGv4FemhUt4kzLQXuDAywSC8cPSZMa27GPGs", "say": "hello, world"}') is None
+
+def test_validate_reports_all_errors_with_paths():
+    doc = json.loads(get_predefined('1'))
+    del doc['publicKey'][0]['id']
+    doc['publicKey'][1]['publicKeyHex'] = 'not hex'
+    doc['service'][0]['serviceEndpoint'] = 42
+    with pytest.raises(ValidationError) as e:
+        validate(doc)
+    paths = [path for path, msg in e.value.errors]
+    assert paths == ['.publicKey[0].id', '.publicKey[1].publicKeyHex', '.service[0].serviceEndpoint']
+
+
+def test_validate_requires_exactly_one_kind_of_key_material():
+    doc = json.loads(get_predefined('1'))
+    doc['publicKey'][0]['publicKeyHex'] = 'abcd'
+    with pytest.raises(ValidationError) as e:
+        validate(doc)
+    assert e.value.errors[0][0] == '.publicKey[0]'
+
+
+def test_validate_many():
+    results = validate_many([get_predefined('1'), {}, b'[]', get_predefined('c')])
+    assert results[0] == []
+    assert results[1] == [('.@context', 'Missing required property.')]
+    assert len(results[2]) == 1
+    assert len(results[3]) == 1
+    # Undecodable or unparseable input is reported, not raised.
+    results = validate_many([b'\xff', b'{"unterminated', '{'])
+    assert [len(r) for r in results] == [1, 1, 1]
+    assert results[0][0][1].startswith('Not valid UTF-8')
+
+
+def test_validate_change():
+    validate_change(Delta('{"deleted": ["key-1"]}', []))
+    validate_change({"publicKey": [{"id": "key-9", "type": "Ed25519VerificationKey2018",
+                                    "publicKeyBase58": "GBMBzuhw7XgSdbNffh8HpoKWEdEN6hU2Q5WqL1KQTG5Z"}]})
+    with pytest.raises(ValidationError):
+        validate_change({"deleted": "key-1"})
+
+
+def test_diddocs_compared_as_jsonld_sets():
+    doc_0 = json.loads(get_predefined('2'))
+    doc_1 = json.loads(get_predefined('2'))
+    doc_1['publicKey'].reverse()
+    doc_1['publicKey'].append(doc_1['publicKey'][0])
+    doc_1['authentication'].reverse()
+    assert get_path_where_diddocs_differ(doc_0, doc_1) is None
+    doc_1['publicKey'][1]['id'] = 'key-6'
+    assert get_path_where_diddocs_differ(doc_0, doc_1) == '.publicKey[1]'
+
+
+def test_get_paths_where_diddocs_differ():
+    doc_0 = get_predefined('2')
+    doc_1 = json.loads(doc_0)
+    assert get_paths_where_diddocs_differ(doc_0, doc_1) == []
+    doc_1['id'] = 'x'
+    doc_1['publicKey'][0]['abc'] = 1
+    doc_1['publicKey'][2]['id'] = 'key-6'
+    doc_1['authentication'].append('#key-6')
+    del doc_1['service']
+    assert get_paths_where_diddocs_differ(doc_0, doc_1) == [
+        '.{service}', '.id', '.publicKey[0]', '.publicKey[2]', '.publicKey', '.authentication']
+
+
+def test_apply_delta_deletes_key_and_references(scratch_space):
+    doc = json.loads(get_predefined('1'))
+    del doc['id']
+    dd = make_genesis_doc(scratch_space.name, json.dumps(doc))
+    dd.append(Delta('{"deleted": ["key-1"]}', []))
+    resolved = dd.resolve()
+    assert [k['id'] for k in resolved['publicKey']] == ['key-3', 'key-5']
+    assert resolved['authentication'] == ['#key-3', '#key-5']
+
+
+def test_delta_between_diddocs_round_trips(scratch_space):
+    old = json.loads(get_predefined('1'))
+    del old['id']
+    new = copy.deepcopy(old)
+    del new['publicKey'][1]
+    new['publicKey'][1]['controller'] = '#other'
+    new['publicKey'].append({'id': 'key-7', 'type': 'Ed25519VerificationKey2018',
+                             'publicKeyBase58': 'GBMBzuhw7XgSdbNffh8HpoKWEdEN6hU2Q5WqL1KQTG5Z'})
+    new['authentication'] = ['#key-1', '#key-5', '#key-7']
+    new['authorization'] = {'rules': [{'id': 'r1', 'grant': ['register'], 'when': {'id': '#key-7'}}]}
+    change = get_change_between_diddocs(old, new)
+    assert sorted(change['deleted']) == ['key-3', 'key-5']
+    assert [k['id'] for k in change['publicKey']] == ['key-5', 'key-7']
+    assert change['authentication'] == ['#key-5', '#key-7']
+    assert change['rules'] == new['authorization']['rules']
+    dd = make_genesis_doc(scratch_space.name, json.dumps(old))
+    dd.append(get_delta_between_diddocs(old, new))
+    resolved = dd.resolve()
+    del resolved['id']
+    assert get_path_where_diddocs_differ(resolved, new) is None
+
+
+def test_delta_between_equal_diddocs_is_none():
+    assert get_delta_between_diddocs(get_predefined('1'), get_predefined('1')) is None
+    with pytest.raises(ValueError):
+        get_change_between_diddocs(get_predefined('1'), get_predefined('e'))
@@ -1,7 +1,12 @@
+import hashlib
+import json
 import os
 import pytest
+import threading
 
 from ..delta import Delta
+from ..diddoc import DIDDoc, get_predefined, get_path_where_diddocs_differ
+from ..file import File
 
 
 def test_genesis(scratch_file, sample_delta):
@@ -31,8 +36,167 @@ def test_autosave_false(scratch_file, sample_delta):
     assert os.path.exists(scratch_file.path)
 
 
+def test_save_fsync(scratch_file, sample_delta):
+    scratch_file.autosave = False
+    scratch_file.extend([sample_delta, Delta('{"n": 1}', [])])
+    scratch_file.save(fsync=True)
+    assert not scratch_file.dirty
+    assert File(scratch_file.path).deltas == scratch_file.deltas
+    # No temp file is left behind.
+    assert os.listdir(os.path.dirname(scratch_file.path)) == [os.path.basename(scratch_file.path)]
+
+
 def test_snapshot_one_delta(scratch_file, sample_delta):
     scratch_file.autosave = False
     assert not os.path.exists(scratch_file.path)
     scratch_file.append(sample_delta)
-    assert scratch_file.snapshot == 'WDuyVDIB7R1C6GhHX9lxhowEMCQkSw_QwBRtBvEFzVg='
\ No newline at end of file
+    assert scratch_file.snapshot == 'WDuyVDIB7R1C6GhHX9lxhowEMCQkSw_QwBRtBvEFzVg='
+
+def test_compute_hashes_matches_lazy_hashes(scratch_file):
+    scratch_file.autosave = False
+    for i in range(300):
+        scratch_file.append(Delta('{"n": %d}' % i, []))
+    expected = [hashlib.sha256(d.change_json_bytes).digest() for d in scratch_file.deltas]
+    scratch_file.compute_hashes(max_workers=4)
+    assert [d._hash for d in scratch_file.deltas] == expected
+
+
+def test_append_is_idempotent(scratch_file, sample_delta):
+    assert not scratch_file.contains(sample_delta.hash)
+    assert scratch_file.append(sample_delta)
+    assert scratch_file.contains(sample_delta.hash)
+    assert not scratch_file.append(Delta(sample_delta.change, [], '2001-01-01'))
+    assert len(scratch_file.deltas) == 1
+
+
+def test_hash_set_built_on_load(scratch_file, sample_delta):
+    scratch_file.append(sample_delta)
+    reloaded = File(scratch_file.path)
+    assert reloaded.contains(sample_delta.hash)
+    assert not reloaded.append(sample_delta)
+
+
+def make_history(f):
+    genesis = json.loads(get_predefined('1'))
+    del genesis['id']
+    f.append(Delta(genesis, []))
+    f.append(Delta({'publicKey': [{'id': 'key-7', 'type': 'Ed25519VerificationKey2018',
+                                   'publicKeyBase58': 'GBMBzuhw7XgSdbNffh8HpoKWEdEN6hU2Q5WqL1KQTG5Z'}],
+                    'authentication': ['#key-7']}, [], '2020-01-01'))
+    f.append(Delta({'deleted': ['key-7']}, [], '2020-01-02'))
+    f.append(Delta({'deleted': ['key-3']}, [], '2020-01-03'))
+
+
+def test_compact(scratch_file):
+    make_history(scratch_file)
+    did = scratch_file.did
+    before = DIDDoc(scratch_file).resolve()
+    old_deltas = scratch_file.deltas[1:]
+    assert scratch_file.compact()
+    assert len(scratch_file.deltas) == 2
+    assert scratch_file.deltas[1].change_json_dict == {'deleted': ['key-3']}
+    reloaded = File(scratch_file.path)
+    assert reloaded.did == did
+    assert get_path_where_diddocs_differ(DIDDoc(reloaded).resolve(), before) is None
+    assert reloaded.archived_deltas() == old_deltas
+    assert not reloaded.compact()
+
+
+def test_compact_remembers_history(scratch_file, scratch_space):
+    make_history(scratch_file)
+    uncompacted = File(os.path.join(scratch_space.name, 'copy'), autosave=False)
+    uncompacted.extend(scratch_file.deltas)
+    snapshot = scratch_file.snapshot
+    add_key_7 = scratch_file.deltas[1]
+    assert scratch_file.compact()
+    assert scratch_file.snapshot == snapshot
+    reloaded = File(scratch_file.path)
+    assert reloaded.snapshot == uncompacted.snapshot
+    # A peer re-sending an archived delta doesn't bring key-7 back.
+    assert not reloaded.append(add_key_7)
+    assert 'key-7' not in json.dumps(DIDDoc(reloaded).resolve())
+    # New deltas count, and compacting again archives them, not the checkpoint.
+    reloaded.append(Delta({'deleted': ['key-4']}, [], '2020-01-04'))
+    uncompacted.append(Delta({'deleted': ['key-4']}, [], '2020-01-04'))
+    assert reloaded.compact()
+    assert File(reloaded.path).snapshot == uncompacted.snapshot
+    assert reloaded.archived_deltas() == uncompacted.deltas[1:]
+
+
+def test_compact_after_crash_does_not_duplicate_archive(scratch_file, monkeypatch):
+    make_history(scratch_file)
+    from .. import file as file_module
+
+    def crash(path, data):
+        raise OSError('crash')
+    real = file_module._replace_contents
+    monkeypatch.setattr(file_module, '_replace_contents', crash)
+    with pytest.raises(OSError):
+        scratch_file.compact()
+    monkeypatch.setattr(file_module, '_replace_contents', real)
+    reloaded = File(scratch_file.path)
+    assert len(reloaded.deltas) == 4
+    assert reloaded.compact()
+    assert reloaded.archived_deltas() == scratch_file.deltas[1:]
+
+
+def test_compact_keeps_concurrent_appends(scratch_file):
+    make_history(scratch_file)
+    other = File(scratch_file.path)
+    other.append(Delta({'deleted': ['key-5']}, [], '2020-01-04'))
+    # scratch_file loaded before that append, but compacts it too.
+    assert scratch_file.compact()
+    assert 'key-5' not in json.dumps(DIDDoc(File(scratch_file.path)).resolve())
+    # other's view predates the compaction; what it appends still counts.
+    other.append(Delta({'deleted': ['key-1']}, [], '2020-01-05'))
+    assert scratch_file.compact()
+    reloaded = File(scratch_file.path)
+    doc = json.dumps(DIDDoc(reloaded).resolve())
+    assert 'key-5' not in doc and 'key-1' not in doc
+    assert len(reloaded.archived_deltas()) == 5
+
+
+def test_compact_while_another_thread_appends(scratch_file):
+    make_history(scratch_file)
+    path = scratch_file.path
+    added = [Delta({'n': i}, []) for i in range(100)]
+
+    def append_all():
+        f = File(path)
+        for d in added:
+            f.append(d)
+    t = threading.Thread(target=append_all)
+    t.start()
+    while t.is_alive():
+        File(path).compact()
+    t.join()
+    reloaded = File(path)
+    history = reloaded.deltas + reloaded.archived_deltas()
+    assert all(reloaded.contains(d.hash) for d in added)
+    assert all(d in history for d in added)
+
+
+def test_compact_refuses_signed_deltas(scratch_file):
+    make_history(scratch_file)
+    scratch_file.append(Delta({'deleted': ['key-4']}, [{'kid': '#key-1', 'sig': 'xyz'}]))
+    with pytest.raises(ValueError):
+        scratch_file.compact()
+    assert len(File(scratch_file.path).deltas) == 5
+
+
+def test_save_appends(scratch_file, sample_delta):
+    scratch_file.append(sample_delta)
+    with open(scratch_file.path, 'rb') as f:
+        before = f.read()
+    scratch_file.autosave = False
+    scratch_file.append(Delta('{"n": 1}', []))
+    scratch_file.save(fsync=True)
+    with open(scratch_file.path, 'rb') as f:
+        assert f.read().startswith(before)
+    # An append torn by a crash is ignored on load, and cut off by the next one.
+    with open(scratch_file.path, 'ab') as f:
+        f.write(b'{"change": "eyJuIjog')
+    reloaded = File(scratch_file.path)
+    assert reloaded.deltas == scratch_file.deltas
+    reloaded.append(Delta('{"n": 2}', []))
+    assert len(File(scratch_file.path).deltas) == 3
@@ -0,0 +1,316 @@
+import asyncio
+import os
+import pytest
+import threading
+import time
+
+from ..sync import folder_channel
+from ..sync.folder_channel import BatchingSender, Channel, PRIORITY_HIGH, PRIORITY_LOW
+from ..sync.watcher import PollingWatcher, open_watcher
+
+
+@pytest.fixture(params=['default', 'polling'])
+def watcher_kind(request, monkeypatch):
+    if request.param == 'polling':
+        monkeypatch.setattr(folder_channel, 'open_watcher',
+                            lambda folder, poll_interval: PollingWatcher(folder, poll_interval))
+    return request.param
+
+
+def test_peek_and_receive(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    assert not receiver.peek()
+    sender.send('hello', id='abc')
+    assert not sender.peek()
+    assert receiver.peek()
+    assert receiver.peek('abc')
+    assert not receiver.peek('xyz')
+    assert asyncio.run(receiver.receive()) == b'hello'
+    assert asyncio.run(receiver.receive()) is None
+
+
+def test_watch(scratch_space, watcher_kind):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    sender.send('waiting')
+    # Messages going the other way aren't ours.
+    receiver.send('reply')
+
+    async def run():
+        got = []
+        messages = receiver.watch(poll_interval=0.01)
+        got.append(await asyncio.wait_for(messages.__anext__(), 5))
+        for i in range(3):
+            sender.send('msg%d' % i)
+        while len(got) < 4:
+            got.append(await asyncio.wait_for(messages.__anext__(), 5))
+        await messages.aclose()
+        return got
+
+    got = asyncio.run(run())
+    assert got[0] == b'waiting'
+    assert sorted(got[1:]) == [b'msg0', b'msg1', b'msg2']
+    assert sender.peek()
+    assert not receiver.peek()
+
+
+def test_open_watcher(scratch_space):
+    watcher = open_watcher(scratch_space.name)
+    try:
+        assert watcher.scan() == []
+    finally:
+        watcher.close()
+
+
+def test_send_many(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    sender.send_many(['a', b'b', 'c'], id='batch1')
+    sender.send('d', id='single')
+    assert receiver.peek('batch1')
+    assert asyncio.run(receiver.receive('batch1')) == b'a'
+    # The rest of the batch is held in memory; the filter still applies.
+    assert receiver.peek('batch1')
+    assert not receiver.peek('nope')
+    assert sorted(asyncio.run(receiver.receive_many())) == [b'b', b'c', b'd']
+    assert asyncio.run(receiver.receive_many()) == []
+    assert not receiver.peek()
+
+
+def test_receive_many_limit(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    sender.send_many([str(i) for i in range(5)])
+    sender.send_many(['5', '6'])
+    got = asyncio.run(receiver.receive_many(3))
+    assert len(got) == 3
+    got += asyncio.run(receiver.receive_many(3))
+    got += asyncio.run(receiver.receive_many(3))
+    assert len(got) == 7
+    assert sorted(got) == [str(i).encode('ascii') for i in range(7)]
+
+
+def test_watch_batches(scratch_space, watcher_kind):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+
+    async def run():
+        messages = receiver.watch(poll_interval=0.01)
+        sender.send_many(['x', 'y'])
+        got = [await asyncio.wait_for(messages.__anext__(), 5) for _ in range(2)]
+        await messages.aclose()
+        return got
+
+    assert asyncio.run(run()) == [b'x', b'y']
+
+
+def test_batching_sender(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    with BatchingSender(sender, max_batch=3, max_latency=60) as batcher:
+        for i in range(7):
+            batcher.send(str(i))
+        # Two full batches were written; the seventh message is still held.
+        assert len(os.listdir(scratch_space.name)) == 2
+    assert len(os.listdir(scratch_space.name)) == 3
+    assert sorted(asyncio.run(receiver.receive_many())) == [str(i).encode('ascii') for i in range(7)]
+    batcher = BatchingSender(sender, max_batch=100, max_latency=0.01)
+    batcher.send('late')
+    deadline = time.time() + 5
+    while not receiver.peek() and time.time() < deadline:
+        time.sleep(0.01)
+    assert asyncio.run(receiver.receive()) == b'late'
+
+
+def test_ordered_receive(scratch_space):
+    alice = Channel(scratch_space.name, is_destward=True)
+    bob = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False, ordered=True)
+    for i in range(20):
+        alice.send('a%d' % i)
+        bob.send('b%d' % i, priority=PRIORITY_LOW)
+    alice.send_many(['a20', 'a21'])
+    # Arrives last, but jumps the queue.
+    bob.send('revoke', priority=PRIORITY_HIGH)
+    assert asyncio.run(receiver.receive()) == b'revoke'
+    got = [asyncio.run(receiver.receive()) for _ in range(2)]
+    # A message that arrives mid-drain is noticed on the next receive.
+    alice.send('urgent', id='x', priority=PRIORITY_HIGH)
+    got += asyncio.run(receiver.receive_many())
+    assert got[2] == b'urgent'
+    del got[2]
+    assert got == [('a%d' % i).encode('ascii') for i in range(22)] + [('b%d' % i).encode('ascii') for i in range(20)]
+
+
+def test_ordered_filter(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False, ordered=True)
+    sender.send('1', id='x1')
+    sender.send('2', id='y1')
+    sender.send('3', id='x2')
+    assert asyncio.run(receiver.receive('x')) == b'1'
+    assert asyncio.run(receiver.receive('x')) == b'3'
+    assert asyncio.run(receiver.receive('x')) is None
+    assert asyncio.run(receiver.receive()) == b'2'
+
+
+def test_ordered_watch(scratch_space, watcher_kind):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False, ordered=True)
+    for i in range(5):
+        sender.send(str(i))
+    sender.send('first', priority=PRIORITY_HIGH)
+
+    async def run():
+        messages = receiver.watch(poll_interval=0.01)
+        got = [await asyncio.wait_for(messages.__anext__(), 5) for _ in range(6)]
+        await messages.aclose()
+        return got
+
+    assert asyncio.run(run()) == [b'first', b'0', b'1', b'2', b'3', b'4']
+
+
+def test_many_channels_concurrently(scratch_space):
+    folders = []
+    for i in range(50):
+        folders.append(os.path.join(scratch_space.name, str(i)))
+        os.mkdir(folders[-1])
+        Channel(folders[-1], is_destward=True).send_many(['x%d' % i, 'y%d' % i])
+    receivers = [Channel(folder, is_destward=False) for folder in folders]
+
+    async def drain(channel):
+        got = []
+        while await channel.apeek():
+            got.append(await channel.receive())
+        return got
+
+    async def run():
+        return await asyncio.gather(*[drain(r) for r in receivers])
+
+    results = asyncio.run(run())
+    assert results == [[('x%d' % i).encode('ascii'), ('y%d' % i).encode('ascii')] for i in range(50)]
+
+
+def test_claim_ack_release(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    sender.send('one', id='1')
+    sender.send_many(['two', 'three'], id='2')
+    first = asyncio.run(receiver.claim('1'))
+    assert first.messages == [b'one']
+    # Claimed files aren't visible to other consumers...
+    assert not receiver.peek('1')
+    batch = asyncio.run(receiver.claim())
+    assert batch.messages == [b'two', b'three']
+    assert asyncio.run(receiver.claim()) is None
+    # ...until they're released.
+    assert batch.release()
+    assert asyncio.run(receiver.receive_many()) == [b'two', b'three']
+    assert first.extend()
+    assert first.ack()
+    assert not first.ack()
+    assert os.listdir(scratch_space.name) == []
+
+
+def test_claim_lease_expires(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    crashed = Channel(scratch_space.name, is_destward=False)
+    survivor = Channel(scratch_space.name, is_destward=False, lease=0.05)
+    sender.send('work')
+    claim = asyncio.run(crashed.claim(lease=0.05))
+    assert asyncio.run(survivor.receive()) is None
+    time.sleep(0.1)
+    assert asyncio.run(survivor.receive()) == b'work'
+    # The crashed consumer comes back, too late.
+    assert not claim.ack()
+
+
+def test_competing_consumers(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    for i in range(300):
+        sender.send(str(i))
+    consumers = [Channel(scratch_space.name, is_destward=False) for _ in range(4)]
+    results = [[] for _ in consumers]
+
+    def drain(channel, got):
+        while True:
+            data = asyncio.run(channel.receive())
+            if data is None:
+                return
+            got.append(data)
+
+    threads = [threading.Thread(target=drain, args=args) for args in zip(consumers, results)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    got = [data for result in results for data in result]
+    assert sorted(got) == sorted(str(i).encode('ascii') for i in range(300))
+
+
+def test_watch_keeps_what_it_does_not_yield(scratch_space, watcher_kind):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    for i in range(5):
+        sender.send(str(i))
+
+    async def run():
+        async for data in receiver.watch(poll_interval=0.01):
+            break
+        return [data] + await receiver.receive_many()
+
+    assert sorted(asyncio.run(run())) == [str(i).encode('ascii') for i in range(5)]
+
+
+def test_partly_received_batch_survives_a_crash(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    crashed = Channel(scratch_space.name, is_destward=False, lease=0.05)
+    sender.send_many(['a', 'b', 'c'])
+    assert asyncio.run(crashed.receive()) == b'a'
+    # The batch stays on disk, claimed, until its last message is received.
+    assert len(os.listdir(scratch_space.name)) == 1
+    time.sleep(0.1)
+    survivor = Channel(scratch_space.name, is_destward=False)
+    assert asyncio.run(survivor.receive_many()) == [b'a', b'b', b'c']
+    assert os.listdir(scratch_space.name) == []
+    with pytest.raises(ValueError):
+        sender.send('x', id='sneaky' + folder_channel.BATCH_MARK)
+
+
+def test_expired_batch_is_dropped_not_delivered_twice_by_one_receiver(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    a = Channel(scratch_space.name, is_destward=False, lease=0.2)
+    b = Channel(scratch_space.name, is_destward=False, lease=0.2)
+    sender.send_many(['m1', 'm2', 'm3'])
+    assert asyncio.run(a.receive()) == b'm1'
+    time.sleep(0.3)
+    # a's lease ran out, so b gets the whole batch again, and a drops its rest.
+    assert asyncio.run(b.receive_many()) == [b'm1', b'm2', b'm3']
+    assert asyncio.run(a.receive()) is None
+    assert os.listdir(scratch_space.name) == []
+
+
+def test_receiving_renews_a_held_batch(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    a = Channel(scratch_space.name, is_destward=False, lease=0.4)
+    b = Channel(scratch_space.name, is_destward=False, lease=0.4)
+    sender.send_many(['m1', 'm2', 'm3'])
+    got = [asyncio.run(a.receive())]
+    time.sleep(0.3)
+    got.append(asyncio.run(a.receive()))
+    time.sleep(0.3)
+    # Past the first lease, but the second receive renewed it.
+    assert asyncio.run(b.receive_many()) == []
+    got.append(asyncio.run(a.receive()))
+    assert got == [b'm1', b'm2', b'm3']
+    assert os.listdir(scratch_space.name) == []
+
+
+def test_batch_acked_once_received(scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    sender.send_many(['a', 'b'])
+    assert asyncio.run(receiver.receive()) == b'a'
+    assert asyncio.run(receiver.receive()) == b'b'
+    assert os.listdir(scratch_space.name) == []
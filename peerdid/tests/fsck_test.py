@@ -0,0 +1,69 @@
+import os
+
+from ..delta import Delta
+from ..diddoc import get_predefined
+from ..file import File
+from ..fsck import fsck, DUPLICATE, TORN_TAIL, MISNAMED, BAD_LINE
+
+
+def make_damaged_repo(repo):
+    did_1 = repo.new_doc(get_predefined('1'))
+    did_2 = repo.new_doc(get_predefined('2'))
+    f1 = repo.get_doc(did_1).file
+    f1.append(Delta('{"deleted": ["key-1"]}', []))
+    with open(f1.path, 'at') as f:
+        f.write(f1.deltas[1].to_json() + '\n')
+        f.write('{"change": "eyJk')
+    f2 = repo.get_doc(did_2).file
+    os.rename(f2.path, os.path.join(repo.path, 'wrong.diddocdeltas'))
+    return f1.path, f2.path
+
+
+def kinds(problems):
+    return sorted((os.path.basename(p.path), p.kind, p.repaired) for p in problems)
+
+
+def test_clean_repo_has_no_problems(scratch_repo):
+    scratch_repo.new_doc(get_predefined('1'))
+    assert list(fsck(scratch_repo, max_workers=1)) == []
+
+
+def test_fsck_finds_problems(scratch_repo):
+    path_1, _ = make_damaged_repo(scratch_repo)
+    fname_1 = os.path.basename(path_1)
+    assert kinds(fsck(scratch_repo, max_workers=1)) == [
+        (fname_1, DUPLICATE, False), (fname_1, TORN_TAIL, False), ('wrong.diddocdeltas', MISNAMED, False)]
+
+
+def test_fsck_repairs_in_process_pool(scratch_repo):
+    path_1, path_2 = make_damaged_repo(scratch_repo)
+    assert all(p.repaired for p in fsck(scratch_repo, repair=True, max_workers=2))
+    assert list(fsck(scratch_repo, max_workers=1)) == []
+    assert len(File(path_1).deltas) == 2
+    assert os.path.isfile(path_2)
+
+
+def test_bad_line_in_middle_is_reported_not_removed(scratch_repo):
+    did = scratch_repo.new_doc(get_predefined('1'))
+    path = scratch_repo.get_doc(did).file.path
+    with open(path, 'at') as f:
+        f.write('{"nonsense": true}\n')
+        f.write(Delta('{"deleted": ["key-1"]}', []).to_json() + '\n')
+    problems = list(fsck(scratch_repo, repair=True, max_workers=1))
+    assert [(p.kind, p.repaired) for p in problems] == [(BAD_LINE, False)]
+
+
+def test_misnamed_copies_never_overwrite(scratch_repo):
+    did = scratch_repo.new_doc(get_predefined('1'))
+    path = scratch_repo.get_doc(did).file.path
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.remove(path)
+    for name in ['copy1.diddocdeltas', 'copy2.diddocdeltas']:
+        with open(os.path.join(scratch_repo.path, name), 'wb') as f:
+            f.write(data)
+    # One file per batch, so the copies are repaired in different workers.
+    problems = list(fsck(scratch_repo, repair=True, max_workers=2, batch_size=1))
+    assert sorted(p.repaired for p in problems) == [False, True]
+    left = [os.path.basename(p.path) for p in problems if not p.repaired]
+    assert sorted(os.listdir(scratch_repo.path)) == sorted([os.path.basename(path)] + left)
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import random
+
+from .. import metrics
+from ..delta import Delta
+from ..ingest import Ingester, encode_message, _decode
+from ..repo import Repo
+from ..sync.folder_channel import Channel
+from ..workload import Workload
+
+
+def _setup(scratch_space):
+    folder = os.path.join(scratch_space.name, 'channel')
+    os.mkdir(folder)
+    repo = Repo(os.path.join(scratch_space.name, 'repo'))
+    # Ordered, so each DID's genesis arrives before its other deltas.
+    return repo, Channel(folder, is_destward=True), Channel(folder, is_destward=False, ordered=True)
+
+
+def _ingest(repo, receiver, **kwargs):
+    ingester = Ingester(repo, receiver, **kwargs)
+    try:
+        return asyncio.run(ingester.run(idle_timeout=0))
+    finally:
+        ingester.close()
+
+
+def test_ingest(scratch_space):
+    repo, sender, receiver = _setup(scratch_space)
+    histories = list(Workload(seed=1).histories(5, 6))
+    dids = ['did:peer:1z' + h[0].encnumbasis for h in histories]
+    # Genesis plus a couple of deltas, one message per delta, then the rest as one batch.
+    for did, history in zip(dids, histories):
+        for d in history[:3]:
+            sender.send(encode_message(did, d))
+    sender.send_many([encode_message(did, history[3:]) for did, history in zip(dids, histories)])
+    # Redelivered duplicates are harmless.
+    sender.send(encode_message(dids[0], histories[0][1]))
+    stats = _ingest(repo, receiver, batch_size=4, max_pending=2)
+    assert stats['messages'] == 5 * 3 + 5 + 1
+    assert stats['new_deltas'] == sum(len(h) for h in histories)
+    assert stats['rejected'] == 0
+    assert os.listdir(receiver.folder) == []
+    for did, history in zip(dids, histories):
+        assert repo.get_doc(did).file.deltas == history
+
+
+def test_ingest_rejects(scratch_space):
+    metrics.enable()
+    try:
+        repo, sender, receiver = _setup(scratch_space)
+        history = next(iter(Workload(seed=2).histories(1, 2)))
+        did = 'did:peer:1z' + history[0].encnumbasis
+        sender.send('not json')
+        sender.send(json.dumps({'did': 'did:example:123', 'deltas': []}))
+        # No genesis for an unknown DID.
+        sender.send(encode_message(did, history[1:]))
+        sender.send(encode_message(did, Delta({'publicKey': 'oops'}, [])))
+        # Corrupt compressed data is rejected, not fatal.
+        sender.send(b'\x00PDZ\x01garbage')
+        reasons = []
+        stats = _ingest(repo, receiver, on_reject=reasons.append)
+        assert stats['rejected'] == 4 and len(reasons) == 4
+        assert stats['waiting'] == len(history) - 1 and stats['new_deltas'] == 0
+        assert receiver.peek()
+        sender.send(encode_message(did, history[0]))
+        stats = _ingest(repo, receiver)
+        assert stats['rejected'] == 0 and stats['new_deltas'] == len(history)
+        assert metrics.registry.counter('ingest_rejected') == 4
+        assert metrics.registry.timing('ingest_commit')[0] >= 1
+        assert repo.get_doc(did).file.deltas == history
+        assert os.listdir(receiver.folder) == []
+    finally:
+        metrics.disable()
+
+
+def test_ingest_rejects_malformed(scratch_space):
+    repo, sender, receiver = _setup(scratch_space)
+    history = next(iter(Workload(seed=2).histories(1, 1)))
+    did = 'did:peer:1z' + history[0].encnumbasis
+    good = history[0].to_dict()
+    bad = [[], 1, {'did': 1, 'deltas': []}, {'did': did, 'deltas': 1}, {'did': did, 'deltas': [1]},
+           {'did': did}, {'did': did, 'delta': dict(good, change=1)}, {'did': did, 'delta': dict(good, by='x')},
+           {'did': did, 'delta': dict(good, when=[])}]
+    for msg in bad:
+        sender.send(json.dumps(msg))
+    reasons = []
+    stats = _ingest(repo, receiver, on_reject=reasons.append)
+    assert stats['rejected'] == len(bad) and all(r.startswith('ValueError') for r in reasons)
+    assert os.listdir(receiver.folder) == []
+
+
+def test_decode_rejects_truncated_payload():
+    groups, _, rejects = _decode([b'\x00PDZ'], check=True)
+    assert groups == {} and rejects == ['ValueError: Truncated compressed payload.']
+
+
+def test_ingest_compressed(scratch_space):
+    repo, sender, receiver = _setup(scratch_space)
+    history = next(iter(Workload(seed=3).histories(1, 3)))
+    did = 'did:peer:1z' + history[0].encnumbasis
+    sender.send(encode_message(did, history, compress=True))
+    stats = _ingest(repo, receiver, compress=True)
+    assert stats['new_deltas'] == len(history)
+    stored = repo.get_doc(did).file.deltas
+    assert all(d.compressed for d in stored)
+    assert [d.change_json_bytes for d in stored] == [d.change_json_bytes for d in history]
+    assert repo.resolve(did)
+
+
+def test_ingest_unordered(scratch_space):
+    folder = os.path.join(scratch_space.name, 'channel')
+    os.mkdir(folder)
+    repo = Repo(os.path.join(scratch_space.name, 'repo'))
+    sender = Channel(folder, is_destward=True)
+    histories = list(Workload(seed=4).histories(4, 5))
+    dids = ['did:peer:1z' + h[0].encnumbasis for h in histories]
+    # One message per delta, each DID's genesis sent last, on an unordered channel.
+    messages = [(did, d) for did, history in zip(dids, histories) for d in history[1:] + history[:1]]
+    for did, d in random.Random(4).sample(messages, len(messages)):
+        sender.send(encode_message(did, d))
+    stats = _ingest(repo, Channel(folder, is_destward=False), batch_size=2, max_pending=1)
+    assert stats['rejected'] == 0
+    assert stats['new_deltas'] == len(messages)
+    assert os.listdir(folder) == []
+    for did, history in zip(dids, histories):
+        assert sorted(d.hash for d in repo.get_doc(did).file.deltas) == sorted(d.hash for d in history)
+        assert repo.get_doc(did).file.deltas[0] == history[0]
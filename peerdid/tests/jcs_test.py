@@ -0,0 +1,30 @@
+import pytest
+
+from ..jcs import canonicalize
+
+
+def test_sorted_keys_no_whitespace():
+    assert canonicalize({"b": [1, 2, {"d": None, "c": True}], "a": "x"}) == \
+        b'{"a":"x","b":[1,2,{"c":true,"d":null}]}'
+
+
+def test_keys_sorted_by_utf16_code_units():
+    # U+1F600 is a surrogate pair in UTF-16, so it sorts before U+FB33.
+    assert canonicalize({"דּ": 1, "\U0001f600": 2}) == '{"\U0001f600":2,"דּ":1}'.encode('utf-8')
+
+
+def test_strings_escape_only_what_is_required():
+    assert canonicalize("€\"\\\n\x1f/") == '"€\\"\\\\\\n\\u001f/"'.encode('utf-8')
+
+
+def test_numbers_use_ecmascript_format():
+    values = [0.0, -0.0, 1.0, -1.5, 1e21, 1e20, 1e-6, 1e-7, 0.00001, 123456789012345680000.0,
+              333333333.3333333, 5e-324, 1.7976931348623157e308]
+    expected = ['0', '0', '1', '-1.5', '1e+21', '100000000000000000000', '0.000001', '1e-7', '0.00001',
+                '123456789012345680000', '333333333.3333333', '5e-324', '1.7976931348623157e+308']
+    assert [canonicalize(v).decode('ascii') for v in values] == expected
+
+
+def test_nan_rejected():
+    with pytest.raises(ValueError):
+        canonicalize(float('nan'))
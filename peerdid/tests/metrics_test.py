@@ -0,0 +1,77 @@
+import json
+import os
+import pytest
+import urllib.request
+
+from .. import metrics
+from ..delta import Delta
+from ..diddoc import get_predefined
+from ..file import File, DELTAS_EXT
+
+
+@pytest.fixture
+def registry():
+    yield metrics.enable()
+    metrics.disable()
+
+
+def test_disabled_by_default(scratch_repo):
+    assert metrics.registry is None
+    did = scratch_repo.new_doc(get_predefined('1'))
+    scratch_repo.resolve(did)
+
+
+def test_hot_paths_recorded(registry, scratch_repo):
+    doc = json.loads(get_predefined('1'))
+    del doc['id']
+    did = scratch_repo.new_doc(doc)
+    assert scratch_repo.resolve(did)
+    assert scratch_repo.resolve(did[:-1] + ('2' if did[-1] != '2' else '3')) is None
+    assert registry.counter('repo_lookup_hit') == 1
+    assert registry.counter('repo_lookup_miss') == 1
+    assert registry.timing('file_save')[0] == 1
+    assert registry.counter('file_save_bytes') == os.path.getsize(scratch_repo.get_doc(did).path)
+    assert registry.timing('file_load')[0] >= 1
+    assert registry.timing('delta_decode')[0] >= 1
+    assert registry.timing('diddoc_resolve')[0] == 1
+    assert registry.counter('delta_hash_cache_miss') >= 1
+    assert registry.counter('delta_hash_cache_hit') >= 1
+
+
+def test_load_counts_no_cache_hits(registry, scratch_space):
+    path = os.path.join(scratch_space.name, 'x' + DELTAS_EXT)
+    f = File(path)
+    f.extend([Delta({'n': i}, []) for i in range(5)])
+    registry.reset()
+    f = File(path)
+    assert registry.counter('delta_hash_cache_miss') == 5
+    assert registry.counter('delta_hash_cache_hit') == 0
+    f.snapshot
+    assert f.contains(f.deltas[0].hash)
+    assert registry.counter('delta_hash_cache_hit') == 1
+
+
+def test_prometheus_export(registry, scratch_space):
+    registry.inc('file_load_bytes', 10)
+    registry.observe('file_load', 0.5)
+    registry.observe('file_load', 1.5)
+    text = registry.to_prometheus()
+    assert 'peerdid_file_load_bytes_total 10' in text
+    assert 'peerdid_file_load_seconds_count 2' in text
+    assert 'peerdid_file_load_seconds_sum 2.0' in text
+    assert 'peerdid_file_load_seconds_max 1.5' in text
+    path = os.path.join(scratch_space.name, 'peerdid.prom')
+    registry.write_prometheus(path)
+    with open(path, 'rt') as f:
+        assert f.read() == text
+
+
+def test_serve(registry):
+    registry.inc('x')
+    server = registry.serve()
+    try:
+        url = 'http://%s:%d/metrics' % server.server_address
+        with urllib.request.urlopen(url) as response:
+            assert b'peerdid_x_total 1' in response.read()
+    finally:
+        server.shutdown()
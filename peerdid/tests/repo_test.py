@@ -81,4 +81,20 @@ def test_get_state_for_2_normal_dids(scratch_space, scratch_file, scratch_repo):
     assert did_a in a
     assert did_b in b
     assert a[did_a] == '4GKyAZVLGaSvb81v6RA3acWRzhV5vhzhHNzBCyri2Ek='
-    assert b[did_b] == 'qWlggN0vuqzOtWEo_37lb5yHVHku5H7lFcYODMaR5-k='
\ No newline at end of file
+    assert b[did_b] == 'qWlggN0vuqzOtWEo_37lb5yHVHku5H7lFcYODMaR5-k='
+
+def test_scan_loads_and_hashes_every_file(scratch_repo):
+    dids = {scratch_repo.new_doc(get_predefined(c)) for c in '123'}
+    files = list(scratch_repo.scan(max_workers=2, window=2))
+    assert {f.did for f in files} == dids
+    assert all(d._hash is not None for f in files for d in f.deltas)
+
+
+def test_compact_in_background(scratch_repo):
+    did = scratch_repo.new_doc(get_predefined('1'))
+    scratch_repo.new_doc(get_predefined('2'))
+    f = scratch_repo.get_doc(did).file
+    for i in range(3):
+        f.append(Delta({'deleted': ['key-%d' % i]}, []))
+    assert scratch_repo.compact_in_background(min_deltas=3).result(timeout=10) == 1
+    assert len(scratch_repo.get_doc(did).file.deltas) == 2
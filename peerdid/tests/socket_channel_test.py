@@ -0,0 +1,80 @@
+import asyncio
+import os
+import pytest
+import socket
+import time
+
+from ..sync.folder_channel import Channel
+from ..sync.socket_channel import SocketChannel
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+@pytest.fixture
+def pair(scratch_space):
+    relay = SocketChannel(scratch_space.name, is_destward=True)
+    agent = SocketChannel(scratch_space.name, is_destward=False)
+    yield relay, agent
+    relay.close()
+    agent.close()
+
+
+def test_round_trip(pair):
+    relay, agent = pair
+    for i in range(100):
+        relay.send('msg%d' % i, id='m%d' % i)
+    assert _wait_for(lambda: agent.peek('m99'))
+    assert not relay.peek()
+    assert asyncio.run(agent.receive('m50')) == b'msg50'
+    got = []
+    while agent.peek():
+        got.append(asyncio.run(agent.receive()))
+    assert got == [('msg%d' % i).encode('ascii') for i in range(100) if i != 50]
+    agent.send(b'\x00' * 200000)
+    assert _wait_for(relay.peek)
+    assert asyncio.run(relay.receive()) == b'\x00' * 200000
+    assert asyncio.run(relay.receive()) is None
+    # Nothing went through the file system.
+    assert not [f for f in os.listdir(relay.folder) if not f.endswith('.sock')]
+
+
+def test_fallback_to_folder(scratch_space):
+    with SocketChannel(scratch_space.name, is_destward=True) as relay:
+        relay.send('offline')
+        assert Channel(scratch_space.name, is_destward=False).peek()
+        with SocketChannel(scratch_space.name, is_destward=False) as agent:
+            assert agent.peek()
+            assert asyncio.run(agent.receive()) == b'offline'
+            relay.send('online')
+            assert _wait_for(agent.peek)
+            assert asyncio.run(agent.receive()) == b'online'
+    with SocketChannel(scratch_space.name, is_destward=True, fallback=False) as relay:
+        with pytest.raises(OSError):
+            relay.send('nobody home')
+
+
+def test_close_removes_socket(scratch_space):
+    channel = SocketChannel(scratch_space.name, is_destward=False)
+    assert os.path.exists(channel.read_path)
+    channel.close()
+    assert not os.path.exists(channel.read_path)
+
+
+def test_stale_socket_replaced_live_one_kept(scratch_space):
+    with SocketChannel(scratch_space.name, is_destward=False) as live:
+        with pytest.raises(OSError):
+            SocketChannel(scratch_space.name, is_destward=False)
+        assert os.path.exists(live.read_path)
+    # A socket file whose listener died without cleaning up.
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(live.read_path)
+    stale.close()
+    with SocketChannel(scratch_space.name, is_destward=False) as agent:
+        with SocketChannel(scratch_space.name, is_destward=True, fallback=False) as relay:
+            relay.send('hi')
+            assert _wait_for(agent.peek)
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import pytest
+
+from .. import tracing
+from ..delta import Delta
+from ..diddoc import get_predefined
+from ..sync.folder_channel import Channel
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemoryExporter()
+    tracing.set_tracer(tracing.Tracer(exporter))
+    yield exporter
+    tracing.set_tracer(None)
+
+
+def test_noop_by_default(scratch_repo):
+    assert isinstance(tracing.get_tracer(), tracing.NoopTracer)
+    did = scratch_repo.new_doc(get_predefined('1'))
+    assert scratch_repo.resolve(did)
+
+
+def test_resolve_spans(exporter, scratch_repo):
+    doc = json.loads(get_predefined('1'))
+    del doc['id']
+    did = scratch_repo.new_doc(doc)
+    scratch_repo.get_doc(did).append(Delta('{"deleted": ["key-1"]}', []))
+    exporter.clear()
+    scratch_repo.resolve(did)
+    by_name = {span.name: span for span in exporter.spans}
+    assert set(by_name) == {'Repo.resolve', 'File.load', 'File.read', 'File.parse', 'File.hash', 'DIDDoc.resolve'}
+    root = by_name['Repo.resolve']
+    assert root.parent_id is None
+    assert by_name['File.load'].parent_id == root.span_id
+    assert by_name['File.read'].parent_id == by_name['File.load'].span_id
+    assert by_name['DIDDoc.resolve'].parent_id == root.span_id
+    assert by_name['DIDDoc.resolve'].attributes['peerdid.deltas_replayed'] == 1
+    assert by_name['DIDDoc.resolve'].attributes['peerdid.did'] == did
+    assert all(span.trace_id == root.trace_id and span.duration_ns >= 0 for span in exporter.spans)
+
+
+def test_exceptions_recorded(exporter):
+    with pytest.raises(ValueError):
+        with tracing.get_tracer().start_as_current_span('boom'):
+            raise ValueError('x')
+    span = exporter.spans[0]
+    assert span.status == 'ERROR'
+    assert span.events[0][0] == 'exception'
+
+
+def test_channel_spans(exporter, scratch_space):
+    sender = Channel(scratch_space.name, is_destward=True)
+    receiver = Channel(scratch_space.name, is_destward=False)
+    sender.send('hello')
+    assert asyncio.run(receiver.receive()) == b'hello'
+    assert [(s.name, s.attributes['peerdid.bytes']) for s in exporter.spans] == \
+        [('Channel.send', 5), ('Channel.receive', 5)]
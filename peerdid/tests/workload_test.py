@@ -0,0 +1,34 @@
+import os
+
+from ..diddoc import validate
+from ..workload import Workload
+
+
+def test_same_seed_same_histories():
+    a = [[d.to_json() for d in h] for h in Workload(seed=7).histories(3, 10)]
+    b = [[d.to_json() for d in h] for h in Workload(seed=7).histories(3, 10)]
+    c = [[d.to_json() for d in h] for h in Workload(seed=8).histories(3, 10)]
+    assert a == b
+    assert a != c
+
+
+def test_histories_are_in_time_order():
+    for history in Workload(seed=1).histories(2, 20):
+        whens = [d.when for d in history]
+        assert whens == sorted(whens)
+
+
+def test_populate_writes_valid_docs(scratch_repo):
+    dids = Workload(seed=1, keys=4, services=2, rules=3).populate(scratch_repo, 5, 30)
+    assert len(os.listdir(scratch_repo.path)) == 5
+    for did in dids:
+        doc = scratch_repo.get_doc(did)
+        assert len(doc.file.deltas) == 31
+        validate(doc.resolve())
+
+
+def test_stream_appends_to_repo(scratch_repo):
+    items = list(Workload(seed=2).stream(scratch_repo, dids=3, count=12))
+    assert len(items) == 12
+    total = sum(len(scratch_repo.get_doc(did).file.deltas) for did in {did for did, _ in items})
+    assert total == len({did for did, _ in items}) + 12
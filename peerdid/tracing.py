@@ -0,0 +1,147 @@
+"""
+Optional per-operation tracing. The API is a small subset of OpenTelemetry's
+(tracer.start_as_current_span(), span.set_attribute(), span.add_event()), so an
+OpenTelemetry tracer can be dropped in with set_tracer(). By default a no-op
+tracer is installed. For tests and ad hoc diagnosis, Tracer plus
+InMemoryExporter records finished spans in process:
+
+    exporter = tracing.InMemoryExporter()
+    tracing.set_tracer(tracing.Tracer(exporter))
+    repo.resolve(did)
+    for span in exporter.spans:
+        print(span.name, span.duration_ns, span.attributes)
+"""
+
+import contextlib
+import contextvars
+import random
+import threading
+import time
+
+
+_current_span = contextvars.ContextVar('peerdid_current_span', default=None)
+
+
+class Span:
+    def __init__(self, name: str, trace_id: int, span_id: int, parent_id: int = None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes) if attributes else {}
+        self.events = []
+        self.status = 'OK'
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes: dict):
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, attributes: dict = None):
+        self.events.append((name, time.time_ns(), dict(attributes) if attributes else {}))
+
+    def record_exception(self, exception: BaseException):
+        self.add_event('exception', {'exception.type': type(exception).__name__, 'exception.message': str(exception)})
+
+    def is_recording(self) -> bool:
+        return self.end_time_ns is None
+
+    def end(self):
+        if self.end_time_ns is None:
+            self.end_time_ns = time.time_ns()
+
+    @property
+    def duration_ns(self) -> int:
+        if self.end_time_ns is not None:
+            return self.end_time_ns - self.start_time_ns
+
+    def __repr__(self):
+        return 'Span(%r, %s)' % (self.name, self.attributes)
+
+
+class InMemoryExporter:
+    """Collects finished spans in a list."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def export(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class Tracer:
+    def __init__(self, exporter=None):
+        self.exporter = exporter if exporter is not None else InMemoryExporter()
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name: str, attributes: dict = None):
+        parent = _current_span.get()
+        span = Span(name, parent.trace_id if parent else random.getrandbits(128), random.getrandbits(64),
+                    parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            span.status = 'ERROR'
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+            self.exporter.export([span])
+
+
+class _NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def is_recording(self):
+        return False
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+_noop_span = _NoopSpan()
+
+
+class NoopTracer:
+    def start_as_current_span(self, name, attributes=None):
+        return _noop_span
+
+
+# Instrumented code reads this directly.
+tracer = NoopTracer()
+
+
+def set_tracer(t):
+    """Install a tracer (None restores the no-op default)."""
+    global tracer
+    tracer = t if t is not None else NoopTracer()
+
+
+def get_tracer():
+    return tracer
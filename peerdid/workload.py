@@ -0,0 +1,185 @@
+"""
+Generates reproducible, synthetic DID histories for benchmarks and load tests.
+Genesis docs have a configurable number of keys, services and authorization
+rules; later deltas model the operations real agents perform (adding keys,
+rotating them via "deleted", changing rules, moving endpoints).
+"""
+
+import base58
+from datetime import datetime, timedelta
+import os
+import random
+import time
+
+from .delta import Delta
+from .file import File, canonical_fname
+
+
+# Relative frequency of each kind of operation in generated histories.
+DEFAULT_WEIGHTS = {
+    'add_key': 1,
+    'rotate_key': 4,
+    'add_rule': 1,
+    'remove_rule': 1,
+    'update_endpoint': 2,
+}
+
+_KEY_TYPE = 'Ed25519VerificationKey2018'
+_PRIVILEGES = ['register', 'route', 'authcrypt', 'plaintext', 'sign', 'key_admin', 'se_admin', 'rule_admin']
+_ROLES = ['edge', 'cloud', 'offline']
+# Same layout as datetime.isoformat(), but always with microseconds, so that
+# "when" values sort correctly as strings (DIDDoc.resolve compares them that way).
+_WHEN_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class _DIDState:
+    """What the generator needs to remember about one DID to produce valid deltas for it."""
+    def __init__(self, genesis: Delta, keys, services, rules, next_id):
+        self.genesis = genesis
+        self.keys = keys
+        self.services = services
+        self.rules = rules
+        self.next_id = next_id
+
+    @property
+    def did(self):
+        return 'did:peer:1z' + self.genesis.encnumbasis
+
+
+class Workload:
+    def __init__(self, seed=0, keys: int = 3, services: int = 1, rules: int = 2, weights: dict = None,
+                 start: str = '2020-01-01T00:00:00.000000', mean_gap_seconds: float = 3600):
+        """
+        :param seed: Same seed, same arguments => same DIDs and deltas.
+        :param keys, services, rules: Size of each genesis doc.
+        :param weights: Relative frequency of operations; see DEFAULT_WEIGHTS.
+        :param start: Time of the first delta.
+        :param mean_gap_seconds: Average time between consecutive deltas.
+        """
+        self.rand = random.Random(seed)
+        self.keys = keys
+        self.services = services
+        self.rules = rules
+        weights = weights or DEFAULT_WEIGHTS
+        self._ops = list(weights.keys())
+        self._weights = [weights[op] for op in self._ops]
+        self._clock = datetime.strptime(start, _WHEN_FORMAT)
+        self._mean_gap = mean_gap_seconds
+
+    def _when(self):
+        self._clock += timedelta(seconds=self.rand.expovariate(1 / self._mean_gap))
+        return self._clock.strftime(_WHEN_FORMAT)
+
+    def _key(self, n):
+        material = bytes(self.rand.getrandbits(8) for _ in range(32))
+        return {'id': 'key-%d' % n, 'type': _KEY_TYPE, 'publicKeyBase58': base58.b58encode(material).decode('ascii')}
+
+    def _profile(self, n):
+        return {'key': '#key-%d' % n, 'roles': [self.rand.choice(_ROLES)]}
+
+    def _rule(self, n, key_ids):
+        return {
+            'id': 'rule-%d' % n,
+            'grant': self.rand.sample(_PRIVILEGES, self.rand.randint(1, 3)),
+            'when': {'id': '#' + self.rand.choice(key_ids)} if key_ids else {'roles': self.rand.choice(_ROLES)},
+        }
+
+    def _service(self, n):
+        return {
+            'id': 'service-%d' % n,
+            'type': 'did-communication',
+            'serviceEndpoint': 'https://agent%d.example.com:%d' % (self.rand.randint(1, 99999), self.rand.randint(1024, 65535)),
+        }
+
+    def new_did(self) -> _DIDState:
+        keys = [self._key(n) for n in range(self.keys)]
+        key_ids = [k['id'] for k in keys]
+        rules = [self._rule(n, key_ids) for n in range(self.rules)]
+        services = [self._service(n) for n in range(self.services)]
+        doc = {
+            '@context': 'https://w3id.org/did/v1',
+            'publicKey': keys,
+            'authentication': ['#' + kid for kid in key_ids],
+            'service': services,
+            'authorization': {
+                'profiles': [self._profile(n) for n in range(self.keys)],
+                'rules': rules,
+            },
+        }
+        genesis = Delta(doc, [], self._when())
+        return _DIDState(genesis, key_ids, [s['id'] for s in services], [r['id'] for r in rules],
+                         max(self.keys, self.services, self.rules))
+
+    def _add_key(self, state, change):
+        n = state.next_id
+        state.next_id += 1
+        change['publicKey'] = [self._key(n)]
+        change['authentication'] = ['#key-%d' % n]
+        change['authorization'] = {'profiles': [self._profile(n)]}
+        state.keys.append('key-%d' % n)
+
+    def next_delta(self, state: _DIDState) -> Delta:
+        """Generate the next delta in state's history, and update state to match."""
+        op = self.rand.choices(self._ops, self._weights)[0]
+        change = {}
+        if op == 'rotate_key' and state.keys:
+            change['deleted'] = [state.keys.pop(self.rand.randrange(len(state.keys)))]
+            self._add_key(state, change)
+        elif op == 'remove_rule' and state.rules:
+            change['deleted'] = [state.rules.pop(self.rand.randrange(len(state.rules)))]
+        elif op == 'add_rule':
+            n = state.next_id
+            state.next_id += 1
+            change['rules'] = [self._rule(n, state.keys)]
+            state.rules.append('rule-%d' % n)
+        elif op == 'update_endpoint' and state.services:
+            n = state.next_id
+            state.next_id += 1
+            change['deleted'] = [state.services.pop(self.rand.randrange(len(state.services)))]
+            change['service'] = [self._service(n)]
+            state.services.append('service-%d' % n)
+        else:
+            self._add_key(state, change)
+        return Delta(change, [], self._when())
+
+    def histories(self, dids: int, deltas_per_did: int):
+        """Yield dids lists of deltas, each a genesis delta followed by deltas_per_did more."""
+        for _ in range(dids):
+            state = self.new_did()
+            yield [state.genesis] + [self.next_delta(state) for _ in range(deltas_per_did)]
+
+    def populate(self, repo, dids: int, deltas_per_did: int) -> list:
+        """
+        Write generated histories straight into repo, one write per DID (rather
+        than one per delta). Returns the DIDs.
+        """
+        if not os.path.isdir(repo.path):
+            os.mkdir(repo.path)
+        result = []
+        for history in self.histories(dids, deltas_per_did):
+            f = File(os.path.join(repo.path, canonical_fname(history[0].encnumbasis)))
+            f.extend(history)
+            result.append(f.did)
+        return result
+
+    def stream(self, repo=None, dids: int = 10, count: int = None, interval: float = 0):
+        """
+        For soak tests: create dids DIDs, then yield (did, delta) pairs for
+        randomly chosen DIDs, forever or until count deltas have been produced,
+        sleeping interval seconds between them. If repo is given, genesis docs
+        and deltas are written to it as they're generated.
+        """
+        states = [self.new_did() for _ in range(dids)]
+        if repo is not None:
+            for state in states:
+                repo.new_doc(state.genesis)
+        n = 0
+        while count is None or n < count:
+            state = self.rand.choice(states)
+            delta = self.next_delta(state)
+            if repo is not None:
+                repo.get_doc(state.did).append(delta)
+            yield state.did, delta
+            n += 1
+            if interval:
+                time.sleep(interval)
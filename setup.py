@@ -3,9 +3,9 @@ from setuptools import setup
 import sys
 
 v = sys.version_info
-if sys.version_info < (3, 5):
+if sys.version_info < (3, 7):
     v = sys.version_info
-    print("FAIL: Requires Python 3.5 or later, but setup.py was run using %s.%s.%s" % (v.major, v.minor, v.micro))
+    print("FAIL: Requires Python 3.7 or later, but setup.py was run using %s.%s.%s" % (v.major, v.minor, v.micro))
     print("NOTE: Installation failed. Run setup.py using python3")
     sys.exit(1)
 
@@ -30,13 +30,16 @@ setup(
     classifiers=[
         "License :: OSI Approved :: Apache Software License",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Development Status :: 4 - Beta"
     ],
     packages=["peerdid"],
+    python_requires=">=3.7",
+    package_data={"peerdid": ["*.zdict"]},
     #include_package_data=True,      -- write a MANIFEST.in with glob patterns if uncommented
     install_requires=[],
+    entry_points={
+        'console_scripts': ['peerdid=peerdid.__main__:main'],
+    },
     download_url='https://github.com/evernym/pypeerdid/archive/v0.1.4.tar.gz',
 )
@@ -1,10 +1,12 @@
+import base64
+import bisect
 import copy
+import hashlib
 import json
 import os
 import random
 import re
 import threading
-import time
 
 try:
     # See if peerdid module is installed.
@@ -28,6 +30,24 @@ conn_pat = re.compile(r'([A-Z][.]\d)(\+-?\+|-\+|\+-)([A-Z].*)$')
 kid_pat = re.compile(r'"kid"\s*:\s*"([^"]+)"')
 
 
+def get_reachability(connections):
+    """
+    Parse connection strings once, into a dict that maps each agent id to the
+    set of ids it can reach.
+    """
+    reachability = {}
+    for conn in connections:
+        m = conn_pat.match(conn)
+        left = m.group(1)
+        rights = m.group(3).split(',')
+        if m.group(2).endswith('+'):
+            reachability.setdefault(left, set()).update(rights)
+        if m.group(2).startswith('+'):
+            for right in rights:
+                reachability.setdefault(right, set()).add(left)
+    return reachability
+
+
 def get_reachable(id, connections):
     reachable = []
     for conn in connections:
@@ -52,34 +72,78 @@ def get_relationship(my_party, all_parties):
     return '+'.join(all_parties)
 
 
+class _Endorsement:
+    """
+    What an agent knows about one m-of-n delta: who has endorsed it so far, how
+    many endorsements it needs, and from which group. text is the delta's
+    current form in the agent's delta list.
+    """
+    __slots__ = ['base', 'endorsers', 'n', 'group', 'text']
+
+    def __init__(self, text, base, endorsers, n, group):
+        self.text = text
+        self.base = base
+        self.endorsers = endorsers
+        self.n = n
+        self.group = group
+
+    def render(self):
+        self.text = '%s by {%s}/%s@%s' % (self.base, ','.join(sorted(self.endorsers)), self.n, self.group)
+        return self.text
+
+
 class Agent:
     """
     Represents an agent that's participating in the peer DID sync protocol.
     """
     all_lock = threading.Lock()
     all = []
-    thread_main = None
+    by_id = {}
     stdout = None
-    cmds_lock = threading.Lock()
-    cmds = []
+    # When a Scheduler is installed, commands and messages are queued for each
+    # agent and run by the scheduler's workers. Without one, they run on the
+    # caller's thread. Set jitter False to remove the random delays (before a
+    # scheduled agent handles a message) that vary event order.
+    scheduler = None
+    jitter = True
 
     def __init__(self, session_folder, key, all_genesis, connections):
+        """
+        :param connections: Connection strings, or the dict that get_reachability()
+          builds from them (cheaper when creating many agents).
+        """
         self.key = key
         self.repo = Repo(os.path.join(session_folder, self.id))
-        self.can_reach = get_reachable(self.id, connections)
-        self.cmd_idx = 0
-        self.thread = threading.Thread(target=Agent.thread_main, args=(self,), daemon=True)
+        if isinstance(connections, dict):
+            self.can_reach = sorted(connections.get(self.id, ()))
+        else:
+            self.can_reach = get_reachable(self.id, connections)
         self.dids_by_party = {}
+        self.groups = set()
         for genesis in all_genesis:
             did = self.repo.new_doc(genesis)
             m = kid_pat.search(genesis)
-            self.dids_by_party[m.group(1)[0]] = did
+            party = m.group(1)[0]
+            self.dids_by_party[party] = did
+            if party == self.party:
+                # Groups are named by the first letter of the roles this key holds.
+                for profile in json.loads(genesis).get('authorization', {}).get('profiles', []):
+                    if profile.get('key') == '#' + self.id:
+                        self.groups.update(role[0] for role in profile.get('roles', []))
         self.did = self.dids_by_party[self.party]
-        self.relationship = get_relationship(self.party, self.dids_by_party.keys())
+        self.relationship = get_relationship(self.party, list(self.dids_by_party.keys()))
+        self.deltas_lock = threading.Lock()
+        # Per party: the sorted list of deltas, a set of the same strings for
+        # fast membership tests, and an index of m-of-n deltas by base text.
+        self.deltas = {party: [] for party in self.dids_by_party}
+        self.known = {party: set() for party in self.dids_by_party}
+        self.endorsements = {party: {} for party in self.dids_by_party}
+        # Digest of each party's delta list (None when it needs recomputing).
+        self.digests = {party: None for party in self.dids_by_party}
         self.say("Ready to sync in the %s relationship." % self.relationship)
         with Agent.all_lock:
             Agent.all.append(self)
-        self.thread.start()
+            Agent.by_id[self.id] = self
 
     @property
     def id(self):
@@ -93,35 +157,56 @@ class Agent:
     def num(self):
         return self.id[2]
 
-    def next(self):
+    @property
+    def reachable(self):
+        with Agent.all_lock:
+            return [Agent.by_id[id] for id in self.can_reach if id in Agent.by_id]
+
+    def post(self, func, *args, delay: float = 0):
+        """
+        Run func(*args) on this agent's behalf: via the scheduler (after delay
+        seconds), or right now.
+        """
+        if Agent.scheduler:
+            Agent.scheduler.post(self, func, *args, delay=delay)
+        else:
+            func(*args)
+
+    def _jitter(self):
+        # Introduce some randomness so order of events from other agents
+        # can vary.
+        return random.random() / 8 if Agent.jitter else 0
+
+    def command(self, rest):
+        """Queue a command (the part after "A.1:")."""
+        self.post(self.execute, rest)
+
+    def execute(self, rest):
+        """Run one command (the part after "A.1:") on the calling thread."""
         handled = True
-        cmd = self.cmds[self.cmd_idx]
-        if cmd.startswith(self.id):
-            rest = cmd[4:].lstrip()
-            m = simple_pat.match(rest)
+        m = simple_pat.match(rest)
+        if m:
+            self.simple(m.group(1))
+        elif rest.startswith('state'):
+            self.state()
+        elif rest.startswith('gossip'):
+            self.say('Gossipping.')
+            self.gossip()
+        elif rest.startswith('res'):
+            self.resolve(rest[rest.find(' ') + 1:].lstrip())
+        else:
+            m = add_rem_pat.match(rest)
             if m:
-                self.simple(m.group(1))
-            elif rest.startswith('state'):
-                self.state()
-            elif rest.startswith('gossip'):
-                self.say('Gossipping.')
-                self.gossip()
-            elif rest.startswith('res'):
-                self.resolve(rest[rest.find(' ') + 1:].lstrip())
-            else:
-                m = add_rem_pat.match(rest)
-                if m:
-                    if m.group(1) == 'add':
-                        self.add(m.group(2), m.group(5))
-                    elif m.group(1) == 'rem':
-                        self.rem(m.group(2), m.group(5))
-                    else:
-                        handled = False
+                if m.group(1) == 'add':
+                    self.add(m.group(2), m.group(5))
+                elif m.group(1) == 'rem':
+                    self.rem(m.group(2), m.group(5))
                 else:
                     handled = False
+            else:
+                handled = False
         if not handled:
-                self.say('Huh? Try "help".')
-        self.cmd_idx += 1
+            self.say('Huh? Try "help".')
 
     def simple(self, auth=None):
         """\
@@ -199,6 +284,9 @@ class Agent:
             short_snapshot = snapshot[:3] + '...' + snapshot[-3:]
             items.append('%s = %s' % (short_did, short_snapshot))
         items.sort()
+        # Simulated deltas aren't written to the repo, so summarize them too.
+        digest = hashlib.sha256(self.all_deltas.encode('utf-8')).hexdigest()
+        items.append('deltas = %s...%s' % (digest[:3], digest[-3:]))
         return '; '.join(items)
 
     def state(self):
@@ -216,61 +304,86 @@ class Agent:
         return self.id
 
     def receive(self, msg):
+        """Deliver a message ("A+delta") to this agent."""
+        self.post(self._receive, msg, delay=self._jitter())
+
+    def _receive(self, msg):
         party = msg[0]
         self.append_delta(msg[2:], party)
         self.say('Received delta. I now see ' + self.all_deltas)
-        # Introduce some randomness so order of events from other agents
-        # can vary.
-        time.sleep(random.random() / 8)
+
+    def receive_batch(self, batch):
+        """Deliver a batch of deltas (a dict of party -> deltas) to this agent."""
+        self.post(self._receive_batch, batch, delay=self._jitter())
+
+    def _receive_batch(self, batch):
+        count = self.merge(batch)
+        self.say('Received %d new delta(s) in a batch. I now see %s' % (count, self.all_deltas))
 
     def append_delta(self, delta, party=None):
+        """
+        Merge a delta into what we know, and return its merged form. An m-of-n
+        delta ("#abc by {A.1}/2@a") that we've seen before with different
+        endorsers is merged with the old form rather than added beside it, and
+        we endorse it ourselves if we're in its group and it needs more.
+        """
         if party is None:
             party = self.party
-        lst = self.deltas[party]
         with self.deltas_lock:
-            # Disregard deltas that we already know about.
-            if delta not in lst:
-                # Is this an m-of-n change?
-                match = m_of_n_of_group_pat.match(delta)
-                if match:
-                    # Figure out endorsers, n, and group name.
-                    endorsers = match.group(2).split(',') if match.group(2) else []
-                    n = int(match.group(3))
-                    group = match.group(4)
-                    # Do we already know about this delta, but with different
-                    # endorsers?
-                    old_idx = -1
-                    i = 0
-                    endorsers_updated = False
-                    for old in lst:
-                        if old.startswith(match.group(1)):
-                            old_match = m_of_n_of_group_pat.match(old)
-                            old_endorsers = old_match.group(2).split(',') if old_match.group(2) else []
-                            new_endorsers = sorted(list(set(endorsers + old_endorsers)))
-                            if new_endorsers != endorsers:
-                                endorsers_updated = True
-                                endorsers = new_endorsers
-                            old_idx = i
-                            break
-                        i += 1
-                    # Can we endorse this change? Or do we know something about the endorsements that this
-                    # change didn't know?
-                    if len(endorsers) < n and (party == self.party) and (group in self.groups) and self.id not in endorsers:
-                        # A newly added agent can't endorse the txn that adds itself.
-                        if not delta.startswith('add-' + self.id):
-                            endorsers.append(self.id)
-                            endorsers.sort()
-                            endorsers_updated = True
-                    if endorsers_updated:
-                        delta = '%s by {%s}/%s@%s' % (match.group(1), ','.join(endorsers), n, group)
-                    if old_idx > -1:
-                        lst[old_idx] = delta
-                    else:
-                        lst.append(delta)
-                else:
-                    lst.append(delta)
-                lst.sort()
-        return delta
+            return self._merge_delta(delta, party)
+
+    def merge(self, batch):
+        """Merge a batch (a dict of party -> deltas) under a single lock. Return how many deltas were new."""
+        with self.deltas_lock:
+            count = 0
+            for party, deltas in batch.items():
+                known = self.known[party]
+                for delta in deltas:
+                    if delta not in known:
+                        self._merge_delta(delta, party)
+                        count += 1
+            return count
+
+    def _merge_delta(self, delta, party):
+        """Do the work of append_delta; the caller holds deltas_lock."""
+        known = self.known[party]
+        # Disregard deltas that we already know about.
+        if delta in known:
+            return delta
+        self.digests[party] = None
+        lst = self.deltas[party]
+        match = m_of_n_of_group_pat.match(delta)
+        if not match:
+            known.add(delta)
+            bisect.insort(lst, delta)
+            return delta
+        base = match.group(1)
+        endorsers = set(match.group(2).split(',')) if match.group(2) else set()
+        index = self.endorsements[party]
+        e = index.get(base)
+        if e is None:
+            old = None
+            e = index[base] = _Endorsement(delta, base, endorsers, int(match.group(3)), match.group(4))
+            updated = False
+        else:
+            old = e.text
+            updated = not endorsers <= e.endorsers
+            e.endorsers |= endorsers
+        # Can we endorse this change? A newly added agent can't endorse the
+        # txn that adds itself.
+        if (len(e.endorsers) < e.n and party == self.party and e.group in self.groups
+                and self.id not in e.endorsers and not base.startswith('#add-' + self.id)):
+            e.endorsers.add(self.id)
+            updated = True
+        if updated:
+            e.render()
+        if e.text != old:
+            if old is not None:
+                del lst[bisect.bisect_left(lst, old)]
+                known.discard(old)
+            bisect.insort(lst, e.text)
+            known.add(e.text)
+        return e.text
 
     def broadcast(self, delta):
         self.say('Broadcasting to agents I can reach.')
@@ -283,22 +396,49 @@ class Agent:
         """\
         A.1: gossip           -- talk to any agents that A.1 can reach
         """
+        # Each side compares per-party digests with the other, then sends what
+        # the other lacks as one batch, so a pair exchanges at most two
+        # messages however many deltas they hold.
         if targets is None:
             targets = self.reachable
-        if targets:
-            def sync(s, t):
-                for key in s.deltas:
-                    for delta in s.deltas[key]:
-                        if delta not in t.deltas[key]:
-                            s.say('%s+%s--> %s' % (key, delta, t.id))
-                            t.receive(key + '+' + delta)
-            for t in targets:
-                sync(self, t)
-                sync(t, self)
+        for t in targets or ():
+            for s, r in ((self, t), (t, self)):
+                batch = s.missing_from(r)
+                if batch:
+                    s.say('%d delta(s) --> %s' % (sum(len(deltas) for deltas in batch.values()), r.id))
+                    r.receive_batch(batch)
+
+    def digest(self, party):
+        """Hash what we know of party's deltas (cf. File.snapshot). Agents with equal digests have nothing to sync."""
+        with self.deltas_lock:
+            digest = self.digests[party]
+            if digest is None:
+                hasher = hashlib.sha256()
+                for delta in self.deltas[party]:
+                    hasher.update(delta.encode('utf-8') + b'\n')
+                digest = base64.urlsafe_b64encode(hasher.digest()).decode('ascii')
+                self.digests[party] = digest
+            return digest
+
+    def missing_from(self, other):
+        """Return a batch (party -> deltas) of what we know and other doesn't."""
+        batch = {}
+        for party in self.deltas:
+            if party not in other.deltas or self.digest(party) == other.digest(party):
+                continue
+            # Take one lock at a time, so two agents gossiping with each other
+            # can't deadlock.
+            with other.deltas_lock:
+                theirs = set(other.known[party])
+            with self.deltas_lock:
+                missing = [delta for delta in self.deltas[party] if delta not in theirs]
+            if missing:
+                batch[party] = missing
+        return batch
 
     def autogossip(self):
-        if random.random() < 0.05:
-            target = random.choice(self.reachable)
-            self.gossip([target])
+        reachable = self.reachable
+        if reachable and random.random() < 0.05:
+            self.gossip([random.choice(reachable)])
 
     commands = ['simple', 'add', 'rem', 'state', 'gossip', 'resolve']
\ No newline at end of file
@@ -101,3 +101,15 @@ class Console:
                 if suffix:
                     sys.stdout.write(suffix)
             sys.stdout.write('\n')
+
+
+class NullConsole(Console):
+    """Swallows all output. Used when running headless."""
+    def prompt(self):
+        pass
+
+    def say_pre(self, msg):
+        pass
+
+    def say(self, msg):
+        pass
@@ -0,0 +1,118 @@
+import collections
+import heapq
+import threading
+import time
+import traceback
+
+
+class Scheduler:
+    """
+    Runs agents as actors on a small, fixed pool of worker threads. Each agent
+    has a mailbox of pending work (commands, received messages). Posting to a
+    mailbox makes the agent ready, and an idle worker runs one item for it, then
+    puts it back in line if more work is waiting. An agent is never run by two
+    workers at once, so agent code sees its own work serially. Idle workers
+    block on a condition variable, so a quiet simulation uses no CPU, however
+    many agents it has.
+
+    Work can be posted with a delay. It waits in a queue ordered by run-at
+    time (on clock()) and goes into the mailbox when due, so a delay never
+    occupies a worker.
+    """
+
+    def __init__(self, workers: int = 4, on_error=None, clock=time.monotonic):
+        if workers < 1:
+            raise ValueError('A scheduler needs at least one worker.')
+        self._cond = threading.Condition()
+        self._clock = clock
+        self._ready = collections.deque()
+        self._mailboxes = {}
+        # (run at, sequence number, agent, func, args) for delayed work.
+        self._delayed = []
+        self._seq = 0
+        self._running = set()
+        self._pending = 0
+        self._stopped = False
+        self._on_error = on_error
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def post(self, agent, func, *args, delay: float = 0):
+        """Queue func(*args) to run on behalf of agent, after delay seconds."""
+        with self._cond:
+            self._pending += 1
+            if delay > 0:
+                # Ties run in the order they were posted.
+                self._seq += 1
+                heapq.heappush(self._delayed, (self._clock() + delay, self._seq, agent, func, args))
+                # A waiting worker may need to wake sooner than it planned.
+                self._cond.notify()
+            else:
+                self._enqueue(agent, func, args)
+
+    def tick(self):
+        """Wake idle workers to check the clock again (after moving a fake clock)."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _enqueue(self, agent, func, args):
+        box = self._mailboxes.get(agent)
+        if box is None:
+            box = self._mailboxes[agent] = collections.deque()
+        box.append((func, args))
+        # If the box was empty and the agent isn't running, it isn't in
+        # line yet. (A running agent is requeued when it finishes.)
+        if len(box) == 1 and agent not in self._running:
+            self._ready.append(agent)
+            self._cond.notify()
+
+    def _release_due(self):
+        """Move delayed work that's due into mailboxes. Returns seconds until the next is due, or None."""
+        now = self._clock()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, agent, func, args = heapq.heappop(self._delayed)
+            self._enqueue(agent, func, args)
+        return self._delayed[0][0] - now if self._delayed else None
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Block until all posted work (including work it posts) is done."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = self._release_due()
+                    if self._ready or self._stopped:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+                agent = self._ready.popleft()
+                func, args = self._mailboxes[agent].popleft()
+                self._running.add(agent)
+            try:
+                func(*args)
+            except Exception:
+                if self._on_error:
+                    self._on_error(agent, traceback.format_exc())
+                else:
+                    traceback.print_exc()
+            with self._cond:
+                self._running.discard(agent)
+                self._pending -= 1
+                if self._mailboxes[agent]:
+                    self._ready.append(agent)
+                    self._cond.notify()
+                if self._pending == 0:
+                    self._cond.notify_all()
@@ -0,0 +1,49 @@
+import pytest
+import threading
+
+from .scheduler import Scheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_delayed_work_runs_in_run_at_order_without_holding_workers():
+    clock = FakeClock()
+    ran = []
+    lock = threading.Lock()
+
+    def record(item):
+        with lock:
+            ran.append(item)
+
+    s = Scheduler(1, clock=clock).start()
+    try:
+        # Jittered messages to one agent, posted out of run-at order.
+        s.post('a', record, 'late', delay=0.1)
+        s.post('a', record, 'early', delay=0.05)
+        s.post('a', record, 'tie', delay=0.1)
+        # The only worker is free for undelayed work meanwhile.
+        s.post('b', record, 'now')
+        s.post('b', record, 'next')
+        assert not s.wait_idle(0.2)
+        assert ran == ['now', 'next']
+        clock.now = 0.07
+        s.tick()
+        assert not s.wait_idle(0.2)
+        assert ran == ['now', 'next', 'early']
+        clock.now = 0.1
+        s.tick()
+        assert s.wait_idle(1)
+        assert ran == ['now', 'next', 'early', 'late', 'tie']
+    finally:
+        s.stop()
+
+
+def test_needs_a_worker():
+    with pytest.raises(ValueError):
+        Scheduler(0)
@@ -0,0 +1,239 @@
+"""
+Simulates the sync protocol at fleet scale. The interactive explorer gives each
+agent a real repo and runs a few agents; here, thousands of lightweight virtual
+agents are wired together by a generated topology, deltas are injected, and
+gossip rounds run in a discrete-event loop (with message latency) until every
+agent knows every delta. The report gives the rounds needed to converge, plus
+messages and bytes per agent. --protocol compares the batched digest exchange
+that Agent.gossip uses with the older one-message-per-delta exchange.
+
+    python simulate.py --agents 2000 --parties 2 --topology small-world --degree 6
+"""
+
+import argparse
+import base64
+import hashlib
+import heapq
+import json
+import random
+import string
+import time
+
+
+def _ids(agents, parties):
+    letters = string.ascii_uppercase[:parties]
+    return ['%s.%d' % (letters[i % parties], i // parties + 1) for i in range(agents)]
+
+
+def _link(reach, a, b):
+    reach[a].add(b)
+    reach[b].add(a)
+
+
+def random_topology(ids, rand, degree=4, **kwargs):
+    """Each agent links (both ways) to degree other agents chosen at random."""
+    reach = {id: set() for id in ids}
+    for a in ids:
+        for b in rand.sample(ids, min(degree, len(ids) - 1) + 1):
+            if b != a and len(reach[a]) < degree:
+                _link(reach, a, b)
+    return reach
+
+
+def small_world_topology(ids, rand, degree=4, rewire=0.1, **kwargs):
+    """Watts-Strogatz: a ring where each agent links to its degree nearest neighbors, randomly rewired."""
+    reach = {id: set() for id in ids}
+    n = len(ids)
+    for i, a in enumerate(ids):
+        for j in range(1, degree // 2 + 1):
+            b = ids[(i + j) % n]
+            if rand.random() < rewire:
+                b = rand.choice(ids)
+            if b != a:
+                _link(reach, a, b)
+    return reach
+
+
+def star_topology(ids, rand, relays=4, **kwargs):
+    """
+    A few relays (think cloud agents) all reach each other. Every other agent
+    (think edge devices) links to one relay.
+    """
+    hubs = ids[:relays]
+    reach = {id: set() for id in ids}
+    for a in hubs:
+        for b in hubs:
+            if a != b:
+                reach[a].add(b)
+    for a in ids[relays:]:
+        _link(reach, a, rand.choice(hubs))
+    return reach
+
+
+TOPOLOGIES = {
+    'random': random_topology,
+    'small-world': small_world_topology,
+    'star': star_topology,
+}
+
+
+class VirtualAgent:
+    __slots__ = ['id', 'party', 'peers', 'deltas', 'known', 'sent_msgs', 'sent_bytes']
+
+    def __init__(self, id, peers, parties):
+        self.id = id
+        self.party = id[0]
+        self.peers = peers
+        self.deltas = {p: set() for p in parties}
+        self.known = 0
+        self.sent_msgs = 0
+        self.sent_bytes = 0
+
+    def add(self, party, delta):
+        lst = self.deltas[party]
+        if delta not in lst:
+            lst.add(delta)
+            self.known += 1
+            return True
+        return False
+
+
+# Bytes in one party's digest, as exchanged by the batched protocol.
+_DIGEST_SIZE = len(base64.urlsafe_b64encode(hashlib.sha256().digest()))
+
+PROTOCOLS = ['batched', 'per-delta']
+
+
+class Simulation:
+    def __init__(self, reach, deltas_per_party=5, fanout=0, latency=(0.01, 0.2), seed=0, protocol='batched'):
+        """
+        :param reach: Dict of agent id -> set of ids it can reach.
+        :param deltas_per_party: Each is created by a random agent of its party at time 0.
+        :param fanout: Peers each agent gossips with per round (0 = all it can reach).
+        :param latency: Range of message delivery times, in rounds.
+        :param protocol: 'batched' (digests, then one batch of missing deltas per
+          direction) or 'per-delta' (one message per missing delta).
+        """
+        self.rand = random.Random(seed)
+        parties = sorted({id[0] for id in reach})
+        self.agents = {id: VirtualAgent(id, sorted(peers), parties) for id, peers in reach.items()}
+        self.fanout = fanout
+        self.protocol = protocol
+        self.latency = latency
+        self.events = []
+        self.seq = 0
+        self.messages = 0
+        self.digest_bytes = 0
+        self.total = 0
+        self.complete = 0
+        by_party = {}
+        for a in self.agents.values():
+            by_party.setdefault(a.party, []).append(a)
+        for party in parties:
+            for n in range(deltas_per_party):
+                creator = self.rand.choice(by_party[party])
+                creator.add(party, '#%s%x' % (party.lower(), self.rand.getrandbits(24) + n))
+                self.total += 1
+        # Agents are complete only once they know everything that was injected.
+        self.complete = sum(1 for a in self.agents.values() if a.known == self.total)
+
+    def _learn(self, agent, party, delta):
+        if agent.add(party, delta) and agent.known == self.total:
+            self.complete += 1
+
+    def _schedule(self, when, func, *args):
+        self.seq += 1
+        heapq.heappush(self.events, (when, self.seq, func, args))
+
+    def _count(self, sender, size):
+        sender.sent_msgs += 1
+        sender.sent_bytes += size
+        self.messages += 1
+
+    def _send(self, now, sender, target, party, delta):
+        self._count(sender, len(party) + 1 + len(delta))
+        self._schedule(now + self.rand.uniform(*self.latency), self._deliver, target, [(party, delta)])
+
+    def _send_batch(self, now, sender, target, batch):
+        self._count(sender, sum(len(party) + 1 + len(delta) for party, delta in batch))
+        self._schedule(now + self.rand.uniform(*self.latency), self._deliver, target, batch)
+
+    def _deliver(self, now, target, batch):
+        for party, delta in batch:
+            self._learn(target, party, delta)
+
+    def _gossip(self, now, agent):
+        peers = agent.peers
+        if self.fanout and len(peers) > self.fanout:
+            peers = self.rand.sample(peers, self.fanout)
+        for id in peers:
+            peer = self.agents[id]
+            # Same exchange as Agent.gossip: each side sends what the other lacks.
+            for s, t in ((agent, peer), (peer, agent)):
+                if self.protocol == 'batched':
+                    # The digest message; equal sets stand in for equal digests.
+                    self._count(s, _DIGEST_SIZE * len(s.deltas))
+                    self.digest_bytes += _DIGEST_SIZE * len(s.deltas)
+                    batch = [(party, delta) for party, deltas in s.deltas.items()
+                             if deltas != t.deltas[party] for delta in deltas - t.deltas[party]]
+                    if batch:
+                        self._send_batch(now, s, t, batch)
+                else:
+                    for party, deltas in s.deltas.items():
+                        for delta in deltas - t.deltas[party]:
+                            self._send(now, s, t, party, delta)
+
+    def run(self, max_rounds=1000):
+        start = time.perf_counter()
+        n = len(self.agents)
+        rounds = 0
+        while self.complete < n and rounds < max_rounds:
+            for a in self.agents.values():
+                self._schedule(rounds + self.rand.random(), self._gossip, a)
+            rounds += 1
+            while self.events and self.events[0][0] < rounds:
+                when, _, func, args = heapq.heappop(self.events)
+                func(when, *args)
+        msgs = [a.sent_msgs for a in self.agents.values()]
+        sent = [a.sent_bytes for a in self.agents.values()]
+        return {
+            'protocol': self.protocol,
+            'agents': n,
+            'edges': sum(len(a.peers) for a in self.agents.values()),
+            'deltas': self.total,
+            'converged': self.complete == n,
+            'rounds': rounds,
+            'messages': self.messages,
+            'bytes': sum(sent),
+            'digest_bytes': self.digest_bytes,
+            'messages_per_agent': {'mean': sum(msgs) / n, 'max': max(msgs)},
+            'bytes_per_agent': {'mean': sum(sent) / n, 'max': max(sent)},
+            'seconds': time.perf_counter() - start,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate peer DID sync across many virtual agents.')
+    parser.add_argument('--agents', type=int, default=1000)
+    parser.add_argument('--parties', type=int, default=2)
+    parser.add_argument('--topology', choices=sorted(TOPOLOGIES), default='small-world')
+    parser.add_argument('--degree', type=int, default=4, help='links per agent (random, small-world)')
+    parser.add_argument('--rewire', type=float, default=0.1, help='rewiring probability (small-world)')
+    parser.add_argument('--relays', type=int, default=4, help='number of relays (star)')
+    parser.add_argument('--deltas', type=int, default=5, help='deltas injected per party')
+    parser.add_argument('--fanout', type=int, default=0, help='peers contacted per round (0 = all)')
+    parser.add_argument('--protocol', choices=PROTOCOLS, default='batched')
+    parser.add_argument('--max-rounds', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    rand = random.Random(args.seed)
+    ids = _ids(args.agents, args.parties)
+    reach = TOPOLOGIES[args.topology](ids, rand, degree=args.degree, rewire=args.rewire, relays=args.relays)
+    sim = Simulation(reach, args.deltas, args.fanout, seed=args.seed, protocol=args.protocol)
+    report = sim.run(args.max_rounds)
+    report['topology'] = args.topology
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
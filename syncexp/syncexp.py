@@ -5,17 +5,18 @@ import re
 import shutil
 import sys
 import textwrap
+import threading
 import time
-import traceback
 import types
 
-from agent import Agent, conn_pat
+from agent import Agent, conn_pat, get_reachability
 import console
 import cmdlog
+from scheduler import Scheduler
 
 
 agent_cmd_pat = re.compile(r'\s*([a-z]\.[1-9])\s*:\s*(.+)', re.I)
-should_autogossip = False
+should_autogossip = threading.Event()
 
 
 def quit():
@@ -31,24 +32,32 @@ def autogossip(*args):
     """
     mode = 'on' if (args and args[0].lower() == 'on') else 'off'
     stdout.say('Turning autogossip %s.' % mode)
-    global should_autogossip
-    should_autogossip = bool(mode == 'on')
+    if mode == 'on':
+        should_autogossip.set()
+    else:
+        should_autogossip.clear()
+
+
+def get_agents_by_state():
+    agents_by_state = {}
+    with Agent.all_lock:
+        agents = list(Agent.all)
+    for a in agents:
+        this_state = a.state_summary
+        if this_state not in agents_by_state:
+            agents_by_state[this_state] = [a]
+        else:
+            agents_by_state[this_state].append(a)
+    return agents_by_state
 
 
 def check(*args):
     """\
     check                 -- see whether all agents have synchronized state
     """
-    agents_by_state = {}
-    with Agent.all_lock:
-        for a in Agent.all:
-            this_state = a.state_summary
-            if this_state not in agents_by_state:
-                agents_by_state[this_state] = [a]
-            else:
-                agents_by_state[this_state].append(a)
+    agents_by_state = get_agents_by_state()
     if len(agents_by_state) == 1:
-        stdout.say('All agents agree that state is %s.' % this_state)
+        stdout.say('All agents agree that state is %s.' % list(agents_by_state.keys())[0])
     else:
         report = 'Agents are not fully synchronized.'
         for key, agents in agents_by_state.items():
@@ -56,6 +65,27 @@ def check(*args):
         stdout.say(report)
 
 
+def converge(*args):
+    """\
+    converge [rounds]     -- gossip in rounds until all agents agree (default: at most 100 rounds)
+    """
+    max_rounds = int(args[0]) if args else 100
+    start = time.perf_counter()
+    rounds = 0
+    while len(get_agents_by_state()) > 1 and rounds < max_rounds:
+        rounds += 1
+        with Agent.all_lock:
+            agents = list(Agent.all)
+        for a in agents:
+            a.gossip()
+        if Agent.scheduler:
+            Agent.scheduler.wait_idle()
+    elapsed = time.perf_counter() - start
+    agreed = len(get_agents_by_state()) == 1
+    stdout.say('%s after %d round(s) in %.3f seconds.' % ('Converged' if agreed else 'Did not converge', rounds, elapsed))
+    return agreed, rounds, elapsed
+
+
 def reach(*args):
     """\
     reach [agentpat]      -- show where specified agent(s) can reach (wildcards ok).
@@ -88,24 +118,23 @@ stdout = console.Console()
 
             
 def abort(msg):
-    stdout.say('Error: ' + msg)
+    # To stderr, so it's seen even when running headless.
+    sys.stderr.write(console.wrap('Error: ' + msg) + '\n')
     sys.exit(1)
 
 
-def thread_main(agent):
-    global should_autogossip
-    try:
-        while True:
-            time.sleep(0.33)
-            with Agent.cmds_lock:
-                n = len(Agent.cmds)
-            while agent.cmd_idx < n:
-                agent.next()
-            if should_autogossip:
-                agent.autogossip()
-    except:
-        agent.say(traceback.format_exc())
-        os._exit(1)
+def autogossip_main(scheduler):
+    # Sleeps on the event (no CPU) while autogossip is off.
+    while should_autogossip.wait():
+        time.sleep(0.33)
+        with Agent.all_lock:
+            agents = list(Agent.all)
+        for a in agents:
+            scheduler.post(a, a.autogossip)
+
+
+def report_agent_error(agent, tb):
+    agent.say(tb)
 
 
 def expand_diddoc_template(ch, template):
@@ -137,10 +166,10 @@ def expand_diddoc_template(ch, template):
 def load_agents(session_folder, diddocs, connections):
     if len(diddocs) < 2:
         abort('Must have at least 2 parties.')
-    Agent.thread_main = thread_main
     Agent.stdout = stdout
     gs = []
     privkeys = {}
+    reachability = get_reachability(connections)
     # Generate keys and build all the genesis DID docs.
     for ch, template in diddocs.items():
         privkeys[ch] = expand_diddoc_template(ch, template)
@@ -153,7 +182,7 @@ def load_agents(session_folder, diddocs, connections):
             # connection info. This initializes state in the same way as doing the DID exchange
             # protocol. Since this explorer is about updating, not connecting, it's the right
             # condition to start from.
-            Agent(session_folder, key, gs, connections)
+            Agent(session_folder, key, gs, reachability)
 
 
 def get_next_command():
@@ -180,19 +209,95 @@ def dispatch(cmd):
         func(*args)
 
 
+def find_agent(id):
+    with Agent.all_lock:
+        return Agent.by_id.get(id)
+
+
+def run_script(path):
+    """
+    Run commands from a file, with no console, threads or pauses. Returns a report
+    that says whether (and how soon after starting) all agents agreed on state.
+    """
+    with open(path, 'rt') as f:
+        lines = [line.strip() for line in f]
+    start = time.perf_counter()
+    converged_at = None
+    converged_after = None
+    n = 0
+    for cmd in lines:
+        if not cmd or cmd.startswith('#'):
+            continue
+        n += 1
+        m = agent_cmd_pat.match(cmd)
+        if m:
+            agent = find_agent(m.group(1).upper())
+            if agent:
+                agent.execute(m.group(2).strip())
+            else:
+                stdout.say('No such agent.')
+        else:
+            dispatch(cmd)
+        if len(get_agents_by_state()) == 1:
+            if converged_at is None:
+                converged_at = time.perf_counter() - start
+                converged_after = n
+        else:
+            converged_at = converged_after = None
+    with Agent.all_lock:
+        agents = list(Agent.all)
+    return {
+        'agents': len(agents),
+        'parties': len({a.party for a in agents}),
+        'commands': n,
+        'seconds': time.perf_counter() - start,
+        'converged': converged_at is not None,
+        'converged_at_seconds': converged_at,
+        'converged_after_command': converged_after,
+        'distinct_states': len(get_agents_by_state()),
+    }
+
+
+def profiled(kind, func):
+    if kind == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    elif kind == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            return func()
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            for stat in snapshot.statistics('lineno')[:15]:
+                sys.stderr.write(str(stat) + '\n')
+            sys.stderr.write('Peak traced memory: %d bytes\n' % peak)
+    return func()
+
+
 def main():
     try:
         while True:
             cmd = get_next_command()
             m = agent_cmd_pat.match(cmd)
-            if m:
-                with Agent.cmds_lock:
-                    Agent.cmds.append(m.group(1).upper() + ': ' + m.group(2))
+            agent = find_agent(m.group(1).upper()) if m else None
+            if agent:
+                agent.command(m.group(2).strip())
             elif ':' in cmd:
                 stdout.say('No such agent.')
             else:
                 dispatch(cmd)
-            time.sleep(1)
+            # Let the command's effects finish printing before prompting again.
+            Agent.scheduler.wait_idle(1)
     except KeyboardInterrupt:
         stdout.say('')
 
@@ -206,7 +311,8 @@ if __name__ == '__main__':
         print('\n' + console.wrap("""%s: run the peer DID sync protocol in exploratory mode.
 %s
 
-Syntax: python %s [<session name> <DID doc template mappings> <connectivity statements>]
+Syntax: python %s [--workers <n>] [--script <file> [--profile cprofile|tracemalloc]]
+    [<session name> <DID doc template mappings> <connectivity statements>]
 
 Example args:
 
@@ -238,15 +344,36 @@ by the identity subject. Connectivity statements are in the form <XconnY,Z>, whe
 identifiers like A.1 and B.2, and conn is the +-+ (bidirectional) symbol, or -+ or +- (unidirectional arrows).
 The arrow/plus points to the side where an agent might be passively updated by data that they receive from the
 other side. Don't put spaces between identifiers and the connector or commas.
-""" % (short_name, '-'*console.cols, __file__, default_cmdline)))
+
+With --script, the tool runs headless: it executes the commands in the file (one per line, same syntax as
+at the prompt; # starts a comment) without threads, pauses or agent chatter, then prints a JSON report of
+how long the agents took to converge on identical state. The "converge" command is handy in scripts.
+--profile wraps the run in cProfile or tracemalloc and prints the results to stderr.
+
+Interactively, agents don't get a thread each. Their commands and messages are queued, and a pool of
+--workers threads (default 4) runs them as they arrive.
+""" % (short_name, '-'*console.column_count, __file__, default_cmdline)))
         sys.exit(0)
 
     diddoc_pat = re.compile(r'([A-Z])=(.*)$', re.I)
 
-    if len(sys.argv) == 1:
+    args = sys.argv[1:]
+    script = profile = None
+    workers = 4
+    while args and args[0].startswith('--'):
+        opt = args.pop(0)
+        if opt == '--script' and args:
+            script = args.pop(0)
+        elif opt == '--workers' and args and args[0].isdigit():
+            workers = int(args.pop(0))
+            if workers < 1:
+                abort('--workers must be at least 1.')
+        elif opt == '--profile' and args and args[0] in ('cprofile', 'tracemalloc'):
+            profile = args.pop(0)
+        else:
+            abort('Bad option %s.' % opt)
+    if not args:
         args = default_cmdline.split(' ')
-    else:
-        args = sys.argv[1:]
     session = args[0]
     args = args[1:]
     diddocs = {}
@@ -268,11 +395,22 @@ other side. Don't put spaces between identifiers and the connector or commas.
                 raise Exception("Unrecognized arg %s.")
             connections.append(arg.upper())
 
+    if script:
+        # Keep stdout for the JSON report. Agents pick this up in load_agents().
+        stdout = console.NullConsole()
     session_folder = os.path.join(os.path.expanduser('~/.syncexp'), session)
     stdout.say("Running session in %s." % session_folder)
     if os.path.isdir(session_folder):
         shutil.rmtree(session_folder)
     os.makedirs(session_folder)
 
-    load_agents(session_folder, diddocs, connections)
-    main()
\ No newline at end of file
+    if script:
+        Agent.jitter = False
+        load_agents(session_folder, diddocs, connections)
+        report = profiled(profile, lambda: run_script(script))
+        print(json.dumps(report, indent=2))
+    else:
+        load_agents(session_folder, diddocs, connections)
+        Agent.scheduler = Scheduler(workers, report_agent_error).start()
+        threading.Thread(target=autogossip_main, args=(Agent.scheduler,), daemon=True).start()
+        main()
\ No newline at end of file